@@ -8,13 +8,18 @@ from StringIO import StringIO
 from zope.interface import classImplements
 
 from twisted.python.components import registerAdapter
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
 
-from bafload.interfaces import IByteLength, IFile, IStringIO
+from bafload.interfaces import IByteLength, IFile, IStringIO, IBuffer
 
 
 classImplements(int, IByteLength)
 classImplements(types.FileType, IFile)
 classImplements(StringIO, IStringIO)
+classImplements(str, IBuffer)
+classImplements(bytearray, IBuffer)
+classImplements(types.BufferType, IBuffer)
+classImplements(memoryview, IBuffer)
 
 
 def fd_to_bytelength(fd):
@@ -34,3 +39,22 @@ def stringio_to_bytelength(stringio):
     return stringio.len
 
 registerAdapter(stringio_to_bytelength, IStringIO, IByteLength)
+
+
+def buffer_to_bytelength(buf):
+    """
+    Adapt an in-memory buffer to a bytes length (int)
+    """
+    return len(buf)
+
+registerAdapter(buffer_to_bytelength, IBuffer, IByteLength)
+
+
+def bodyproducer_to_bytelength(producer):
+    """
+    Adapt a body producer to its bytes length (int) if the length is known
+    """
+    if producer.length is not UNKNOWN_LENGTH:
+        return producer.length
+
+registerAdapter(bodyproducer_to_bytelength, IBodyProducer, IByteLength)
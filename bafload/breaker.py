@@ -0,0 +1,248 @@
+"""
+Limits on retrying during outages.
+
+When an endpoint struggles, every call retrying on its own multiplies the
+load on it. A L{GuardedRetry} wraps an L{IRetryDeferred} provider with a
+L{RetryBudget}, which allows retries only as a fraction of recent
+successful calls and is typically shared by the whole process, and a
+L{CircuitBreaker}, typically one per endpoint or bucket, which holds calls
+back while the endpoint is failing and lets a few probe calls through to
+find out when it has recovered.
+"""
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.python.failure import Failure
+
+from bafload.retry import IRetryDeferred, is_retryable
+
+
+__all__ = ['RetryBudgetExhausted', 'RetryBudget', 'CircuitBreaker',
+           'GuardedRetry']
+
+
+class RetryBudgetExhausted(Exception):
+    """
+    A call was not retried because the L{RetryBudget} was spent.
+    """
+
+
+class RetryBudget(object):
+    """
+    A budget of retries: over the last C{window} seconds, at most
+    C{ratio} retries per successful call plus C{min_retries} retries are
+    allowed.
+
+    @param ratio: Retries allowed per successful call
+    @param min_retries: Retries allowed in a window without any successes
+    @param window: Length in seconds of the window of calls remembered
+    @param slots: Number of slots the window is divided into
+    @param clock: L{twisted.internet.interfaces.IReactorTime} provider.
+        default: the global reactor
+    """
+
+    def __init__(self, ratio=0.1, min_retries=10, window=10, slots=10,
+                 clock=None):
+        if clock is None:
+            clock = reactor
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.slot_duration = float(window) / slots
+        self.clock = clock
+        self.successes = 0
+        self.retries = 0
+        self._slots = deque()
+
+    def _slot(self):
+        now = int(self.clock.seconds() / self.slot_duration)
+        oldest = now - int(self.window / self.slot_duration) + 1
+        while self._slots and self._slots[0][0] < oldest:
+            (_, successes, retries) = self._slots.popleft()
+            self.successes -= successes
+            self.retries -= retries
+        if not self._slots or self._slots[-1][0] != now:
+            self._slots.append([now, 0, 0])
+        return self._slots[-1]
+
+    def deposit(self):
+        """
+        Record a successful call.
+        """
+        self._slot()[1] += 1
+        self.successes += 1
+
+    def withdraw(self):
+        """
+        Return True, recording a retry, if the budget allows one.
+        """
+        slot = self._slot()
+        if self.retries >= self.successes * self.ratio + self.min_retries:
+            return False
+        slot[2] += 1
+        self.retries += 1
+        return True
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker for calls to one endpoint. After C{threshold}
+    consecutive retryable failures the breaker opens and calls wait; after
+    C{reset_timeout} seconds it is half-open and up to C{probes} waiting
+    calls are let through. A successful probe closes the breaker, letting
+    all waiting calls through, and a failed one opens it again.
+
+    @param threshold: Consecutive failures which open the breaker
+    @param reset_timeout: Seconds the breaker stays open
+    @param probes: Calls let through at once while half-open
+    @param classify: Callable taking a L{Failure}, returning True if the
+        failure counts against the endpoint. default: L{is_retryable}
+    @param clock: L{twisted.internet.interfaces.IReactorTime} provider.
+        default: the global reactor
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=10, probes=1,
+                 classify=is_retryable, clock=None):
+        if clock is None:
+            clock = reactor
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.classify = classify
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = 0
+        self._waiting = deque()
+        self._timer = None
+
+    @property
+    def waiting(self):
+        """
+        Number of calls waiting for the breaker to let them through.
+        """
+        return len(self._waiting)
+
+    def call(self, f, *args, **kwargs):
+        """
+        Call C{f} once the breaker lets it through.
+        """
+        if self.state == self.CLOSED:
+            return self._call(f, args, kwargs, False)
+        if self.state == self.HALF_OPEN and self.probing < self.probes:
+            return self._call(f, args, kwargs, True)
+        d = Deferred(self._cancel)
+        self._waiting.append((d, f, args, kwargs))
+        return d
+
+    def _cancel(self, d):
+        for waiting in self._waiting:
+            if waiting[0] is d:
+                self._waiting.remove(waiting)
+                break
+
+    def _call(self, f, args, kwargs, probe):
+        if probe:
+            self.probing += 1
+        d = maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._finished, probe)
+        return d
+
+    def _finished(self, result, probe):
+        if probe:
+            self.probing -= 1
+        if isinstance(result, Failure):
+            if self.classify(result):
+                self.failures += 1
+                if probe or self.failures >= self.threshold:
+                    self._open()
+        elif self.state != self.CLOSED or self.failures:
+            self._close()
+        if probe and self.state == self.HALF_OPEN:
+            # The probe failed without telling anything about the
+            # endpoint (say, it was cancelled); let the next one through.
+            self._release()
+        return result
+
+    def _open(self):
+        if self.state == self.OPEN:
+            return
+        self.state = self.OPEN
+        self._timer = self.clock.callLater(self.reset_timeout,
+                                           self._half_open)
+
+    def _half_open(self):
+        self._timer = None
+        self.state = self.HALF_OPEN
+        self._release()
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._release()
+
+    def _release(self):
+        while self._waiting and (self.state == self.CLOSED or
+                                 (self.state == self.HALF_OPEN and
+                                  self.probing < self.probes)):
+            (d, f, args, kwargs) = self._waiting.popleft()
+            self.call(f, *args, **kwargs).chainDeferred(d)
+
+
+class _Attempts(object):
+    """
+    Calls made by one L{GuardedRetry.retry}.
+    """
+    count = 0
+
+
+class GuardedRetry(object):
+    """
+    Retry strategy which has C{retry_strategy} retry calls, drawing retries
+    from C{budget} and making calls through C{breaker}. A retry not allowed
+    by the budget fails with L{RetryBudgetExhausted}, which retry
+    strategies classifying failures, such as
+    L{bafload.retry.ClassifyingBackoff}, don't retry.
+
+    @param retry_strategy: The wrapped L{IRetryDeferred} provider
+    @param budget: A L{RetryBudget}, or None for unlimited retries
+    @param breaker: A L{CircuitBreaker}, or None
+    """
+    implements(IRetryDeferred)
+
+    def __init__(self, retry_strategy, budget=None, breaker=None):
+        self.retry_strategy = retry_strategy
+        self.budget = budget
+        self.breaker = breaker
+
+    def retry(self, f, *args, **kwargs):
+        return self.retry_strategy.retry(self._attempt, _Attempts(), f, args,
+                                         kwargs)
+
+    def _attempt(self, attempts, f, args, kwargs):
+        if attempts.count and self.budget is not None and \
+                not self.budget.withdraw():
+            return fail(RetryBudgetExhausted(
+                'Retry budget exhausted calling %s' % (f,)))
+        attempts.count += 1
+        if self.breaker is not None:
+            d = self.breaker.call(f, *args, **kwargs)
+        else:
+            d = f(*args, **kwargs)
+        if self.budget is not None:
+            d.addCallback(self._succeeded)
+        return d
+
+    def _succeeded(self, result):
+        self.budget.deposit()
+        return result
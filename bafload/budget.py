@@ -0,0 +1,71 @@
+"""
+Memory governor for parts in flight.
+"""
+from collections import deque
+
+from twisted.internet.defer import Deferred
+
+
+__all__ = ['ByteBudget']
+
+
+class ByteBudget(object):
+    """
+    A budget of bytes for parts which have been generated (read into memory)
+    but not yet uploaded. A budget is shared by all uploads of a
+    L{bafload.up.MultipartUploadsManager}: uploads reserve a part's worth of
+    bytes before generating each part and wait, in order, while the budget
+    is spent. Bytes are returned as parts finish.
+
+    A reservation is always granted when nothing is in flight so a part
+    larger than the whole budget can still be uploaded.
+
+    @param limit: Maximum number of bytes in flight.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiting = deque()
+
+    @property
+    def waiting(self):
+        """
+        Number of reservations waiting for bytes to be released.
+        """
+        return len(self._waiting)
+
+    def acquire(self, size):
+        """
+        Reserve C{size} bytes, returning a L{Deferred} which fires with
+        C{size} once they have been reserved. Cancelling the L{Deferred}
+        withdraws a waiting reservation.
+        """
+        d = Deferred(self._cancel)
+        if not self._waiting and self._fits(size):
+            self.in_flight += size
+            d.callback(size)
+        else:
+            self._waiting.append((d, size))
+        return d
+
+    def _cancel(self, d):
+        for reservation in self._waiting:
+            if reservation[0] is d:
+                self._waiting.remove(reservation)
+                break
+        self.release(0)
+
+    def release(self, size):
+        """
+        Return C{size} reserved bytes to the budget, granting waiting
+        reservations which now fit.
+        """
+        self.in_flight -= size
+        while self._waiting and self._fits(self._waiting[0][1]):
+            (d, size) = self._waiting.popleft()
+            self.in_flight += size
+            d.callback(size)
+
+    def _fits(self, size):
+        return not self.in_flight or self.in_flight + size <= self.limit
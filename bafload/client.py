@@ -0,0 +1,158 @@
+"""
+The S3 client used by bafload.
+
+L{S3Client} is L{txaws.s3.client.S3Client} with the multipart upload
+calls uploads need working: C{upload_part} sends a C{body_producer} as
+the part's body (txAWS 0.3.0 accepts the argument but uploads an empty
+body) and reads the response's headers from C{headers}, which twisted.web
+responses have, rather than C{responseHeaders}, which they don't. It also
+adds C{list_parts}, for reconciling resumed uploads with S3, and
+C{abort_multipart_upload}, for cleaning up after cancelled uploads. Errors
+keep the Retry-After header of their response as C{retry_after}, for
+L{bafload.retry.retry_after}.
+"""
+from twisted.python.failure import Failure
+from twisted.web.http import OK, NO_CONTENT
+
+from txaws.client.base import _Query as _BaseQuery
+from txaws.s3.client import S3Client as _S3Client, s3_error_wrapper
+from txaws.util import XML
+
+
+__all__ = ['S3Client', 'get_s3_client']
+
+
+def _to_dict(headers):
+    return dict((k, vs[0]) for (k, vs) in headers.getAllRawHeaders())
+
+
+class _Query(_BaseQuery):
+    """
+    A txAWS query whose error responses keep their Retry-After header as
+    the error's C{retry_after}.
+    """
+
+    def _check_response(self, data, response):
+        result = _BaseQuery._check_response(self, data, response)
+        if isinstance(result, Failure):
+            hint = response.headers.getRawHeaders('retry-after')
+            if hint:
+                result.value.retry_after = hint[0]
+        return result
+
+
+def _error_wrapper(why):
+    hint = getattr(why.value, 'retry_after', None)
+    try:
+        return s3_error_wrapper(why)
+    except Exception, e:
+        # The S3Error parsed from the response replaces the web error.
+        if hint is not None and getattr(e, 'retry_after', None) is None:
+            e.retry_after = hint
+        raise
+
+
+class S3Client(_S3Client):
+    """
+    A L{txaws.s3.client.S3Client} with working multipart uploads.
+    """
+
+    def __init__(self, creds=None, endpoint=None, query_factory=None,
+                 **kwargs):
+        if query_factory is None:
+            query_factory = _Query
+        _S3Client.__init__(self, creds, endpoint, query_factory, **kwargs)
+
+    def _submit(self, query):
+        d = query.submit(self.agent, self.receiver_factory, self.utcnow)
+        d.addErrback(_error_wrapper)
+        return d
+
+    def upload_part(self, bucket, object_name, upload_id, part_number,
+                    data=None, content_type=None, metadata={},
+                    body_producer=None):
+        """
+        Upload part C{part_number} of multipart upload C{upload_id}, with
+        C{data} or the bytes of C{body_producer} as its body.
+
+        @return: L{Deferred} which fires with a C{dict} of the response's
+            headers, such as C{'ETag'}.
+        """
+        parms = 'partNumber=%s&uploadId=%s' % (part_number, upload_id)
+        details = self._details(
+            method='PUT',
+            url_context=self._url_context(bucket=bucket,
+                object_name='%s?%s' % (object_name, parms)),
+            headers=self._headers(content_type),
+            metadata=metadata,
+            body=data,
+            body_producer=body_producer)
+        d = self._submit(self._query_factory(details))
+        d.addCallback(lambda (response, body): _to_dict(response.headers))
+        return d
+
+    def list_parts(self, bucket, object_name, upload_id):
+        """
+        List the parts uploaded for multipart upload C{upload_id}, over as
+        many requests as S3 pages the listing into.
+
+        @return: L{Deferred} which fires with a list of (part_number, etag)
+            pairs in ascending order of part number.
+        """
+        return self._list_parts(bucket, object_name, upload_id, None, [])
+
+    def _list_parts(self, bucket, object_name, upload_id, marker, parts):
+        parms = 'uploadId=%s' % (upload_id,)
+        if marker is not None:
+            parms += '&part-number-marker=%s' % (marker,)
+        details = self._details(
+            method='GET',
+            url_context=self._url_context(bucket=bucket,
+                object_name='%s?%s' % (object_name, parms)))
+        d = self._submit(self._query_factory(details))
+        d.addCallback(self._parse_list_parts, bucket, object_name, upload_id,
+                      parts)
+        return d
+
+    def _parse_list_parts(self, (response, xml_bytes), bucket, object_name,
+                          upload_id, parts):
+        root = XML(xml_bytes)
+        for part in root.findall('Part'):
+            parts.append((int(part.findtext('PartNumber')),
+                          part.findtext('ETag')))
+        if root.findtext('IsTruncated') != 'true':
+            return parts
+        return self._list_parts(bucket, object_name, upload_id,
+                                root.findtext('NextPartNumberMarker'), parts)
+
+    def abort_multipart_upload(self, bucket, object_name, upload_id):
+        """
+        Abort multipart upload C{upload_id}, freeing the storage of its
+        uploaded parts.
+
+        @return: L{Deferred} which fires with None once S3 has aborted the
+            upload.
+        """
+        details = self._details(
+            method='DELETE',
+            url_context=self._url_context(bucket=bucket,
+                object_name='%s?uploadId=%s' % (object_name, upload_id)))
+        d = self._submit(self._query_factory(details,
+                                             ok_status=(OK, NO_CONTENT)))
+        d.addCallback(lambda ignore: None)
+        return d
+
+
+def get_s3_client(region, agent=None):
+    """
+    Return an L{S3Client} for the S3 endpoint and credentials of C{region}
+    (a L{txaws.service.AWSServiceRegion}), making requests with C{agent},
+    if given. Clients without an agent are cached by the region, as
+    C{region.get_s3_client()} caches its clients.
+    """
+    if agent is not None:
+        return S3Client(creds=region.creds, endpoint=region.s3_endpoint,
+                        agent=agent)
+    return region.get_client(S3Client, creds=region.creds,
+                             endpoint=region.s3_endpoint, query_factory=None)
+
@@ -19,6 +19,8 @@ class BaseCounter(ProgressLoggerMixin):
 
     completed = 0
     expected = None
+    bytes = 0
+    expected_bytes = None
     receiving = None
     context = ''
     format_for_stdout = True
@@ -26,8 +28,9 @@ class BaseCounter(ProgressLoggerMixin):
     def __init__(self, expected):
         self.expected = expected
 
-    def increment_count(self):
+    def increment_count(self, size=0):
         self.completed += 1
+        self.bytes += size
         verb = ('transferred', 'received')[self.receiving]
         cr = ('', '\r')[self.format_for_stdout]
         self.log.msg('%-40s %s' % ('%s%s parts %d/%s' % (self.context, verb,
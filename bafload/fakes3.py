@@ -0,0 +1,476 @@
+"""
+A local stand-in for S3, for measuring uploads without network access.
+
+L{FakeS3} keeps buckets, objects and multipart uploads in memory and
+L{FakeS3Resource} serves it over HTTP with path-style URLs, as
+L{txaws.s3.client.S3Client} requests them:
+
+    - C{POST /bucket/key?uploads} initiates a multipart upload
+    - C{PUT /bucket/key?partNumber=N&uploadId=ID} uploads a part
+    - C{POST /bucket/key?uploadId=ID} completes an upload
+    - C{DELETE /bucket/key?uploadId=ID} aborts an upload
+    - C{GET /bucket/key?uploadId=ID} lists the parts of an upload
+    - C{PUT /bucket/key} puts an object
+    - C{GET /bucket/key} gets an object, or a range of it with a C{Range}
+      header
+    - C{DELETE /bucket/key} deletes an object
+
+Responses are delayed and failed as configured by L{Faults}. Requests
+aren't authenticated. Serve it locally with, for example::
+
+    port = reactor.listenTCP(0, Site(FakeS3Resource(FakeS3())),
+                             interface='127.0.0.1')
+    region = AWSServiceRegion(creds=creds,
+        s3_uri='http://127.0.0.1:%d/' % port.getHost().port)
+"""
+import random
+import uuid
+from hashlib import md5
+from urlparse import parse_qs
+from xml.sax.saxutils import escape
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from txaws.util import XML
+
+
+__all__ = ['FakeS3Error', 'FakeS3', 'Faults', 'FakeS3Resource']
+
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def _etag(data):
+    return '"%s"' % md5(data).hexdigest()
+
+
+def _xml(root, *elements):
+    """
+    Return an S3 XML document with element C{root} containing
+    C{elements}, each a (name, text) pair or a (name, [elements]) pair.
+    """
+    def render(elements):
+        for (name, content) in elements:
+            if isinstance(content, list):
+                content = ''.join(render(content))
+            else:
+                content = escape(str(content))
+            yield '<%s>%s</%s>' % (name, content, name)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<%s xmlns="%s">%s</%s>' % (root, S3_NAMESPACE,
+                                       ''.join(render(elements)), root)
+
+
+class FakeS3Error(Exception):
+    """
+    An S3 error response.
+
+    @ivar status: The HTTP status code
+    @ivar code: The S3 error code, such as C{NoSuchUpload}
+    """
+
+    def __init__(self, status, code, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+    def render(self):
+        return _xml('Error', ('Code', self.code), ('Message', self.message))
+
+
+class _Upload(object):
+
+    def __init__(self, bucket, object_name):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.parts = {}
+
+
+class FakeS3(object):
+    """
+    Buckets, objects and multipart uploads kept in memory. Buckets are
+    created as objects are written to them.
+
+    @ivar buckets: C{dict} of bucket name to a C{dict} of object name to
+        (data, etag)
+    @ivar uploads: C{dict} of upload id to the multipart uploads in
+        progress
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.uploads = {}
+
+    def clear(self):
+        """
+        Forget all objects and uploads.
+        """
+        self.buckets.clear()
+        self.uploads.clear()
+
+    def _upload(self, upload_id, bucket, object_name):
+        upload = self.uploads.get(upload_id)
+        if upload is None or (upload.bucket, upload.object_name) != (
+                bucket, object_name):
+            raise FakeS3Error(404, 'NoSuchUpload',
+                              'The specified upload does not exist.')
+        return upload
+
+    def initiate(self, bucket, object_name):
+        """
+        Start a multipart upload, returning its upload id.
+        """
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = _Upload(bucket, object_name)
+        return upload_id
+
+    def upload_part(self, bucket, object_name, upload_id, part_number, data):
+        """
+        Store part C{part_number} of an upload, returning its ETag.
+        """
+        upload = self._upload(upload_id, bucket, object_name)
+        if not 1 <= part_number <= 10000:
+            raise FakeS3Error(400, 'InvalidArgument',
+                              'Part number must be between 1 and 10000.')
+        etag = _etag(data)
+        upload.parts[part_number] = (data, etag)
+        return etag
+
+    def list_parts(self, bucket, object_name, upload_id):
+        """
+        Return (part_number, etag, size) tuples of the parts of an upload.
+        """
+        upload = self._upload(upload_id, bucket, object_name)
+        return [(part_number, etag, len(data)) for (part_number,
+                (data, etag)) in sorted(upload.parts.items())]
+
+    def complete(self, bucket, object_name, upload_id, parts):
+        """
+        Join C{parts}, (part_number, etag) pairs in ascending order, into
+        the object, returning its ETag.
+        """
+        upload = self._upload(upload_id, bucket, object_name)
+        if not parts:
+            raise FakeS3Error(400, 'MalformedXML',
+                              'The XML you provided was not well-formed.')
+        numbers = [part_number for (part_number, etag) in parts]
+        if numbers != sorted(set(numbers)):
+            raise FakeS3Error(400, 'InvalidPartOrder',
+                              'The list of parts was not in ascending order.')
+        chunks = []
+        digests = []
+        for (part_number, etag) in parts:
+            part = upload.parts.get(part_number)
+            if part is None or part[1] != etag:
+                raise FakeS3Error(400, 'InvalidPart',
+                                  'One or more of the specified parts could '
+                                  'not be found.')
+            chunks.append(part[0])
+            digests.append(md5(part[0]).digest())
+        del self.uploads[upload_id]
+        etag = '"%s-%d"' % (md5(''.join(digests)).hexdigest(), len(parts))
+        objects = self.buckets.setdefault(bucket, {})
+        objects[object_name] = (''.join(chunks), etag)
+        return etag
+
+    def abort(self, bucket, object_name, upload_id):
+        """
+        Abort an upload, dropping its parts.
+        """
+        self._upload(upload_id, bucket, object_name)
+        del self.uploads[upload_id]
+
+    def put(self, bucket, object_name, data):
+        """
+        Store an object, returning its ETag.
+        """
+        etag = _etag(data)
+        self.buckets.setdefault(bucket, {})[object_name] = (data, etag)
+        return etag
+
+    def get(self, bucket, object_name):
+        """
+        Return the (data, etag) of an object.
+        """
+        try:
+            return self.buckets[bucket][object_name]
+        except KeyError:
+            raise FakeS3Error(404, 'NoSuchKey',
+                              'The specified key does not exist.')
+
+    def delete(self, bucket, object_name):
+        """
+        Delete an object, if it exists.
+        """
+        self.buckets.get(bucket, {}).pop(object_name, None)
+
+
+class Faults(object):
+    """
+    Delays and failures injected into the responses of a
+    L{FakeS3Resource}.
+
+    Each request is delayed by C{latency} plus the time its request and
+    response bodies take at C{bandwidth}, or at C{bandwidth} divided by
+    C{slow_factor} for the requests (a C{slow_rate} fraction of them)
+    given a slow connection. With a C{total_bandwidth}, transfers also
+    queue for a link shared by all requests.
+
+    A C{error_rate} fraction of requests fail with a 500 InternalError, a
+    C{throttle_rate} fraction with a 503 SlowDown and a C{reset_rate}
+    fraction have their connection reset without a response.
+
+    @param latency: Seconds each request is delayed by
+    @param bandwidth: Bytes per second of each request, or None for no
+        limit
+    @param total_bandwidth: Bytes per second of all requests, or None for
+        no limit
+    @param error_rate: Fraction of requests failing with a 500
+    @param throttle_rate: Fraction of requests failing with a 503
+    @param reset_rate: Fraction of requests whose connection is reset
+    @param slow_rate: Fraction of requests given a slow connection
+    @param slow_factor: How many times slower slow connections are
+    @ivar injected: C{dict} of fault (C{'error'}, C{'throttle'},
+        C{'reset'} or C{'slow'}) to the number of requests it was injected
+        into
+    """
+
+    random = random.random
+
+    def __init__(self, latency=0, bandwidth=None, total_bandwidth=None,
+                 error_rate=0, throttle_rate=0, reset_rate=0, slow_rate=0,
+                 slow_factor=10):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.total_bandwidth = total_bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.reset_rate = reset_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.injected = {}
+        self._link_free = 0
+
+    def _inject(self, fault):
+        self.injected[fault] = self.injected.get(fault, 0) + 1
+        return fault
+
+    def failure(self):
+        """
+        Choose the failure of a request: C{'error'}, C{'throttle'},
+        C{'reset'} or None.
+        """
+        r = self.random()
+        for (fault, rate) in [('error', self.error_rate),
+                              ('throttle', self.throttle_rate),
+                              ('reset', self.reset_rate)]:
+            if r < rate:
+                return self._inject(fault)
+            r -= rate
+        return None
+
+    def delay(self, now, size):
+        """
+        Return the seconds a request transferring C{size} bytes at time
+        C{now} is delayed by.
+        """
+        transfer = 0
+        if self.bandwidth is not None:
+            transfer = size / float(self.bandwidth)
+        if self.slow_rate and self.random() < self.slow_rate:
+            self._inject('slow')
+            transfer *= self.slow_factor
+        if self.total_bandwidth is not None:
+            self._link_free = max(now, self._link_free) + \
+                size / float(self.total_bandwidth)
+            transfer = max(transfer, self._link_free - now)
+        return self.latency + transfer
+
+
+class FakeS3Resource(Resource):
+    """
+    Resource serving a L{FakeS3} with S3's REST API.
+
+    @param s3: The L{FakeS3}
+    @param faults: The L{Faults} injected. default: none
+    @param clock: The clock responses are delayed with (default: the
+        reactor)
+    @ivar requests: Number of requests received
+    """
+    isLeaf = True
+    requests = 0
+
+    def __init__(self, s3, faults=None, clock=None):
+        Resource.__init__(self)
+        if faults is None:
+            faults = Faults()
+        if clock is None:
+            clock = reactor
+        self.s3 = s3
+        self.faults = faults
+        self.clock = clock
+
+    def render(self, request):
+        self.requests += 1
+        body = request.content.read()
+        failure = self.faults.failure()
+        if failure == 'error':
+            response = self._error(request, FakeS3Error(500, 'InternalError',
+                'We encountered an internal error. Please try again.'))
+        elif failure == 'throttle':
+            response = self._error(request, FakeS3Error(503, 'SlowDown',
+                'Please reduce your request rate.'))
+        elif failure == 'reset':
+            response = None
+        else:
+            try:
+                response = self._handle(request, body)
+            except FakeS3Error as e:
+                response = self._error(request, e)
+        size = len(body)
+        if response is not None:
+            size += len(response)
+        delay = self.faults.delay(self.clock.seconds(), size)
+        call = self.clock.callLater(delay, self._respond, request, response)
+        request.notifyFinish().addErrback(self._gone, call)
+        return NOT_DONE_YET
+
+    def _respond(self, request, response):
+        if response is None:
+            transport = request.transport
+            getattr(transport, 'abortConnection', transport.loseConnection)()
+            return
+        request.setHeader('content-length', str(len(response)))
+        request.write(response)
+        request.finish()
+
+    def _gone(self, why, call):
+        if call.active():
+            call.cancel()
+
+    def _error(self, request, error):
+        request.setResponseCode(error.status)
+        request.setHeader('content-type', 'application/xml')
+        return error.render()
+
+    def _handle(self, request, body):
+        if len(request.postpath) < 2 or not request.postpath[1]:
+            raise FakeS3Error(501, 'NotImplemented',
+                              'Only object requests are supported.')
+        bucket = request.postpath[0]
+        object_name = '/'.join(request.postpath[1:])
+        # request.args drops subresources without a value, like ?uploads.
+        args = {}
+        if '?' in request.uri:
+            args = parse_qs(request.uri.split('?', 1)[1],
+                            keep_blank_values=True)
+        upload_id = args.get('uploadId', [None])[0]
+        method = request.method
+        if method == 'POST' and 'uploads' in args:
+            return self._initiate(request, bucket, object_name)
+        if upload_id is not None:
+            if method == 'PUT' and 'partNumber' in args:
+                return self._upload_part(request, bucket, object_name,
+                                         upload_id, args['partNumber'][0],
+                                         body)
+            if method == 'POST':
+                return self._complete(request, bucket, object_name, upload_id,
+                                      body)
+            if method == 'DELETE':
+                self.s3.abort(bucket, object_name, upload_id)
+                request.setResponseCode(204)
+                return ''
+            if method == 'GET':
+                return self._list_parts(request, bucket, object_name,
+                                        upload_id)
+        elif method == 'PUT':
+            request.setHeader('etag', self.s3.put(bucket, object_name, body))
+            return ''
+        elif method == 'GET':
+            return self._get(request, bucket, object_name)
+        elif method == 'DELETE':
+            self.s3.delete(bucket, object_name)
+            request.setResponseCode(204)
+            return ''
+        raise FakeS3Error(405, 'MethodNotAllowed',
+                          'The specified method is not allowed.')
+
+    def _initiate(self, request, bucket, object_name):
+        upload_id = self.s3.initiate(bucket, object_name)
+        return _xml('InitiateMultipartUploadResult', ('Bucket', bucket),
+                    ('Key', object_name), ('UploadId', upload_id))
+
+    def _upload_part(self, request, bucket, object_name, upload_id,
+                     part_number, body):
+        try:
+            part_number = int(part_number)
+        except ValueError:
+            raise FakeS3Error(400, 'InvalidArgument',
+                              'Part number must be an integer.')
+        etag = self.s3.upload_part(bucket, object_name, upload_id,
+                                   part_number, body)
+        request.setHeader('etag', etag)
+        return ''
+
+    def _complete(self, request, bucket, object_name, upload_id, body):
+        try:
+            root = XML(body)
+            parts = [(int(part.findtext('PartNumber')),
+                      part.findtext('ETag').strip())
+                     for part in root.findall('Part')]
+        except Exception:
+            raise FakeS3Error(400, 'MalformedXML',
+                              'The XML you provided was not well-formed.')
+        etag = self.s3.complete(bucket, object_name, upload_id, parts)
+        return _xml('CompleteMultipartUploadResult',
+                    ('Location', request.uri), ('Bucket', bucket),
+                    ('Key', object_name), ('ETag', etag))
+
+    def _list_parts(self, request, bucket, object_name, upload_id):
+        parts = self.s3.list_parts(bucket, object_name, upload_id)
+        return _xml('ListPartsResult', ('Bucket', bucket),
+                    ('Key', object_name), ('UploadId', upload_id),
+                    ('IsTruncated', 'false'),
+                    *[('Part', [('PartNumber', part_number), ('ETag', etag),
+                                ('Size', size)])
+                      for (part_number, etag, size) in parts])
+
+    def _get(self, request, bucket, object_name):
+        (data, etag) = self.s3.get(bucket, object_name)
+        request.setHeader('etag', etag)
+        header = request.getHeader('range')
+        if header is None:
+            return data
+        (start, end) = self._range(header, len(data))
+        request.setResponseCode(206)
+        request.setHeader('content-range', 'bytes %d-%d/%d' % (
+                          start, end, len(data)))
+        return data[start:end + 1]
+
+    def _range(self, header, size):
+        """
+        Return the first and last byte of the single range of a C{Range}
+        header.
+        """
+        try:
+            (unit, spec) = header.split('=', 1)
+            (first, last) = spec.strip().split('-', 1)
+            if unit.strip() != 'bytes':
+                raise ValueError(unit)
+            if not first:
+                start = max(size - int(last), 0)
+                end = size - 1
+            else:
+                start = int(first)
+                end = size - 1
+                if last:
+                    end = min(int(last), size - 1)
+        except ValueError:
+            start = end = size
+        if start > end or start >= size:
+            raise FakeS3Error(416, 'InvalidRange',
+                              'The requested range is not satisfiable.')
+        return (start, end)
@@ -0,0 +1,181 @@
+"""
+Hedged part uploads.
+
+A multipart upload finishes only when its slowest part does. A
+L{HedgingPartHandler} keeps the distribution of part upload durations of
+its upload and, when a part runs past a deadline taken from that
+distribution, uploads the part a second time. Whichever upload answers
+first wins and the other is cancelled.
+"""
+from bisect import insort, bisect_left
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+from bafload.interfaces import IPartHandler
+from bafload.common import ProgressLoggerMixin
+from bafload.throttle import PassThruThrottler
+
+
+__all__ = ['HedgingPartHandler']
+
+
+def _forward(name):
+    """
+    Return a property forwarding attribute C{name} to the wrapped part
+    handler.
+    """
+    def get(self):
+        return getattr(self.part_handler, name)
+
+    def set(self, value):
+        setattr(self.part_handler, name, value)
+
+    return property(get, set)
+
+
+class HedgingPartHandler(ProgressLoggerMixin):
+    """
+    Part handler which has C{part_handler} upload parts and hedges those
+    running late. A part is late once it has run longer than C{factor}
+    times the C{percentile} of the durations of the last C{window} parts
+    uploaded; no part is hedged until C{min_samples} parts have been
+    uploaded. Each part is hedged at most once.
+
+    The second upload of a part is made through C{throttler}, like the
+    first, and sends a C{copy()} of the part if it has one, as
+    L{bafload.producers.FileRangeBodyProducer}s do. Other parts, such as
+    in-memory buffers, must be safe to upload twice at once.
+
+    A handler keeps the durations of the parts it uploads, so each upload
+    should have its own.
+
+    @param part_handler: The L{IPartHandler} to upload parts with.
+    @param percentile: Percentile (between 0 and 1) of part durations
+        after which a part is hedged.
+    @param factor: Multiplier of the percentile duration.
+    @param min_samples: Number of parts uploaded before any are hedged.
+    @param window: Number of most recent part durations kept.
+    @param clock: L{twisted.internet.interfaces.IReactorTime} provider.
+        default: the global reactor
+    @param log: An L{ILog} provider. default: L{twisted.python.log}
+    """
+    implements(IPartHandler)
+
+    bucket = _forward('bucket')
+    object_name = _forward('object_name')
+    upload_id = _forward('upload_id')
+    client = _forward('client')
+
+    throttler = PassThruThrottler()
+
+    def __init__(self, part_handler, percentile=0.95, factor=1.0,
+                 min_samples=5, window=1000, clock=None, log=None):
+        if clock is None:
+            clock = reactor
+        self.part_handler = part_handler
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.clock = clock
+        self.durations = []
+        self._recent = deque(maxlen=window)
+        self.hedged = 0
+        self.set_log(log)
+
+    def deadline(self):
+        """
+        Return the number of seconds after which a part is hedged, or None
+        if too few parts have been uploaded to tell.
+        """
+        if len(self.durations) < self.min_samples:
+            return None
+        index = int(round(self.percentile * (len(self.durations) - 1)))
+        return self.durations[index] * self.factor
+
+    def handle_part(self, part, part_number):
+        return _HedgedPart(self, part, part_number).start()
+
+    def _record(self, duration):
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            del self.durations[bisect_left(self.durations, oldest)]
+        self._recent.append(duration)
+        insort(self.durations, duration)
+
+
+class _HedgedPart(object):
+    """
+    The uploads of one part by a L{HedgingPartHandler}.
+    """
+
+    timer = None
+    won = False
+
+    def __init__(self, handler, part, part_number):
+        self.handler = handler
+        self.part = part
+        self.part_number = part_number
+        self.attempts = []
+        self.result = Deferred(self._cancel)
+
+    def start(self):
+        self._attempt(self.handler.part_handler.handle_part, part=self.part,
+                      part_number=self.part_number)
+        deadline = self.handler.deadline()
+        if deadline is not None:
+            self.timer = self.handler.clock.callLater(deadline, self._hedge)
+        return self.result
+
+    def _attempt(self, f, *args, **kwargs):
+        started = self.handler.clock.seconds()
+        d = maybeDeferred(f, *args, **kwargs)
+        self.attempts.append(d)
+        d.addBoth(self._finished, d, started)
+
+    def _hedge(self):
+        self.timer = None
+        self.handler.hedged += 1
+        self.handler.log.msg('Part %d of %s running late, hedging' % (
+                             self.part_number, self.handler.object_name))
+        part = self.part
+        if hasattr(part, 'copy'):
+            part = part.copy()
+        self._attempt(self.handler.throttler.throttle,
+                      self.handler.part_handler.handle_part, part=part,
+                      part_number=self.part_number)
+
+    def _finished(self, result, d, started):
+        self.attempts.remove(d)
+        if self.won or self.result.called:
+            # Lost the race (or cancelled).
+            return None
+        if isinstance(result, Failure):
+            if self.attempts:
+                # The other upload may still succeed.
+                return None
+            self._stop_timer()
+            self.result.errback(result)
+            return None
+        self.handler._record(self.handler.clock.seconds() - started)
+        self._stop_timer()
+        # Cancel the other upload first, so a throttler freed by the result
+        # doesn't start it, if it is still waiting.
+        self.won = True
+        for other in list(self.attempts):
+            other.cancel()
+        self.result.callback(result)
+
+    def _stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _cancel(self, result):
+        self._stop_timer()
+        for attempt in list(self.attempts):
+            attempt.cancel()
@@ -31,15 +31,37 @@ class IProgressLogger(Interface):
         """
 
 
+class ITracer(Interface):
+    """
+    A receiver of timed events, such as the calls made by an upload.
+    """
+
+    def event(name, start, duration, **tags):
+        """
+        Record event C{name} which started at time C{start} and lasted
+        C{duration} seconds.
+
+        @param tags: Attributes of the event. Events of uploads are tagged
+            with C{bucket}, C{key} and C{upload_id}; events of calls also
+            with C{attempt} (starting at 1), C{queued} (seconds the call
+            waited in the throttler) and, if the call failed, C{error}; and
+            events of parts also with C{part_number} and C{bytes}.
+        """
+
+
 class ITransmissionCounter(IProgressLogger):
 
     completed = Attribute("Number of parts/chunks transfered (starts at 0)")
     receiving = Attribute("If True, we're receiving data, otherwise we're "
                           "sending")
+    expected_bytes = Attribute("Number of bytes expected in total, or None "
+                               "if unknown")
 
-    def increment_count():
+    def increment_count(size=0):
         """
         Count a part as completed, incrementing completed count.
+
+        @param size: Number of bytes in the part
         """
 
 
@@ -69,6 +91,20 @@ class IPartsGenerator(IProgressLogger):
         """
 
 
+class IPartSizePolicy(Interface):
+    """
+    A policy for choosing the part size to upload an object with.
+    """
+
+    def part_size_for(fd):
+        """
+        Return the part size in bytes to use for uploading the file-like
+        object C{fd}.
+
+        @param fd: file-like object parts will be read from
+        """
+
+
 class IPartHandler(IProgressLogger):
     """
     Part Handler receives parts and sequences number and uploads
@@ -96,7 +132,8 @@ class IMultipartUploadsManager(IProgressLogger):
     """
 
     def upload(fd, bucket, object_name, content_type=None, metadata={},
-               parts_generator=None, part_handler=None):
+               parts_generator=None, part_handler=None,
+               part_size_policy=None):
         """
         @param fd: A file-like object to read parts from
         @param bucket: The bucket name
@@ -107,6 +144,15 @@ class IMultipartUploadsManager(IProgressLogger):
             specified this method should use some default provider)
         @param part_handler: provider of L{IPartHandler} (if not specified,
             this method should use some default provider)
+        @param part_size_policy: provider of L{IPartSizePolicy} used to set
+            the part size of C{parts_generator}
+        """
+
+    def cancel(task):
+        """
+        Cancel an upload in progress.
+
+        @param task: The upload task to cancel
         """
 
 
@@ -150,6 +196,23 @@ class IThrottler(Interface):
         """
 
 
+class IFairThrottler(IThrottler):
+    """
+    An IThrottler which shares its calls fairly between queues, such as one
+    queue per upload, rather than in the order calls are made.
+    """
+
+    control_throttler = Attribute(
+        "IThrottler whose calls are made before those of any queue; for "
+        "control calls such as initiating and completing uploads.")
+
+    def queue(weight=1):
+        """
+        Return a new queue: an L{IThrottler} whose calls are given up to
+        C{weight} turns for every turn of a queue of weight 1.
+        """
+
+
 class IByteLength(Interface):
     """
     An integral byte count.
@@ -166,3 +229,10 @@ class IStringIO(Interface):
     """
     Stub interface for StringIO objects.
     """
+
+
+class IBuffer(Interface):
+    """
+    Stub interface for in-memory byte buffers (str, bytearray, buffer and
+    memoryview objects).
+    """
@@ -0,0 +1,186 @@
+"""
+On-disk journals for resuming multipart uploads.
+
+A journal is an append-only file of JSON records, one per line: an C{init}
+record with the upload id and everything that must match for the upload to
+be resumed (bucket, key, file identity and part size) followed by a
+C{part} record for each part as it is uploaded. A journal is removed once
+its upload completes.
+"""
+import json
+import os
+from hashlib import sha1
+
+from bafload.interfaces import IByteLength, IFile
+
+
+__all__ = ['file_identity', 'UploadJournal', 'JournalDirectory']
+
+
+def file_identity(fd):
+    """
+    Return a C{dict} identifying the contents of file-like object C{fd}:
+    its size and, for files, its path, device, inode and modification time.
+    """
+    try:
+        identity = {'size': IByteLength(fd)}
+    except TypeError:
+        identity = {'size': None}
+    if IFile.providedBy(fd):
+        st = os.fstat(fd.fileno())
+        identity.update(name=os.path.abspath(fd.name), device=st.st_dev,
+                        inode=st.st_ino, mtime=st.st_mtime)
+    return identity
+
+
+class UploadJournal(object):
+    """
+    The journal for uploading one file to one key.
+
+    @param path: Path of the journal file
+    @param identity: C{dict} which must match the journal's C{init} record
+        for the upload to be resumed.
+    @param sync: If True, fsync after appending each record.
+    """
+
+    upload_id = None
+    part_size = None
+
+    def __init__(self, path, identity, sync=True):
+        self.path = path
+        self.identity = identity
+        self.sync = sync
+        self.parts = {}
+        self._fd = None
+
+    def load(self):
+        """
+        Load the journal from disk, returning True if it records an upload
+        which can be resumed; upload_id, part_size and parts (a C{dict} of
+        part number to ETag) are then set from the journal.
+        """
+        self.upload_id = None
+        self.parts = {}
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as fd:
+            data = fd.read()
+        records = []
+        valid = 0
+        for line in data.splitlines(True):
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('Incomplete record')
+                records.append(json.loads(line))
+            except ValueError:
+                # A crash mid-append can leave a torn last record; drop it
+                # so later records aren't appended to it.
+                self._truncate(valid)
+                break
+            valid += len(line)
+        if not records:
+            return False
+        init = records[0]
+        if init.get('type') != 'init' or init['identity'] != self.identity:
+            return False
+        self.upload_id = str(init['upload_id'])
+        self.part_size = init['part_size']
+        for record in records[1:]:
+            if record.get('type') == 'part':
+                self.parts[record['part_number']] = str(record['etag'])
+        return True
+
+    def _truncate(self, size):
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(size)
+
+    def start(self, upload_id, part_size):
+        """
+        Start a new journal (replacing any existing one) for upload
+        C{upload_id} with parts of C{part_size} bytes.
+        """
+        self.close()
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.parts = {}
+        self._fd = open(self.path, 'wb')
+        self._append(self._init_record())
+
+    def replace_parts(self, parts):
+        """
+        Rewrite the journal of the upload to record C{parts} (a C{dict} of
+        part number to ETag), such as the parts S3 lists for it, instead of
+        the parts recorded so far. The journal is replaced atomically.
+        """
+        self.close()
+        path = self.path + '.tmp'
+        self._fd = open(path, 'wb')
+        self._append(self._init_record())
+        for (part_number, etag) in sorted(parts.items()):
+            self._append({'type': 'part', 'part_number': part_number,
+                          'etag': etag})
+        self.close()
+        os.rename(path, self.path)
+        self.parts = dict(parts)
+
+    def _init_record(self):
+        return {'type': 'init', 'identity': self.identity,
+                'upload_id': self.upload_id, 'part_size': self.part_size}
+
+    def record_part(self, part_number, etag):
+        """
+        Record that part C{part_number} was uploaded with ETag C{etag}.
+        """
+        self.parts[part_number] = etag
+        if self._fd is None:
+            self._fd = open(self.path, 'ab')
+        self._append({'type': 'part', 'part_number': part_number,
+                      'etag': etag})
+
+    def finish(self):
+        """
+        Remove the journal of a completed upload.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def _append(self, record):
+        self._fd.write(json.dumps(record, sort_keys=True) + '\n')
+        self._fd.flush()
+        if self.sync:
+            os.fsync(self._fd.fileno())
+
+
+class JournalDirectory(object):
+    """
+    A directory of L{UploadJournal}s, one per bucket, key and file.
+
+    @param path: Path of the directory (created if it does not exist)
+    @param sync: If True, journals fsync after appending each record.
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def journal_for(self, fd, bucket, object_name):
+        """
+        Return the L{UploadJournal} for uploading C{fd} to C{bucket} as
+        C{object_name}.
+        """
+        identity = file_identity(fd)
+        identity.update(bucket=bucket, object_name=object_name)
+        key = '\0'.join([bucket, object_name, identity.get('name', '')])
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        name = '%s.journal' % sha1(key).hexdigest()
+        return UploadJournal(os.path.join(self.path, name), identity,
+                             self.sync)
@@ -0,0 +1,183 @@
+"""
+Live metrics of a L{bafload.up.MultipartUploadsManager} for Prometheus.
+
+A L{MetricsResource} renders the manager's counters in the Prometheus text
+exposition format: throughput over sliding windows (from its
+L{bafload.stats.ThroughputCounter}), active uploads and bytes in flight,
+calls running and waiting in its throttlers, hits and misses of its
+connection pool and, from its L{bafload.stats.LatencyStats}, call latency
+percentiles, retries and failures. Serve it locally with, for example::
+
+    site = Site(MetricsResource(manager))
+    reactor.listenTCP(9090, site, interface='127.0.0.1')
+"""
+from twisted.internet import task
+from twisted.internet.task import TaskStopped
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from bafload.up import MultipartUpload
+
+
+__all__ = ['MetricsResource']
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+                             '\\', r'\\').replace('"', r'\"'))
+                             for (name, value) in labels)
+
+
+def _value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value))
+
+
+class _Family(object):
+    """
+    The lines of one metric family.
+    """
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.lines = ['# HELP %s %s' % (name, help),
+                      '# TYPE %s %s' % (name, kind)]
+
+    def add(self, value, labels=(), suffix=''):
+        self.lines.append('%s%s%s %s' % (self.name, suffix, _labels(labels),
+                                         _value(value)))
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsResource(Resource):
+    """
+    Resource rendering the metrics of C{manager}. The metrics are written
+    one family at a time from a cooperative task, so scrapes don't hold
+    up the reactor however many uploads are active.
+
+    @param manager: The L{bafload.up.MultipartUploadsManager}
+    @param windows: Lengths in seconds of the windows throughput is
+        averaged over
+    @param quantiles: Quantiles (between 0 and 1) of latencies exposed
+    """
+    isLeaf = True
+
+    cooperator = task
+
+    def __init__(self, manager, windows=(10, 60, 300),
+                 quantiles=(0.5, 0.9, 0.99)):
+        Resource.__init__(self)
+        self.manager = manager
+        self.windows = windows
+        self.quantiles = sorted(quantiles)
+
+    def render_GET(self, request):
+        request.setHeader('content-type', CONTENT_TYPE)
+        work = self.cooperator.cooperate(self._write(request))
+        request.notifyFinish().addErrback(self._stop, work)
+        d = work.whenDone()
+        d.addCallbacks(self._finish, self._stopped, callbackArgs=(request,))
+        return NOT_DONE_YET
+
+    def _write(self, request):
+        for family in self.families():
+            request.write(family.render())
+            yield None
+
+    def _finish(self, ignore, request):
+        request.finish()
+
+    def _stop(self, why, work):
+        # The client went away before the metrics were written.
+        work.stop()
+
+    def _stopped(self, why):
+        why.trap(TaskStopped)
+
+    def families(self):
+        """
+        Generate the metric families, each computed only as it's needed.
+        """
+        manager = self.manager
+        family = _Family('bafload_uploads_active', 'gauge',
+                         'Uploads in progress.')
+        family.add(len(manager.uploads))
+        yield family
+        family = _Family('bafload_bytes_in_flight', 'gauge',
+                         'Bytes of parts generated but not yet uploaded.')
+        family.add(manager.bytes_in_flight)
+        yield family
+        if manager.throughput_counter is not None:
+            yield self._throughput(manager.throughput_counter)
+        for family in self._throttlers(manager.throttler):
+            yield family
+        if manager.clients is not None:
+            for family in self._pool(manager.clients.connections):
+                yield family
+        if manager.latencies is not None:
+            for family in self._latencies(manager.latencies):
+                yield family
+
+    def _throughput(self, counter):
+        family = _Family('bafload_throughput_bytes_per_second', 'gauge',
+                         'Bytes uploaded per second over sliding windows.')
+        for window in self.windows:
+            family.add(counter.rate(window), [('window', '%ss' % window)])
+        return family
+
+    def _throttlers(self, throttler):
+        if throttler is None:
+            throttler = MultipartUpload.throttler
+        running = _Family('bafload_throttler_running', 'gauge',
+                          'Calls a throttler is running.')
+        waiting = _Family('bafload_throttler_waiting', 'gauge',
+                          'Calls waiting in the backlog of a throttler.')
+        # Follow throttlers wrapping others, such as ByteRateThrottler.
+        while throttler is not None:
+            labels = [('throttler', throttler.__class__.__name__)]
+            count = getattr(throttler, 'running', None)
+            if count is not None:
+                running.add(count, labels)
+            count = getattr(throttler, 'waiting', None)
+            if count is not None:
+                waiting.add(count, labels)
+            throttler = getattr(throttler, 'throttler', None)
+        return [running, waiting]
+
+    def _pool(self, connections):
+        hits = _Family('bafload_connection_pool_hits_total', 'counter',
+                       'Requests made on a cached connection.')
+        hits.add(connections.hits)
+        misses = _Family('bafload_connection_pool_misses_total', 'counter',
+                         'Requests which opened a new connection.')
+        misses.add(connections.misses)
+        return [hits, misses]
+
+    def _latencies(self, latencies):
+        family = _Family('bafload_latency_seconds', 'summary',
+                         'Latencies of upload phases.')
+        for phase in latencies.phases():
+            histogram = latencies.histogram(phase)
+            values = histogram.percentiles(self.quantiles)
+            for (quantile, value) in zip(self.quantiles, values):
+                family.add(value, [('phase', phase), ('quantile', quantile)])
+            family.add(histogram.total, [('phase', phase)], '_sum')
+            family.add(histogram.count, [('phase', phase)], '_count')
+        yield family
+        for (name, counts, help) in [
+                ('bafload_retries_total', latencies.retries,
+                 'Calls which were retries.'),
+                ('bafload_failures_total', latencies.failures,
+                 'Calls which failed.')]:
+            family = _Family(name, 'counter', help)
+            for phase in sorted(counts):
+                family.add(counts[phase], [('phase', phase)])
+            yield family
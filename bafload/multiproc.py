@@ -0,0 +1,245 @@
+"""
+Uploading parts in worker processes.
+
+A L{WorkerPool} runs worker processes (see L{bafload.scripts.partworker})
+which each have their own reactor and S3 client. The parent process sends
+each worker the location of a part (path, offset and length) over an AMP
+connection on the worker's stdin/stdout; the worker reads the range from
+disk, uploads it and answers with the ETag. Encryption and request signing
+for a single upload are then spread over as many cores as there are
+workers.
+"""
+import multiprocessing
+import os
+import sys
+
+from zope.interface import implements
+
+from twisted.internet import reactor as _reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols import amp
+
+from bafload.interfaces import IPartHandler
+from bafload.common import ProgressLoggerMixin
+
+
+__all__ = ['UploadPart', 'PartUploaderWorker', 'WorkerPool',
+           'MultiProcessPartUploader']
+
+
+class UploadPart(amp.Command):
+    """
+    Upload the C{length} bytes at C{offset} in the file at C{path} as part
+    C{part_number} of a multipart upload.
+    """
+    arguments = [('path', amp.String()),
+                 ('offset', amp.Integer()),
+                 ('length', amp.Integer()),
+                 ('bucket', amp.String()),
+                 ('object_name', amp.String()),
+                 ('upload_id', amp.String()),
+                 ('part_number', amp.Integer())]
+    response = [('etag', amp.String())]
+
+
+class PartUploaderWorker(amp.AMP):
+    """
+    The worker side of L{UploadPart}: read the part from disk and upload it
+    with C{client}.
+
+    @param client: L{txaws.s3.client.S3Client}
+    @param on_disconnect: Callable called with no arguments when the
+        connection to the parent process is lost.
+    """
+
+    def __init__(self, client, on_disconnect=None):
+        amp.AMP.__init__(self)
+        self.client = client
+        self.on_disconnect = on_disconnect
+
+    @UploadPart.responder
+    def upload_part(self, path, offset, length, bucket, object_name,
+                    upload_id, part_number):
+        fd = open(path, 'rb')
+        try:
+            fd.seek(offset)
+            data = fd.read(length)
+        finally:
+            fd.close()
+        d = self.client.upload_part(bucket, object_name, upload_id,
+                                    part_number, data)
+        d.addCallback(lambda headers: {'etag': headers['ETag']})
+        return d
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+
+
+class _StdinTransport(object):
+    """
+    The parent's end of the AMP connection to a worker: data is written to
+    the worker's stdin.
+    """
+
+    def __init__(self, process):
+        self.process = process
+
+    def write(self, data):
+        self.process.write(data)
+
+    def writeSequence(self, data):
+        self.process.writeSequence(data)
+
+    def loseConnection(self):
+        self.process.closeStdin()
+
+    def getPeer(self):
+        return ('process', self.process.pid)
+
+    def getHost(self):
+        return ('process', None)
+
+
+class _WorkerProcessProtocol(ProcessProtocol):
+    """
+    Speak AMP with a worker process over its stdin and stdout.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.amp = amp.AMP()
+        self.pending = 0
+        self.ended = Deferred()
+
+    def connectionMade(self):
+        self.amp.makeConnection(_StdinTransport(self.transport))
+
+    def outReceived(self, data):
+        self.amp.dataReceived(data)
+
+    def errReceived(self, data):
+        self.pool.log.msg('[worker pid=%s] %s' % (self.transport.pid,
+                                                 data.rstrip()))
+
+    def processEnded(self, reason):
+        self.amp.connectionLost(reason)
+        self.pool._worker_ended(self)
+        self.ended.callback(None)
+
+    def callRemote(self, command, **kw):
+        self.pending += 1
+        d = self.amp.callRemote(command, **kw)
+        d.addBoth(self._finished_call)
+        return d
+
+    def _finished_call(self, passthru):
+        self.pending -= 1
+        return passthru
+
+
+class WorkerPool(ProgressLoggerMixin):
+    """
+    A pool of part uploading worker processes. Calls are dispatched to the
+    worker with the fewest calls outstanding. Workers which exit while the
+    pool is running are replaced.
+
+    @param region: L{txaws.service.AWSServiceRegion} whose credentials and
+        S3 endpoint the workers use.
+    @param size: Number of worker processes. default: number of CPUs
+    @param executable: The Python interpreter to run workers with.
+    @param reactor: The reactor to spawn workers with. default: the global
+        reactor
+    @param log: An L{ILog} provider. default: L{twisted.python.log}
+    """
+
+    worker_module = 'bafload.scripts.partworker'
+
+    def __init__(self, region, size=None, executable=None, reactor=None,
+                 log=None):
+        if reactor is None:
+            reactor = _reactor
+        if size is None:
+            size = multiprocessing.cpu_count()
+        if executable is None:
+            executable = sys.executable
+        self.region = region
+        self.size = size
+        self.executable = executable
+        self.reactor = reactor
+        self.workers = []
+        self.running = False
+        self.set_log(log)
+
+    def start(self):
+        self.running = True
+        while len(self.workers) < self.size:
+            self._spawn()
+
+    def stop(self):
+        """
+        Stop all workers, returning a L{Deferred} which fires when they have
+        exited.
+        """
+        self.running = False
+        ended = []
+        for worker in list(self.workers):
+            ended.append(worker.ended)
+            worker.transport.closeStdin()
+        return DeferredList(ended)
+
+    def _spawn(self):
+        creds = self.region.creds
+        env = dict(os.environ)
+        env['AWS_ACCESS_KEY_ID'] = creds.access_key
+        env['AWS_SECRET_ACCESS_KEY'] = creds.secret_key
+        worker = _WorkerProcessProtocol(self)
+        args = [self.executable, '-m', self.worker_module,
+                self.region.s3_endpoint.get_uri()]
+        self.reactor.spawnProcess(worker, self.executable, args, env=env)
+        self.workers.append(worker)
+        return worker
+
+    def _worker_ended(self, worker):
+        self.workers.remove(worker)
+        if self.running:
+            self.log.msg('Worker pid=%s exited, restarting' % (
+                         worker.transport.pid,))
+            self._spawn()
+
+    def callRemote(self, command, **kw):
+        worker = min(self.workers, key=lambda w: w.pending)
+        return worker.callRemote(command, **kw)
+
+
+class MultiProcessPartUploader(ProgressLoggerMixin):
+    """
+    Part handler which has a L{WorkerPool} upload parts. Parts must be file
+    ranges, such as the L{bafload.producers.FileRangeBodyProducer}s
+    generated by L{bafload.up.StreamingPartsGenerator}, of files with a
+    name: only the file name, offset and length are sent to workers.
+
+    @param pool: A started L{WorkerPool}
+    """
+    implements(IPartHandler)
+
+    bucket = None
+    object_name = None
+    upload_id = None
+    client = None
+
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def handle_part(self, part, part_number):
+        d = self.pool.callRemote(UploadPart, path=part.fd.name,
+            offset=part.offset, length=part.length, bucket=self.bucket,
+            object_name=self.object_name, upload_id=self.upload_id,
+            part_number=part_number)
+        d.addCallback(self._handle_response, part_number)
+        return d
+
+    def _handle_response(self, response, part_number):
+        return (part_number, response['etag'])
@@ -0,0 +1,186 @@
+"""
+Persistent connections for S3 clients.
+
+By default each S3 request opens its own connection, paying for a TCP (and
+TLS) handshake per part. A L{ClientPool} gives the clients it creates an
+agent sharing a L{MeteredConnectionPool} of keep-alive connections, so
+requests reuse connections left open by earlier ones, and can open
+connections ahead of the requests which will need them.
+"""
+from zope.interface import implements
+
+from twisted.internet import reactor as _reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.endpoints import TCP4ClientEndpoint, SSL4ClientEndpoint
+from twisted.python import log as twisted_log
+from twisted.web.client import (Agent, BrowserLikePolicyForHTTPS,
+        HTTPConnectionPool, URI)
+from twisted.web.error import SchemeNotSupported
+from twisted.web.iweb import IAgentEndpointFactory
+
+from bafload.client import get_s3_client
+
+
+__all__ = ['MeteredConnectionPool', 'DirectEndpointFactory', 'ClientPool']
+
+
+class MeteredConnectionPool(HTTPConnectionPool):
+    """
+    An L{HTTPConnectionPool} of persistent connections which counts
+    requests served by a cached connection (C{hits}) and by a new one
+    (C{misses}), and can open connections before they are needed with
+    L{warm}.
+    """
+
+    hits = 0
+    misses = 0
+    warmed = 0
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self._warming = {}
+
+    @property
+    def hit_ratio(self):
+        """
+        Fraction of requests served by a cached connection, or None if
+        there have been no requests.
+        """
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return float(self.hits) / total
+
+    def idle(self, key):
+        """
+        Number of cached connections for C{key} ready for a request.
+        """
+        return len([c for c in self._connections.get(key, ())
+                    if c.state == 'QUIESCENT'])
+
+    def getConnection(self, key, endpoint):
+        if self.idle(key):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def warm(self, key, endpoint, count):
+        """
+        Open connections for C{key} with C{endpoint} until C{count} (at
+        most C{maxPersistentPerHost}) are cached or being opened.
+
+        @return: L{Deferred} which fires once the connections are open (or
+            failed to open).
+        """
+        count = min(count, self.maxPersistentPerHost)
+        count -= self.idle(key) + self._warming.get(key, 0)
+        ds = []
+        for i in xrange(count):
+            self._warming[key] = self._warming.get(key, 0) + 1
+            d = self._newConnection(key, endpoint)
+            d.addCallbacks(self._warmed, self._warm_failed,
+                           callbackArgs=(key,))
+            d.addBoth(self._stop_warming, key)
+            ds.append(d)
+        return DeferredList(ds)
+
+    def _warmed(self, connection, key):
+        self.warmed += 1
+        self._putConnection(key, connection)
+
+    def _warm_failed(self, why):
+        twisted_log.msg('Failed opening connection: %s' %
+                        why.getErrorMessage())
+
+    def _stop_warming(self, ignore, key):
+        self._warming[key] -= 1
+        if not self._warming[key]:
+            del self._warming[key]
+
+
+class DirectEndpointFactory(object):
+    """
+    An L{IAgentEndpointFactory} connecting straight to the host of each URI,
+    over TLS checked like a browser would for C{https}, the way L{Agent}
+    does by default.
+
+    @param reactor: The reactor connections are made with
+    """
+    implements(IAgentEndpointFactory)
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.policy = BrowserLikePolicyForHTTPS()
+
+    def endpointForURI(self, uri):
+        if uri.scheme == 'http':
+            return TCP4ClientEndpoint(self.reactor, uri.host, uri.port)
+        elif uri.scheme == 'https':
+            return SSL4ClientEndpoint(
+                self.reactor, uri.host, uri.port,
+                self.policy.creatorForNetloc(uri.host, uri.port))
+        raise SchemeNotSupported('Unsupported scheme: %r' % (uri.scheme,))
+
+
+class ClientPool(object):
+    """
+    S3 clients for the endpoint of C{region} sharing up to C{size}
+    persistent connections. One client is created per bucket and reused.
+
+    @param region: A L{txaws.service.AWSServiceRegion}
+    @param size: Maximum number of idle connections kept open
+    @param endpoint_factory: An L{IAgentEndpointFactory} provider for the
+        agent's connections. default: a L{DirectEndpointFactory}
+    @param reactor: The reactor connections are made with. default: the
+        global reactor
+    """
+
+    def __init__(self, region, size=10, endpoint_factory=None, reactor=None):
+        if reactor is None:
+            reactor = _reactor
+        self.region = region
+        self.connections = MeteredConnectionPool(reactor)
+        self.connections.maxPersistentPerHost = size
+        if endpoint_factory is None:
+            endpoint_factory = DirectEndpointFactory(reactor)
+        self.endpoint_factory = endpoint_factory
+        self.agent = Agent.usingEndpointFactory(reactor, endpoint_factory,
+                                                pool=self.connections)
+        self._clients = {}
+
+    @property
+    def size(self):
+        return self.connections.maxPersistentPerHost
+
+    def client_for(self, bucket):
+        """
+        Return the S3 client for C{bucket}.
+        """
+        client = self._clients.get(bucket)
+        if client is None:
+            client = self._clients[bucket] = get_s3_client(self.region,
+                                                           self.agent)
+        return client
+
+    def warm(self, count=None):
+        """
+        Open connections to the S3 endpoint until C{count} (default: the
+        pool size) are ready for requests.
+
+        @return: L{Deferred} which fires once the connections are open.
+        """
+        if count is None:
+            count = self.size
+        uri = URI.fromBytes(self.region.s3_endpoint.get_uri())
+        key = (uri.scheme, uri.host, uri.port)
+        # Agent keeps connections under the same key, and connects with
+        # the same endpoint factory.
+        endpoint = self.endpoint_factory.endpointForURI(uri)
+        return self.connections.warm(key, endpoint, count)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        return self.connections.closeCachedConnections()
@@ -0,0 +1,88 @@
+"""
+Body producers for streaming parts from disk.
+"""
+from zope.interface import implements
+
+from twisted.internet import task
+from twisted.web.iweb import IBodyProducer
+
+
+__all__ = ['FileRangeBodyProducer']
+
+
+class FileRangeBodyProducer(object):
+    """
+    An L{IBodyProducer} which writes the C{length} bytes at C{offset} of a
+    file-like object to its consumer, C{read_size} bytes at a time, pausing
+    when the consumer (the HTTP transport) applies backpressure.
+
+    The producer keeps no data of its own and every call to
+    L{startProducing} reads the range from the file again, so it can be
+    handed to a retried request as-is. It produces for one consumer at a
+    time, though; a request sending the range while another still is needs
+    a L{copy}. Several producers may share one file object since each read
+    seeks to its own position first.
+
+    @param fd: file-like object to read the range from
+    @param offset: Offset of the first byte of the range
+    @param length: Length in bytes of the range
+    @param cooperator: L{twisted.internet.task.Cooperator} (or the
+        L{twisted.internet.task} module) used to schedule reads.
+    @param read_size: Maximum number of bytes read and written at once.
+    """
+    implements(IBodyProducer)
+
+    read_size = 0x10000
+
+    def __init__(self, fd, offset, length, cooperator=task, read_size=None):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.cooperator = cooperator
+        self._cooperate = cooperator.cooperate
+        if read_size is not None:
+            self.read_size = read_size
+        self._task = None
+
+    def copy(self):
+        """
+        Return a new producer of the same range of the same file.
+        """
+        return FileRangeBodyProducer(self.fd, self.offset, self.length,
+                                     self.cooperator, self.read_size)
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._write_range(consumer))
+        d = self._task.whenDone()
+
+        def finished(ignore):
+            self._task = None
+
+        d.addCallback(finished)
+        return d
+
+    def _write_range(self, consumer):
+        offset = self.offset
+        remaining = self.length
+        while remaining:
+            self.fd.seek(offset)
+            data = self.fd.read(min(remaining, self.read_size))
+            if not data:
+                raise IOError('Unexpected end of file at offset %d reading '
+                              '%d bytes from %d' % (offset, self.length,
+                                                    self.offset))
+            consumer.write(data)
+            offset += len(data)
+            remaining -= len(data)
+            yield None
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
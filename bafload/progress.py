@@ -0,0 +1,182 @@
+"""
+Aggregate progress of the uploads of a manager.
+
+L{BaseCounter} logs a line for every part of every upload. A
+L{ProgressReporter} instead hands out L{ProgressCounter}s (as a manager's
+C{counter_factory}) which only add their parts and bytes to the reporter's
+totals, and the reporter logs the progress of all uploads at most once
+every C{interval} seconds, with an exponentially weighted estimate of the
+upload rate and the time left::
+
+    reporter = ProgressReporter()
+    manager = MultipartUploadsManager(counter_factory=reporter.counter)
+"""
+import math
+
+from twisted.internet import reactor
+
+from bafload.common import BaseCounter, ProgressLoggerMixin
+
+
+__all__ = ['ProgressCounter', 'ProgressReporter']
+
+
+class ProgressCounter(BaseCounter):
+    """
+    Counter of one upload adding its parts and bytes to a
+    L{ProgressReporter} rather than logging them.
+
+    @param reporter: The L{ProgressReporter}
+    @param expected: Number of parts expected, or "?" if unknown
+    """
+    receiving = False
+    _expected_bytes = None
+
+    def __init__(self, reporter, expected):
+        BaseCounter.__init__(self, expected)
+        self.reporter = reporter
+        self._completed = 0
+        reporter.unsized += 1
+        if isinstance(expected, (int, long)):
+            reporter.expected_parts += expected
+
+    def _get_completed(self):
+        return self._completed
+
+    def _set_completed(self, completed):
+        # Parts uploaded before a resume count as done.
+        self.reporter.parts += completed - self._completed
+        self._completed = completed
+
+    completed = property(_get_completed, _set_completed)
+
+    def _get_expected_bytes(self):
+        return self._expected_bytes
+
+    def _set_expected_bytes(self, expected_bytes):
+        reporter = self.reporter
+        if self._expected_bytes is None:
+            reporter.unsized -= 1
+        else:
+            reporter.expected_bytes -= self._expected_bytes
+        if expected_bytes is None:
+            reporter.unsized += 1
+        else:
+            reporter.expected_bytes += expected_bytes
+        self._expected_bytes = expected_bytes
+
+    expected_bytes = property(_get_expected_bytes, _set_expected_bytes)
+
+    def increment_count(self, size=0):
+        self._completed += 1
+        self.bytes += size
+        self.reporter.count(size)
+
+
+class ProgressReporter(ProgressLoggerMixin):
+    """
+    Progress of all uploads of a manager, logged at most every C{interval}
+    seconds whatever the number of uploads and parts.
+
+    The rate is averaged over the time between parts completing, weighting
+    the rate of an interval of C{dt} seconds by C{1 - exp(-dt / smoothing)},
+    so older intervals decay with a time constant of C{smoothing} seconds.
+
+    @param interval: Minimum seconds between logged lines
+    @param smoothing: Time constant of the rate estimate in seconds
+    @param clock: The clock (default: the reactor)
+    @param log: An L{ILog} provider. default: L{twisted.python.log}
+
+    @ivar parts: Parts completed
+    @ivar expected_parts: Parts expected, counting uploads with a known
+        number of parts only
+    @ivar bytes: Bytes completed
+    @ivar expected_bytes: Bytes expected, counting uploads of a known size
+        only
+    @ivar unsized: Number of uploads of unknown size
+    @ivar rate: Estimated bytes per second, or None before any part
+        completes
+    """
+
+    parts = 0
+    expected_parts = 0
+    bytes = 0
+    expected_bytes = 0
+    unsized = 0
+    rate = None
+
+    def __init__(self, interval=1, smoothing=10, clock=None, log=None):
+        if clock is None:
+            clock = reactor
+        self.interval = interval
+        self.smoothing = float(smoothing)
+        self.clock = clock
+        self._updated = None
+        self._unrated = 0
+        self._logged = None
+        self.set_log(log)
+
+    def counter(self, expected):
+        """
+        Return a new L{ProgressCounter} for an upload of C{expected} parts.
+        Pass this method as the C{counter_factory} of a manager.
+        """
+        if self._updated is None:
+            self._updated = self.clock.seconds()
+        return ProgressCounter(self, expected)
+
+    def count(self, size):
+        """
+        Count a part of C{size} bytes as completed, logging progress if
+        C{interval} seconds passed since it was last logged.
+        """
+        self.parts += 1
+        self.bytes += size
+        self._unrated += size
+        now = self.clock.seconds()
+        self._update(now)
+        if self._logged is None or now - self._logged >= self.interval:
+            self.report()
+
+    def _update(self, now):
+        if self._updated is None:
+            self._updated = now
+        elapsed = now - self._updated
+        if elapsed <= 0:
+            # Parts completing at the same time are rated together.
+            return
+        rate = float(self._unrated) / elapsed
+        if self.rate is None:
+            self.rate = rate
+        else:
+            weight = 1 - math.exp(-elapsed / self.smoothing)
+            self.rate += weight * (rate - self.rate)
+        self._unrated = 0
+        self._updated = now
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until all bytes expected are uploaded, or None if
+        the size of some upload or the rate is unknown.
+        """
+        if self.unsized or not self.rate:
+            return None
+        return max(self.expected_bytes - self.bytes, 0) / self.rate
+
+    def report(self):
+        """
+        Log the progress now.
+        """
+        self._logged = self.clock.seconds()
+        mb = float(2 ** 20)
+        line = 'progress: parts %d/%d, %.1f/%s MB' % (self.parts,
+            self.expected_parts, self.bytes / mb,
+            ('%.1f' % (self.expected_bytes / mb), '?')[bool(self.unsized)])
+        if self.rate is not None:
+            line += ', %.2f MB/s' % (self.rate / mb,)
+        eta = self.eta
+        if eta is not None:
+            line += ', eta %d:%02d:%02d' % (eta // 3600, eta % 3600 // 60,
+                                            eta % 60)
+        self.log.msg(line)
@@ -2,17 +2,22 @@
 Retry alogorithms:
 
     BinaryExponentialBackoff
+    ClassifyingBackoff
 """
 import random
 
 from zope.interface import Interface, implements
 
 from twisted.python import log as twisted_log
-from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet import reactor, error
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.web.client import ResponseFailed, RequestTransmissionFailed
+from twisted.web.error import Error as WebError
 
 
-__all__ = ['IRetryDeferred', 'BinaryExponentialBackoff']
+__all__ = ['IRetryDeferred', 'BinaryExponentialBackoff', 'ClassifyingBackoff',
+           'is_retryable', 'retry_after', 'full_jitter', 'equal_jitter',
+           'decorrelated_jitter']
 
 
 class IRetryDeferred(Interface):
@@ -24,6 +29,35 @@ class IRetryDeferred(Interface):
         """
 
 
+class _Retrying(object):
+    """
+    A call being retried. Cancelling C{finished} cancels the attempt in
+    flight or the wait for the next one.
+    """
+
+    cancelled = False
+    attempt = None
+    delayed = None
+
+    def __init__(self):
+        self.finished = Deferred(self._cancel)
+
+    def call(self, f, a, kw):
+        self.delayed = None
+        self.attempt = f(*a, **kw)
+        return self.attempt
+
+    def later(self, clock, when, f, *a, **kw):
+        self.delayed = clock.callLater(when, f, *a, **kw)
+
+    def _cancel(self, finished):
+        self.cancelled = True
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        if self.attempt is not None:
+            self.attempt.cancel()
+
+
 class BinaryExponentialBackoff(object):
     implements(IRetryDeferred)
 
@@ -43,30 +77,190 @@ class BinaryExponentialBackoff(object):
         self.log = log
 
     def retry(self, f, *args, **kwargs):
-        finished = Deferred()
-        self._retry(None, finished, 0, f, args, kwargs)
-        return finished
+        retrying = _Retrying()
+        self._retry(None, retrying, 0, f, args, kwargs)
+        return retrying.finished
 
-    def _retry(self, why, finished, count, f, a, kw):
+    def _retry(self, why, retrying, count, f, a, kw):
+        if retrying.cancelled:
+            return
+        finished = retrying.finished
         count = min(count, self.max_slots)
         if count == self.max_slots and self.fail_on_truncate:
             finished.errback(why)
             return
 
         def retry():
-            d = f(*a, **kw)
+            d = retrying.call(f, a, kw)
             d.addCallback(finished.callback)
             if self.log_errors:
-                d.addErrback(self._log_error, f)
-            d.addErrback(self._retry, finished, count + 1, f, a, kw)
+                d.addErrback(self._log_error, f, retrying)
+            d.addErrback(self._retry, retrying, count + 1, f, a, kw)
 
         if count:
             when = self.slot_duration * ((2 ** count) - 1) * self.scatter()
-            self.clock.callLater(when, retry)
+            retrying.later(self.clock, when, retry)
         else:
             retry()
 
-    def _log_error(self, why, f):
-        self.log.msg('Error applying function=%s' % f)
-        self.log.err(why)
+    def _log_error(self, why, f, retrying):
+        if not retrying.cancelled:
+            self.log.msg('Error applying function=%s' % f)
+            self.log.err(why)
+        return why
+
+
+RETRYABLE_ERRORS = (
+    error.ConnectError, error.ConnectionLost, error.TimeoutError,
+    TimeoutError, ResponseFailed, RequestTransmissionFailed)
+
+RETRYABLE_STATUSES = frozenset([408, 429])
+
+RETRYABLE_ERROR_CODES = frozenset([
+    'RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException',
+    'RequestLimitExceeded', 'InternalError', 'ServiceUnavailable'])
+
+
+def is_retryable(why):
+    """
+    Return True if the failure C{why} is worth retrying: a server error
+    (5xx), throttling or request timeout response, or a timed out, refused
+    or reset connection. Any other failure, such as 403 Forbidden or a bad
+    digest, will fail again and is fatal.
+    """
+    if why.check(*RETRYABLE_ERRORS):
+        return True
+    if not why.check(WebError):
+        return False
+    try:
+        status = int(why.value.status)
+    except (TypeError, ValueError):
+        return False
+    if status >= 500 or status in RETRYABLE_STATUSES:
+        return True
+    get_error_codes = getattr(why.value, 'get_error_codes', None)
+    if get_error_codes is not None:
+        return get_error_codes() in RETRYABLE_ERROR_CODES
+    return False
+
+
+def retry_after(why):
+    """
+    Return the number of seconds the server asked us to wait before
+    retrying, or None. The hint is taken from a C{retry_after} attribute,
+    which L{bafload.client.S3Client} sets from the response's Retry-After
+    header, or a Retry-After header (in seconds) of the failure's
+    exception.
+    """
+    hint = getattr(why.value, 'retry_after', None)
+    if hint is None:
+        headers = getattr(why.value, 'headers', None)
+        if headers is None:
+            return None
+        if hasattr(headers, 'getRawHeaders'):
+            hint = (headers.getRawHeaders('retry-after') or [None])[0]
+        else:
+            hint = headers.get('Retry-After')
+    try:
+        return float(hint)
+    except (TypeError, ValueError):
+        return None
+
+
+def full_jitter(backoff, attempt, previous):
+    """
+    Wait a random time up to the exponential backoff.
+    """
+    return backoff.scatter() * backoff.ceiling(attempt)
+
+
+def equal_jitter(backoff, attempt, previous):
+    """
+    Wait half the exponential backoff plus a random time up to the other
+    half.
+    """
+    half = backoff.ceiling(attempt) / 2.0
+    return half + backoff.scatter() * half
+
+
+def decorrelated_jitter(backoff, attempt, previous):
+    """
+    Wait a random time between the base delay and three times the previous
+    wait.
+    """
+    upper = max(backoff.base, previous * 3)
+    delay = backoff.base + backoff.scatter() * (upper - backoff.base)
+    return min(backoff.cap, delay)
+
+
+class ClassifyingBackoff(object):
+    """
+    Exponential backoff which retries only retryable failures and fails
+    fast on fatal ones. Waits between attempts are chosen by C{jitter}
+    (L{full_jitter}, L{equal_jitter} or L{decorrelated_jitter}) from
+    exponential backoff ceilings of C{base * 2 ** attempt}, capped at
+    C{cap}, but are never shorter than a server's L{retry_after} hint.
+
+    @param max_attempts: Number of calls made before giving up.
+    @param base: Seconds of the first backoff ceiling
+    @param cap: Longest backoff ceiling in seconds
+    @param jitter: Callable taking this backoff, the number of attempts
+        made and the previous wait, returning the next wait.
+    @param classify: Callable taking a L{Failure}, returning True if the
+        call should be retried. default: L{is_retryable}
+    """
+    implements(IRetryDeferred)
+
+    scatter = random.random
+    log_errors = True
+
+    def __init__(self, max_attempts=8, base=0.1, cap=20, jitter=full_jitter,
+                 classify=is_retryable, clock=None, log=None):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.classify = classify
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        if log is None:
+            log = twisted_log
+        self.log = log
+
+    def ceiling(self, attempt):
+        """
+        Return the exponential backoff ceiling after C{attempt} attempts.
+        """
+        return min(self.cap, self.base * 2 ** (attempt - 1))
+
+    def retry(self, f, *args, **kwargs):
+        retrying = _Retrying()
+        self._call(retrying, 1, 0, f, args, kwargs)
+        return retrying.finished
+
+    def _call(self, retrying, attempt, previous, f, a, kw):
+        d = retrying.call(f, a, kw)
+        d.addCallback(retrying.finished.callback)
+        if self.log_errors:
+            d.addErrback(self._log_error, f, retrying)
+        d.addErrback(self._retry, retrying, attempt, previous, f, a, kw)
+
+    def _retry(self, why, retrying, attempt, previous, f, a, kw):
+        if retrying.cancelled:
+            return
+        if attempt >= self.max_attempts or not self.classify(why):
+            retrying.finished.errback(why)
+            return
+        when = self.jitter(self, attempt, previous)
+        hint = retry_after(why)
+        if hint is not None:
+            when = max(when, hint)
+        retrying.later(self.clock, when, self._call, retrying, attempt + 1,
+                       when, f, a, kw)
+
+    def _log_error(self, why, f, retrying):
+        if not retrying.cancelled:
+            self.log.msg('Error applying function=%s' % f)
+            self.log.err(why)
         return why
@@ -0,0 +1,34 @@
+"""
+Part uploading worker process for L{bafload.multiproc.WorkerPool}.
+
+Usage: python -m bafload.scripts.partworker S3_URI
+
+Credentials are read from the environment variables AWS_ACCESS_KEY_ID and
+AWS_SECRET_ACCESS_KEY. Requests are read from stdin and responses written
+to stdout; logging goes to stderr.
+"""
+import sys
+
+from twisted.internet import reactor, stdio
+from twisted.python import log
+
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceRegion
+
+from bafload.client import get_s3_client
+from bafload.multiproc import PartUploaderWorker
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    log.startLogging(sys.stderr)
+    region = AWSServiceRegion(creds=AWSCredentials(), s3_uri=argv[1])
+    worker = PartUploaderWorker(get_s3_client(region),
+                                on_disconnect=reactor.stop)
+    stdio.StandardIO(worker)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
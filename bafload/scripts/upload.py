@@ -1,16 +1,20 @@
 import sys
 import os
 from optparse import OptionParser
-import mimetypes
 
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.internet.defer import gatherResults
+from twisted.python.failure import Failure
+from twisted.web.server import Site
 
 from txaws.credentials import AWSCredentials
 from txaws.service import AWSServiceRegion
 
-from bafload.stats import ThroughputCounter
+from bafload.metrics import MetricsResource
+from bafload.progress import ProgressReporter
+from bafload.stats import ThroughputCounter, LatencyStats
+from bafload.trace import JSONLinesExporter
+from bafload.throttle import FairThrottler, ByteRateThrottler
 from bafload.up import MultipartUploadsManager
 
 
@@ -23,6 +27,22 @@ parser.add_option('-r', '--region', dest='region', default='US',
     help='EC2 Service Regison')
 parser.add_option('-b', '--bucket', dest='bucket',
     help='Name of the bucket to upload to')
+parser.add_option('-m', '--manifest', dest='manifest',
+    help='File listing paths to upload, one per line, each optionally '
+         'followed by a tab and the object name')
+parser.add_option('-R', '--recursive', dest='recursive', action='store_true',
+    default=False, help='Upload the files in directories recursively')
+parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+    default=10, help='Maximum number of objects to upload at once')
+parser.add_option('-l', '--limit-rate', dest='limit_rate', type='int',
+    help='Maximum upload rate in bytes per second')
+parser.add_option('-t', '--trace', dest='trace',
+    help='File to write upload events to as JSON lines')
+parser.add_option('-i', '--progress-interval', dest='progress_interval',
+    type='float', default=1,
+    help='Minimum seconds between progress lines')
+parser.add_option('-p', '--metrics-port', dest='metrics_port', type='int',
+    help='Local port to serve Prometheus metrics on while uploading')
 options, paths = parser.parse_args()
 
 
@@ -32,29 +52,80 @@ def error(message):
 
 
 def show_stats(result, throughput_counter):
-    table = throughput_counter.read()
-    slot_dur = throughput_counter.stats.slot_duration_secs
-    (index0, (t0, _)) = [(i, (t, count))
-            for (i, (t, count)) in enumerate(table) if count][0]
-    (index1, (tk, _)) = [(i, (t, count))
-            for (i, (t, count)) in enumerate(reversed(table)) if count][0]
-    index1 = throughput_counter.stats.size - index1
-    elapsed = (tk - t0) + slot_dur
-    counts = [slot[1] for slot in table[index0:index1 + 1]]
-    tx = sum(counts)
-    max_count = max(counts)
-    max_mbps = max_count / float(slot_dur) / (2 ** 20)
-    min_mbps = min(counts) / float(slot_dur) / (2 ** 20)
-    avg_mbps = tx / float(elapsed) / (2 ** 20)
-    print 'Average Transfer: %3.3fMBs' % avg_mbps
-    print 'Max: %3.3fMBs' % max_mbps
-    print 'Min: %3.3fMBs' % min_mbps
-    print 'Total tx: %2.2fMB' % (tx / 2.0 ** 20)
+    summary = throughput_counter.summary()
+    mb = float(2 ** 20)
+    print 'Average Transfer: %3.3fMBs' % (summary.average / mb)
+    print 'Max: %3.3fMBs' % (summary.max / mb)
+    print 'Min: %3.3fMBs' % (summary.min / mb)
+    print 'Total tx: %2.2fMB' % (summary.total / mb)
     return result
 
 
-def complete(result):
-    print 'successfully uploaded: %s' % ', '.join(paths)
+def show_progress(result, reporter):
+    reporter.report()
+    return result
+
+
+def show_latencies(result, latencies):
+    for phase in latencies.phases():
+        histogram = latencies.histogram(phase)
+        print '%-12s n=%-6d p50=%.3fs p90=%.3fs p99=%.3fs max=%.3fs ' \
+              'retries=%d' % (phase, histogram.count,
+                              histogram.percentile(0.5),
+                              histogram.percentile(0.9),
+                              histogram.percentile(0.99), histogram.max,
+                              latencies.retries.get(phase, 0))
+    return result
+
+
+def iter_sources(paths, manifest=None, recursive=False):
+    """
+    Generate sources for L{MultipartUploadsManager.upload_many} from a
+    manifest file and from paths. Directories are walked if C{recursive} is
+    True and their files are uploaded with object names relative to the
+    directory.
+    """
+    if manifest is not None:
+        with open(manifest) as fd:
+            for line in fd:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                if '\t' in line:
+                    yield tuple(line.split('\t', 1))
+                else:
+                    yield line
+    for path in paths:
+        if recursive and os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    full_path = os.path.join(dirpath, filename)
+                    yield (full_path, os.path.relpath(full_path, path))
+        else:
+            yield path
+
+
+def uploaded(source, result):
+    if isinstance(source, tuple):
+        source = source[0]
+    if isinstance(result, Failure):
+        log.msg('failed to upload %s: %s' % (source,
+                                             result.getErrorMessage()))
+    else:
+        timings = result.timings
+        log.msg('uploaded %s in %.3fs (%.3fs queued, %d retries)' % (
+                source, timings.elapsed, timings.queued, timings.retries))
+
+
+def complete(counts):
+    (completed, failed) = counts
+    print 'successfully uploaded: %d, failed: %d' % (completed, failed)
+    return counts
+
+
+def close_trace(result, tracer):
+    tracer.close()
     return result
 
 
@@ -69,18 +140,34 @@ def start():
     creds = AWSCredentials(options.access_key, options.secret_key)
     region = AWSServiceRegion(creds=creds, region=options.region)
     throughput_counter = ThroughputCounter()
+    latencies = LatencyStats()
+    reporter = ProgressReporter(options.progress_interval)
+    tracer = None
+    if options.trace:
+        tracer = JSONLinesExporter(open(options.trace, 'w'))
+    rate_throttler = None
+    if options.limit_rate:
+        rate_throttler = ByteRateThrottler(options.limit_rate)
+    throttler = FairThrottler(throttler=rate_throttler)
     uploader = MultipartUploadsManager(region=region,
-            throughput_counter=throughput_counter)
-    finished = []
-    for path in paths:
-        fd = open(path)
-        object_name = os.path.basename(path)
-        content_type = mimetypes.guess_type(path)[0]
-        d = uploader.upload(fd, bucket, object_name, content_type=content_type,
-                            amz_headers={'acl': 'public-read'})
-        finished.append(d)
-    gatherResults(finished).addCallback(show_stats, throughput_counter
-            ).addCallbacks(complete, log.err).addBoth(stop)
+            throughput_counter=throughput_counter, throttler=throttler,
+            latencies=latencies, tracer=tracer,
+            counter_factory=reporter.counter)
+    if options.metrics_port:
+        reactor.listenTCP(options.metrics_port,
+                          Site(MetricsResource(uploader)),
+                          interface='127.0.0.1')
+    sources = iter_sources(paths, options.manifest, options.recursive)
+    d = uploader.upload_many(sources, bucket, options.concurrency,
+                             on_result=uploaded,
+                             amz_headers={'acl': 'public-read'})
+    d.addCallback(show_progress, reporter
+            ).addCallback(show_stats, throughput_counter
+            ).addCallback(show_latencies, latencies
+            ).addCallbacks(complete, log.err)
+    if tracer is not None:
+        d.addBoth(close_trace, tracer)
+    d.addBoth(stop)
 
 
 log.startLogging(sys.stdout)
@@ -0,0 +1,82 @@
+"""
+Part size policies.
+"""
+from zope.interface import implements
+
+from bafload.interfaces import IPartSizePolicy, IByteLength
+
+
+__all__ = ['PartSizePolicy', 'MIN_PART_SIZE', 'MAX_PART_SIZE', 'MAX_PARTS']
+
+
+MIN_PART_SIZE = 0x500000
+MAX_PART_SIZE = 0x140000000
+MAX_PARTS = 10000
+
+
+class PartSizePolicy(object):
+    """
+    Choose a part size from the size of the object, keeping the part count
+    within C{max_parts} and the part size between C{min_part_size} and
+    C{max_part_size} (S3's limits by default).
+
+    If C{target_part_duration} and C{throughput_counter} are given, parts are
+    also made large enough to take about C{target_part_duration} seconds to
+    upload at the rate single parts have been observed to upload at
+    (L{bafload.stats.ThroughputCounter.entity_rate}), so fast links make
+    fewer requests per GB.
+
+    Part sizes are rounded up to a multiple of C{alignment} bytes.
+
+    @param min_part_size: Minimum part size
+    @param max_part_size: Maximum part size
+    @param max_parts: Maximum number of parts for an object
+    @param target_part_duration: Desired upload time for a part in seconds
+    @param throughput_counter: L{bafload.stats.ThroughputCounter}
+    @param alignment: Part sizes are multiples of this
+    """
+    implements(IPartSizePolicy)
+
+    def __init__(self, min_part_size=MIN_PART_SIZE,
+                 max_part_size=MAX_PART_SIZE, max_parts=MAX_PARTS,
+                 target_part_duration=None, throughput_counter=None,
+                 alignment=0x100000):
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.max_parts = max_parts
+        self.target_part_duration = target_part_duration
+        self.throughput_counter = throughput_counter
+        self.alignment = alignment
+
+    def part_size_for(self, fd):
+        try:
+            size = IByteLength(fd)
+        except TypeError:
+            size = None
+        part_size = max(self.min_part_size, self._target_part_size())
+        if size is not None:
+            least = size / self.max_parts
+            if size % self.max_parts:
+                least += 1
+            if least > self.max_part_size:
+                raise ValueError('Object of %d bytes cannot be uploaded in '
+                                 '%d parts of at most %d bytes' % (
+                                 size, self.max_parts, self.max_part_size))
+            part_size = max(part_size, least)
+        part_size = self._align(part_size)
+        return min(part_size, self.max_part_size)
+
+    def _target_part_size(self):
+        if (self.target_part_duration is None or
+            self.throughput_counter is None):
+            return 0
+        rate = self.throughput_counter.entity_rate
+        if not rate:
+            return 0
+        return int(rate * self.target_part_duration)
+
+    def _align(self, part_size):
+        remainder = part_size % self.alignment
+        if remainder:
+            part_size += self.alignment - remainder
+        return part_size
@@ -1,14 +1,16 @@
 import math
-from collections import deque
+from array import array
+from collections import Sequence
 
 from zope.interface import implements
 
 from twisted.internet import reactor
 
-from bafload.interfaces import IThrouputCounter
+from bafload.interfaces import IThrouputCounter, ITracer
 
 
-__all__ = ['SlidingStats', 'ThroughputCounter']
+__all__ = ['SlidingStats', 'SlotsView', 'ThroughputCounter',
+           'ThroughputSummary', 'LatencyHistogram', 'LatencyStats']
 
 
 class SlidingStats(object):
@@ -18,20 +20,73 @@ class SlidingStats(object):
     C{size}. This should be initialized for a given time C{t} (float seconds)
     provided by the wizard. The window also has the property that there are no
     gaps between each time slot.
+
+    Slots are kept in preallocated arrays used as a ring buffer: slot number
+    C{n} (covering time C{n * slot_duration_secs}) lives at index
+    C{n % size}, alongside the slot number it was last written for, so a
+    value left from an earlier lap of the ring reads as 0. Updates and
+    moving the window on, however far, take constant time and allocate
+    nothing.
+
+    Counts spread over a range of slots with L{add_range} are kept as
+    pending ranges and added to the slots in one difference array sweep of
+    the window when the slots are next read.
+
+    @ivar slots: A read-only L{SlotsView} of (time, value) pairs, oldest
+        first.
     """
 
     def __init__(self, t, slot_duration_secs=1, size=2048):
         self.slot_duration_secs = slot_duration_secs
         self.size = size
         self.generation = size * self.slot_duration_secs
-        t = t - (t % self.slot_duration_secs)
-        self._reset_slots(t)
+        self._values = array('d', [0]) * size
+        self._numbers = array('l', [-1]) * size
+        self._deltas = array('d', [0]) * (size + 1)
+        self._ends = array('l', [0]) * (size + 1)
+        self._pending = []
+        self.last = self._number(t)
+        self.slots = SlotsView(self)
 
-    def _reset_slots(self, t):
-        dur = self.slot_duration_secs
-        n = self.size
-        t0 = dur + t - self.generation
-        self.slots = deque([(t0 + (i * dur), 0) for i in xrange(n)], n)
+    def _number(self, t):
+        return int(math.floor(t / float(self.slot_duration_secs)))
+
+    @property
+    def first(self):
+        """
+        Number of the oldest slot in the window.
+        """
+        return self.last - self.size + 1
+
+    def value(self, n):
+        """
+        Return the value of slot number C{n}.
+        """
+        if self._pending:
+            self._resolve()
+        i = n % self.size
+        if self._numbers[i] != n:
+            return 0
+        return self._values[i]
+
+    def total(self, t, count):
+        """
+        Return the sum of the values of the C{count} slots up to and
+        including that of time C{t} which are in the window.
+        """
+        last = self._number(t)
+        first = max(last - count + 1, self.first)
+        value = self.value
+        return sum(value(n) for n in xrange(first, last + 1))
+
+    def counts(self):
+        """
+        Return the values of the slots in the window, oldest first, as an
+        C{array('d')}.
+        """
+        value = self.value
+        return array('d', [value(n) for n in xrange(self.first,
+                                                     self.last + 1)])
 
     def update(self, t, count):
         """
@@ -46,26 +101,105 @@ class SlidingStats(object):
         @param t: The time to update for as C{float}
         @param count: The value to add to current total for t' (if in window)
         """
-        tp = t - (t % self.slot_duration_secs)
-        if tp < self.slots[0][0]:
+        n = self._number(t)
+        if n < self.first:
+            return
+        if n > self.last:
+            self.last = n
+        self._add(n, count)
+
+    def add_range(self, t0, t1, count):
+        """
+        Add C{count} to each slot from that of time C{t0} through that of
+        time C{t1}, as L{update} would for each, in constant time. Slots
+        before the window are left out.
+        """
+        n0 = self._number(t0)
+        n1 = self._number(t1)
+        if n1 < self.first or n1 < n0:
             return
-        if (tp - self.slots[-1][0]) > self.generation:
-            self._reset_slots(tp)
-        index = -1
-        (last, v) = self.slots[index]
-        while tp > last:
-            self.slots.append((last + self.slot_duration_secs, 0))
-            (last, v) = self.slots[index]
-        if tp < last:
-            index = int(((tp - last) / self.slot_duration_secs) - 1)
-        tk, v = self.slots[index]
-        self.slots[index] = (tp, v + count)
+        if n1 > self.last:
+            self.last = n1
+        self._pending.append((n0, n1, count))
+        if len(self._pending) >= self.size:
+            self._resolve()
+
+    def _add(self, n, count):
+        i = n % self.size
+        if self._numbers[i] != n:
+            self._numbers[i] = n
+            self._values[i] = 0
+        self._values[i] += count
+
+    def _resolve(self):
+        """
+        Add the pending ranges to the slots in the window.
+        """
+        (pending, self._pending) = (self._pending, [])
+        first = self.first
+        deltas = self._deltas
+        ends = self._ends
+        for (n0, n1, count) in pending:
+            if n1 < first:
+                continue
+            n0 = max(n0, first)
+            deltas[n0 - first] += count
+            deltas[n1 - first + 1] -= count
+            ends[n0 - first] += 1
+            ends[n1 - first + 1] -= 1
+        running = 0
+        active = 0
+        for k in xrange(self.size):
+            running += deltas[k]
+            active += ends[k]
+            deltas[k] = ends[k] = 0
+            if not active:
+                # Don't leave rounding errors outside the ranges.
+                running = 0
+            elif running:
+                self._add(first + k, running)
+        deltas[self.size] = ends[self.size] = 0
+
+
+class SlotsView(Sequence):
+    """
+    The slots of a L{SlidingStats} as a sequence of (time, value) pairs,
+    oldest first. The view reads the ring buffer of its stats in place, so
+    it always shows the current window.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __len__(self):
+        return self.stats.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        n = self.stats.first + index
+        return (n * self.stats.slot_duration_secs, self.stats.value(n))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<SlotsView %r>' % (list(self),)
 
 
 class ThroughputCounter(object):
     implements(IThrouputCounter)
 
     cutoff = 3600
+    entity_rate = None
+    entity_rate_weight = 0.2
 
     def __init__(self, clock=None, stats=None):
         if clock is None:
@@ -84,14 +218,265 @@ class ThroughputCounter(object):
         t1 = self.clock.seconds()
         t0 = self.starts.pop(id)
         total = t1 - t0
+        if size and total > 0:
+            self._update_entity_rate(size / float(total))
         dur = self.stats.slot_duration_secs
         if total < dur:
             self.stats.update(t1, size)
         else:
             divisions = int(math.ceil(total / float(dur)))
-            for i in xrange(divisions):
-                t_k = t1 - (i * float(dur))
-                self.stats.update(t_k, size / float(divisions))
+            t_k = t1 - ((divisions - 1) * float(dur))
+            self.stats.add_range(t_k, t1, size / float(divisions))
+
+    def _update_entity_rate(self, rate):
+        """
+        Update the exponentially weighted moving average of bytes per second
+        for single entities.
+        """
+        if self.entity_rate is None:
+            self.entity_rate = rate
+        else:
+            w = self.entity_rate_weight
+            self.entity_rate = (w * rate) + ((1 - w) * self.entity_rate)
 
     def read(self):
-        return list(self.stats.slots)
+        """
+        Return the (time, value) slots of stats, oldest first, as a
+        L{SlotsView} of the current window.
+        """
+        return self.stats.slots
+
+    def rate(self, window):
+        """
+        Return the average count per second over the last C{window}
+        seconds.
+        """
+        dur = self.stats.slot_duration_secs
+        slots = max(1, int(math.ceil(window / float(dur))))
+        total = self.stats.total(self.clock.seconds(), slots)
+        return total / float(slots * dur)
+
+    def summary(self):
+        """
+        Return a L{ThroughputSummary} of the stats.
+        """
+        return ThroughputSummary(self.stats.counts(),
+                                 self.stats.slot_duration_secs)
+
+
+class ThroughputSummary(object):
+    """
+    Summary of the active part of a window of slot counts: the slots from
+    the first through the last with a count. Rates are per second.
+
+    @ivar counts: C{array('d')} of the counts of the active slots
+    @ivar elapsed: Seconds covered by the active slots
+    @ivar total: Sum of the counts
+    @ivar average: Total over the elapsed time
+    @ivar max: Rate of the busiest slot
+    @ivar min: Rate of the quietest slot
+    """
+
+    _sorted = None
+
+    def __init__(self, counts, slot_duration_secs=1):
+        start = 0
+        end = len(counts)
+        while start < end and not counts[start]:
+            start += 1
+        while end > start and not counts[end - 1]:
+            end -= 1
+        self.counts = counts[start:end]
+        self.slot_duration_secs = dur = float(slot_duration_secs)
+        self.elapsed = len(self.counts) * dur
+        self.total = sum(self.counts)
+        self.average = self.max = self.min = 0
+        if self.counts:
+            self.average = self.total / self.elapsed
+            self.max = max(self.counts) / dur
+            self.min = min(self.counts) / dur
+
+    def percentile(self, p):
+        """
+        Return the rate which the C{p} (between 0 and 1) percentile of the
+        active slots don't exceed.
+        """
+        if not self.counts:
+            return 0
+        if self._sorted is None:
+            self._sorted = sorted(self.counts)
+        index = int(round(p * (len(self._sorted) - 1)))
+        return self._sorted[index] / self.slot_duration_secs
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of latencies (in seconds) in logarithmic buckets, like an
+    HDR histogram: each bucket's upper bound is C{1 + precision} times that
+    of the one before, so percentiles are within C{precision} relative
+    error, in a fixed amount of memory. Values up to C{lowest} fall in the
+    first bucket and values above C{highest} in the last. Histograms with
+    the same bounds and precision can be merged.
+
+    @param lowest: Upper bound of the first bucket
+    @param highest: Lower bound of the last bucket
+    @param precision: Relative width of the buckets
+    """
+
+    count = 0
+    total = 0
+    min = None
+    max = None
+
+    def __init__(self, lowest=0.0001, highest=3600, precision=0.01):
+        self.lowest = lowest
+        self.highest = highest
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        size = int(math.ceil(math.log(highest / float(lowest)) /
+                             self._log_base)) + 1
+        self.counts = array('l', [0]) * size
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def _index(self, value):
+        if value <= self.lowest:
+            return 0
+        index = int(math.ceil(math.log(value / float(self.lowest)) /
+                              self._log_base))
+        return min(index, len(self.counts) - 1)
+
+    def _upper(self, index):
+        return self.lowest * (1 + self.precision) ** index
+
+    def record(self, value, count=1):
+        """
+        Record C{count} occurrences of latency C{value}.
+        """
+        self.counts[self._index(value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Return the latency which the C{p} (between 0 and 1) percentile of
+        recorded latencies don't exceed, or None if none are recorded.
+        """
+        return self.percentiles([p])[0]
+
+    def percentiles(self, ps):
+        """
+        Return the L{percentile}s C{ps} (in increasing order) in one pass
+        over the buckets.
+        """
+        if not self.count:
+            return [None] * len(ps)
+        results = []
+        ranks = [max(1, int(math.ceil(p * self.count))) for p in ps]
+        last = len(self.counts) - 1
+        seen = 0
+        index = 0
+        for rank in ranks:
+            while seen + self.counts[index] < rank and index < last:
+                seen += self.counts[index]
+                index += 1
+            if index == last:
+                results.append(self.max)
+            else:
+                results.append(max(self.min,
+                                   min(self.max, self._upper(index))))
+        return results
+
+    def merge(self, other):
+        """
+        Add the latencies recorded by histogram C{other} to this one.
+        """
+        if (other.lowest, other.highest, other.precision) != \
+                (self.lowest, self.highest, self.precision):
+            raise ValueError('Cannot merge histograms with different buckets')
+        if not other.count:
+            return
+        counts = self.counts
+        for (index, count) in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+
+class LatencyStats(object):
+    """
+    L{LatencyHistogram}s of the latencies of phases of uploads, such as
+    C{'init'}, C{'upload_part'} or C{'complete'} calls, and counts of their
+    retries and failed attempts, recorded from the events of uploads it
+    traces. Time calls spend waiting in a throttler is recorded as the
+    C{'queued'} phase.
+
+    @param histogram_factory: Callable taking no arguments returning a new
+        L{LatencyHistogram}
+    """
+    implements(ITracer)
+
+    def __init__(self, histogram_factory=LatencyHistogram):
+        self.histogram_factory = histogram_factory
+        self.histograms = {}
+        self.retries = {}
+        self.failures = {}
+
+    def phases(self):
+        """
+        Return the names of the phases recorded, sorted.
+        """
+        return sorted(self.histograms)
+
+    def histogram(self, phase):
+        """
+        Return the histogram of C{phase}.
+        """
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = self.histogram_factory()
+        return histogram
+
+    def record(self, phase, seconds):
+        self.histogram(phase).record(seconds)
+
+    def percentile(self, phase, p):
+        """
+        Return the C{p} (between 0 and 1) percentile latency of C{phase},
+        or None if none are recorded.
+        """
+        return self.histogram(phase).percentile(p)
+
+    def merge(self, other):
+        """
+        Add the latencies, retries and failures recorded by C{other} to
+        these stats.
+        """
+        for (phase, histogram) in other.histograms.iteritems():
+            self.histogram(phase).merge(histogram)
+        for (phase, retries) in other.retries.iteritems():
+            self.retries[phase] = self.retries.get(phase, 0) + retries
+        for (phase, failures) in other.failures.iteritems():
+            self.failures[phase] = self.failures.get(phase, 0) + failures
+
+    def event(self, name, start, duration, **tags):
+        self.record(name, duration)
+        if 'queued' in tags:
+            self.record('queued', tags['queued'])
+        if tags.get('attempt', 1) > 1:
+            self.retries[name] = self.retries.get(name, 0) + 1
+        if 'error' in tags:
+            self.failures[name] = self.failures.get(name, 0) + 1
@@ -0,0 +1,202 @@
+from zope.interface.verify import verifyObject
+
+from twisted.internet import error
+from twisted.internet.defer import Deferred, succeed, fail, CancelledError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from bafload.retry import IRetryDeferred, ClassifyingBackoff
+from bafload.breaker import (RetryBudgetExhausted, RetryBudget,
+        CircuitBreaker, GuardedRetry)
+from bafload.test.util import FakeClock, FakeLog
+
+
+class RetryBudgetTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.budget = RetryBudget(ratio=0.5, min_retries=1, window=10,
+                                  clock=self.clock)
+
+    def test_min_retries(self):
+        self.assert_(self.budget.withdraw())
+        self.failIf(self.budget.withdraw())
+
+    def test_ratio(self):
+        for i in range(4):
+            self.budget.deposit()
+        self.assertEqual([self.budget.withdraw() for i in range(4)],
+                         [True, True, True, False])
+
+    def test_window(self):
+        for i in range(4):
+            self.budget.deposit()
+        self.clock.advance(5)
+        self.assert_(self.budget.withdraw())
+        self.assert_(self.budget.withdraw())
+        self.clock.advance(5)
+        self.failIf(self.budget.withdraw())
+        self.assertEqual((self.budget.successes, self.budget.retries),
+                         (0, 2))
+        self.clock.advance(5)
+        self.assert_(self.budget.withdraw())
+        self.assertEqual((self.budget.successes, self.budget.retries),
+                         (0, 1))
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(threshold=2, reset_timeout=10,
+                                      clock=self.clock)
+        self.calls = []
+
+    def _call(self, result):
+        self.calls.append(result)
+        if isinstance(result, Exception):
+            return fail(result)
+        return succeed(result)
+
+    def _trip(self):
+        for i in range(2):
+            d = self.breaker.call(self._call, error.ConnectionLost())
+            self.assertFailure(d, error.ConnectionLost)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_closed(self):
+        results = []
+        self.breaker.call(self._call, 'ok').addCallback(results.append)
+        self.assertEqual(results, ['ok'])
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_fatal_errors_do_not_trip(self):
+        for i in range(3):
+            d = self.breaker.call(self._call, ValueError())
+            self.assertFailure(d, ValueError)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_success_resets_failures(self):
+        d = self.breaker.call(self._call, error.ConnectionLost())
+        self.assertFailure(d, error.ConnectionLost)
+        self.breaker.call(self._call, 'ok')
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_open_waits(self):
+        self._trip()
+        results = []
+        for i in range(3):
+            self.breaker.call(self._call, i).addCallback(results.append)
+        self.assertEqual(self.breaker.waiting, 3)
+        self.failIf(results)
+        self.clock.advance(10)
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.failIf(self.breaker.waiting)
+
+    def test_half_open_probes(self):
+        self._trip()
+        probe = Deferred()
+        self.breaker.call(lambda: probe)
+        self.breaker.call(self._call, 'next')
+        self.clock.advance(10)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.probing, 1)
+        self.assertEqual(self.breaker.waiting, 1)
+        self.breaker.call(self._call, 'later')
+        self.assertEqual(self.breaker.waiting, 2)
+        probe.callback(None)
+        self.assertEqual(self.calls[-2:], ['next', 'later'])
+
+    def test_failed_probe_reopens(self):
+        self._trip()
+        d = self.breaker.call(self._call, error.ConnectionLost())
+        self.assertFailure(d, error.ConnectionLost)
+        self.breaker.call(self._call, 'next')
+        self.clock.advance(10)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.waiting, 1)
+        self.clock.advance(10)
+        self.assertEqual(self.calls[-1], 'next')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        return d
+
+    def test_unclassified_probe_failure(self):
+        self._trip()
+        probe = Deferred()
+        d = self.breaker.call(lambda: probe)
+        self.breaker.call(self._call, 'next')
+        self.clock.advance(10)
+        self.assertEqual(self.breaker.waiting, 1)
+        probe.cancel()
+        self.assertEqual(self.calls[-1], 'next')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.failIf(self.breaker.waiting)
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_waiting(self):
+        self._trip()
+        d = self.breaker.call(self._call, 'cancelled')
+        d.cancel()
+        self.failIf(self.breaker.waiting)
+        self.clock.advance(10)
+        self.assertNotIn('cancelled', self.calls)
+        return self.assertFailure(d, CancelledError)
+
+
+class GuardedRetryTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backoff = ClassifyingBackoff(clock=self.clock, log=FakeLog())
+
+    def _failing(self, count):
+        calls = []
+
+        def f(a):
+            calls.append(a)
+            if len(calls) <= count:
+                return fail(error.ConnectionLost())
+            return succeed(a)
+
+        return (f, calls)
+
+    def test_iface(self):
+        verifyObject(IRetryDeferred, GuardedRetry(self.backoff))
+
+    def test_retry(self):
+        budget = RetryBudget(clock=self.clock)
+        retry = GuardedRetry(self.backoff, budget=budget)
+        (f, calls) = self._failing(2)
+
+        def check(result):
+            self.assertEqual(result, 'a')
+            self.assertEqual(calls, ['a', 'a', 'a'])
+            self.assertEqual((budget.successes, budget.retries), (1, 2))
+
+        return retry.retry(f, 'a').addCallback(check)
+
+    def test_budget_exhausted(self):
+        budget = RetryBudget(ratio=0, min_retries=1, clock=self.clock)
+        retry = GuardedRetry(self.backoff, budget=budget)
+        (f, calls) = self._failing(5)
+
+        def check(why):
+            self.assertEqual(calls, ['a', 'a'])
+            return why
+
+        d = retry.retry(f, 'a')
+        d.addErrback(check)
+        return self.assertFailure(d, RetryBudgetExhausted)
+
+    def test_breaker(self):
+        clock = Clock()
+        breaker = CircuitBreaker(threshold=2, reset_timeout=10, clock=clock)
+        retry = GuardedRetry(self.backoff, breaker=breaker)
+        (f, calls) = self._failing(2)
+        results = []
+        retry.retry(f, 'a').addCallback(results.append)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(breaker.waiting, 1)
+        clock.advance(10)
+        self.assertEqual(results, ['a'])
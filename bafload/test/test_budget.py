@@ -0,0 +1,64 @@
+from twisted.internet.defer import CancelledError
+from twisted.trial.unittest import TestCase
+
+from bafload.budget import ByteBudget
+
+
+class ByteBudgetTestCase(TestCase):
+
+    def test_acquire_within_limit(self):
+        budget = ByteBudget(30)
+        acquired = []
+        for _ in range(3):
+            budget.acquire(10).addCallback(acquired.append)
+        self.assertEqual(acquired, [10, 10, 10])
+        self.assertEqual(budget.in_flight, 30)
+        self.assertEqual(budget.waiting, 0)
+
+    def test_acquire_waits_for_release(self):
+        budget = ByteBudget(20)
+        acquired = []
+        for _ in range(4):
+            budget.acquire(10).addCallback(acquired.append)
+        self.assertEqual(acquired, [10, 10])
+        self.assertEqual(budget.waiting, 2)
+        budget.release(10)
+        self.assertEqual(acquired, [10, 10, 10])
+        self.assertEqual(budget.in_flight, 20)
+        budget.release(10)
+        budget.release(10)
+        self.assertEqual(acquired, [10, 10, 10, 10])
+        self.assertEqual(budget.in_flight, 10)
+        self.assertEqual(budget.waiting, 0)
+
+    def test_acquire_in_order(self):
+        budget = ByteBudget(20)
+        acquired = []
+        budget.acquire(15)
+        budget.acquire(10).addCallback(acquired.append)
+        budget.acquire(5).addCallback(acquired.append)
+        self.assertEqual(acquired, [])
+        budget.release(15)
+        self.assertEqual(acquired, [10, 5])
+
+    def test_acquire_larger_than_limit(self):
+        budget = ByteBudget(10)
+        acquired = []
+        budget.acquire(50).addCallback(acquired.append)
+        budget.acquire(5).addCallback(acquired.append)
+        self.assertEqual(acquired, [50])
+        budget.release(50)
+        self.assertEqual(acquired, [50, 5])
+
+    def test_cancel(self):
+        budget = ByteBudget(20)
+        acquired = []
+        budget.acquire(10)
+        d = budget.acquire(20)
+        budget.acquire(10).addCallback(acquired.append)
+        self.assertEqual(budget.waiting, 2)
+        d.cancel()
+        self.assertEqual(budget.waiting, 0)
+        self.assertEqual(acquired, [10])
+        self.assertEqual(budget.in_flight, 20)
+        return self.assertFailure(d, CancelledError)
@@ -0,0 +1,125 @@
+from StringIO import StringIO
+
+from twisted.internet.task import Cooperator
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txaws.credentials import AWSCredentials
+from txaws.s3.exception import S3Error
+from txaws.service import AWSServiceRegion
+
+from bafload.client import S3Client, get_s3_client
+from bafload.producers import FileRangeBodyProducer
+from bafload.retry import retry_after
+from bafload.up import SingleProcessPartUploader
+from bafload.test.util import FakeAgent, FakeResponse
+
+
+class S3ClientTestCase(TestCase):
+
+    def setUp(self):
+        super(S3ClientTestCase, self).setUp()
+        self.scheduled = []
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+        self.region = AWSServiceRegion(creds=AWSCredentials('key', 'secret'),
+                                       s3_uri='http://s3.example.com/')
+        self.agent = FakeAgent(FakeResponse(headers={'etag': '"abc"'}))
+        self.client = S3Client(creds=self.region.creds,
+                               endpoint=self.region.s3_endpoint,
+                               agent=self.agent, cooperator=self.cooperator)
+
+    def _body(self, producer):
+        consumer = StringTransport()
+        producer.startProducing(consumer)
+        while self.scheduled:
+            self.scheduled.pop(0)()
+        return consumer.value()
+
+    def _headers(self, headers):
+        return dict((k.lower(), v[0]) for (k, v) in headers.getAllRawHeaders())
+
+    def test_upload_part(self):
+        d = self.client.upload_part('mybucket', 'mykey', '1234', 2, 'data')
+        (method, uri, headers, producer) = self.agent.requests[0]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(uri, 'http://s3.example.com/mybucket/mykey?'
+                              'partNumber=2&uploadId=1234')
+        self.assertEqual(producer.length, 4)
+        self.assertEqual(self._body(producer), 'data')
+        self.assertNotEqual(
+            self._headers(headers)['x-amz-content-sha256'],
+            'UNSIGNED-PAYLOAD')
+        return d.addCallback(self.assertEqual, {'ETag': '"abc"'})
+
+    def test_upload_part_body_producer(self):
+        part = FileRangeBodyProducer(StringIO('0123456789'), 2, 5,
+                                     cooperator=self.cooperator)
+        handler = SingleProcessPartUploader()
+        handler.client = self.client
+        handler.bucket = 'mybucket'
+        handler.object_name = 'mykey'
+        handler.upload_id = '1234'
+        d = handler.handle_part(part, 1)
+        (method, uri, headers, producer) = self.agent.requests[0]
+        self.assertEqual(method, 'PUT')
+        self.assertIdentical(producer, part)
+        self.assertEqual(self._body(producer), '23456')
+        self.assertEqual(self._headers(headers)['x-amz-content-sha256'],
+                         'UNSIGNED-PAYLOAD')
+        return d.addCallback(self.assertEqual, (1, '"abc"'))
+
+    def test_list_parts(self):
+        self.agent.responses = [FakeResponse(body=
+            '<ListPartsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<IsTruncated>true</IsTruncated>'
+            '<NextPartNumberMarker>2</NextPartNumberMarker>'
+            '<Part><PartNumber>1</PartNumber><ETag>"a"</ETag></Part>'
+            '<Part><PartNumber>2</PartNumber><ETag>"b"</ETag></Part>'
+            '</ListPartsResult>'), FakeResponse(body=
+            '<ListPartsResult><IsTruncated>false</IsTruncated>'
+            '<Part><PartNumber>4</PartNumber><ETag>"d"</ETag></Part>'
+            '</ListPartsResult>')]
+        d = self.client.list_parts('mybucket', 'mykey', '1234')
+        self.assertEqual([(method, uri) for (method, uri, headers, producer)
+                          in self.agent.requests], [
+            ('GET', 'http://s3.example.com/mybucket/mykey?uploadId=1234'),
+            ('GET', 'http://s3.example.com/mybucket/mykey?uploadId=1234&'
+                    'part-number-marker=2')])
+        return d.addCallback(self.assertEqual,
+                             [(1, '"a"'), (2, '"b"'), (4, '"d"')])
+
+    def test_abort_multipart_upload(self):
+        self.agent.responses = [FakeResponse(code=204)]
+        d = self.client.abort_multipart_upload('mybucket', 'mykey', '1234')
+        (method, uri, headers, producer) = self.agent.requests[0]
+        self.assertEqual(method, 'DELETE')
+        self.assertEqual(uri,
+                         'http://s3.example.com/mybucket/mykey?uploadId=1234')
+        return d.addCallback(self.assertIdentical, None)
+
+    def test_error_retry_after(self):
+        self.agent.responses = [
+            FakeResponse(code=503, headers={'Retry-After': '7'}, body=
+                '<Error><Code>SlowDown</Code>'
+                '<Message>Reduce your request rate.</Message></Error>'),
+            FakeResponse(code=503, headers={'Retry-After': '2'}),
+            FakeResponse(code=503, body='<Error><Code>SlowDown</Code>'
+                '<Message>Reduce your request rate.</Message></Error>')]
+        errors = []
+        for i in range(3):
+            d = self.client.upload_part('mybucket', 'mykey', '1234', 1, 'x')
+            d.addErrback(errors.append)
+        self.assertIsInstance(errors[0].value, S3Error)
+        self.assertEqual([retry_after(why) for why in errors], [7, 2, None])
+
+    def test_get_s3_client(self):
+        client = get_s3_client(self.region)
+        self.assertIsInstance(client, S3Client)
+        self.assertIdentical(get_s3_client(self.region), client)
+        self.assertIdentical(client.endpoint, self.region.s3_endpoint)
+        client = get_s3_client(self.region, self.agent)
+        self.assertIdentical(client.agent, self.agent)
+        self.assertNotIdentical(get_s3_client(self.region, self.agent),
+                                client)
@@ -58,3 +58,10 @@ class CounterTestCase(TestCase):
         self.assertIn('2/365', next_msg())
         self.counter.increment_count()
         self.assertIn('3/365', next_msg())
+
+    def test_bytes(self):
+        self.counter.receiving = False
+        self.counter.increment_count(10)
+        self.counter.increment_count(5)
+        self.assertEqual(self.counter.completed, 2)
+        self.assertEqual(self.counter.bytes, 15)
@@ -0,0 +1,252 @@
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceRegion
+from txaws.util import XML
+
+from bafload.fakes3 import FakeS3Error, FakeS3, Faults, FakeS3Resource
+from bafload.up import MultipartUploadsManager
+from bafload.test.util import FakeLog
+
+
+class FakeS3TestCase(TestCase):
+
+    def setUp(self):
+        self.s3 = FakeS3()
+
+    def test_multipart_upload(self):
+        upload_id = self.s3.initiate('mybucket', 'mykey')
+        etag2 = self.s3.upload_part('mybucket', 'mykey', upload_id, 2, 'def')
+        etag1 = self.s3.upload_part('mybucket', 'mykey', upload_id, 1, 'abc')
+        self.assertEqual(etag1, '"900150983cd24fb0d6963f7d28e17f72"')
+        self.assertEqual(self.s3.list_parts('mybucket', 'mykey', upload_id),
+                         [(1, etag1, 3), (2, etag2, 3)])
+        etag = self.s3.complete('mybucket', 'mykey', upload_id,
+                                [(1, etag1), (2, etag2)])
+        self.assert_(etag.endswith('-2"'))
+        self.assertEqual(self.s3.get('mybucket', 'mykey'), ('abcdef', etag))
+        self.failIf(self.s3.uploads)
+
+    def test_complete_invalid_parts(self):
+        upload_id = self.s3.initiate('mybucket', 'mykey')
+        etag = self.s3.upload_part('mybucket', 'mykey', upload_id, 1, 'abc')
+        for (parts, code) in [([], 'MalformedXML'),
+                              ([(1, '"wrong"')], 'InvalidPart'),
+                              ([(2, etag)], 'InvalidPart'),
+                              ([(1, etag), (1, etag)], 'InvalidPartOrder')]:
+            e = self.assertRaises(FakeS3Error, self.s3.complete, 'mybucket',
+                                  'mykey', upload_id, parts)
+            self.assertEqual((e.status, e.code), (400, code))
+        self.assertIn(upload_id, self.s3.uploads)
+
+    def test_no_such_upload(self):
+        upload_id = self.s3.initiate('mybucket', 'mykey')
+        e = self.assertRaises(FakeS3Error, self.s3.upload_part, 'mybucket',
+                              'other', upload_id, 1, 'abc')
+        self.assertEqual((e.status, e.code), (404, 'NoSuchUpload'))
+        self.s3.abort('mybucket', 'mykey', upload_id)
+        self.assertRaises(FakeS3Error, self.s3.abort, 'mybucket', 'mykey',
+                          upload_id)
+
+    def test_put_get_delete(self):
+        etag = self.s3.put('mybucket', 'mykey', 'data')
+        self.assertEqual(self.s3.get('mybucket', 'mykey'), ('data', etag))
+        self.s3.delete('mybucket', 'mykey')
+        e = self.assertRaises(FakeS3Error, self.s3.get, 'mybucket', 'mykey')
+        self.assertEqual((e.status, e.code), (404, 'NoSuchKey'))
+
+
+class FaultsTestCase(TestCase):
+
+    def setUp(self):
+        self.draws = []
+        self.faults = Faults()
+        self.faults.random = lambda: self.draws.pop(0)
+
+    def test_failure(self):
+        self.faults.error_rate = 0.1
+        self.faults.throttle_rate = 0.2
+        self.faults.reset_rate = 0.1
+        self.draws = [0.05, 0.15, 0.35, 0.45]
+        self.assertEqual([self.faults.failure() for _ in range(4)],
+                         ['error', 'throttle', 'reset', None])
+        self.assertEqual(self.faults.injected,
+                         {'error': 1, 'throttle': 1, 'reset': 1})
+
+    def test_delay(self):
+        self.faults.latency = 0.5
+        self.assertEqual(self.faults.delay(0, 1000), 0.5)
+        self.faults.bandwidth = 1000
+        self.assertEqual(self.faults.delay(0, 500), 1)
+
+    def test_slow(self):
+        self.faults.bandwidth = 1000
+        self.faults.slow_rate = 0.5
+        self.draws = [0.1, 0.9]
+        self.assertEqual(self.faults.delay(0, 500), 5)
+        self.assertEqual(self.faults.delay(0, 500), 0.5)
+        self.assertEqual(self.faults.injected, {'slow': 1})
+
+    def test_total_bandwidth(self):
+        self.faults.total_bandwidth = 1000
+        self.assertEqual(self.faults.delay(10, 500), 0.5)
+        self.assertEqual(self.faults.delay(10, 500), 1)
+        self.assertEqual(self.faults.delay(12, 500), 0.5)
+
+
+class FakeS3ResourceTestCase(TestCase):
+
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.clock = Clock()
+        self.faults = Faults(latency=1)
+        self.resource = FakeS3Resource(self.s3, self.faults, self.clock)
+
+    def _request(self, method, path, args={}, body='', headers={}):
+        request = DummyRequest(path.split('/'))
+        request.method = method
+        request.content = StringIO(body)
+        request.uri = '/' + path
+        if args:
+            request.uri += '?' + '&'.join('%s=%s' % item
+                                          for item in sorted(args.items()))
+        for (name, value) in headers.items():
+            request.requestHeaders.setRawHeaders(name, [value])
+        self.assertEqual(self.resource.render(request), NOT_DONE_YET)
+        self.failIf(request.finished)
+        self.clock.advance(1)
+        self.assert_(request.finished)
+        return request
+
+    def _body(self, request):
+        return ''.join(request.written)
+
+    def test_multipart_upload(self):
+        request = self._request('POST', 'mybucket/my/key', {'uploads': ''})
+        upload_id = XML(self._body(request)).findtext('UploadId')
+        self.assertIn(upload_id, self.s3.uploads)
+        request = self._request('PUT', 'mybucket/my/key', {
+            'partNumber': '1', 'uploadId': upload_id}, 'abc')
+        etag = request.responseHeaders.getRawHeaders('etag')[0]
+        request = self._request('GET', 'mybucket/my/key',
+                                {'uploadId': upload_id})
+        part = XML(self._body(request)).find('Part')
+        self.assertEqual((part.findtext('PartNumber'), part.findtext('ETag'),
+                          part.findtext('Size')), ('1', etag, '3'))
+        body = ('<CompleteMultipartUpload><Part><PartNumber>1</PartNumber>'
+                '<ETag>%s</ETag></Part></CompleteMultipartUpload>' % etag)
+        request = self._request('POST', 'mybucket/my/key',
+                                {'uploadId': upload_id}, body)
+        result = XML(self._body(request))
+        self.assertEqual(result.findtext('Key'), 'my/key')
+        self.assertEqual(self.resource.requests, 4)
+        self.assertEqual(self.s3.get('mybucket', 'my/key')[0], 'abc')
+
+    def test_abort(self):
+        upload_id = self.s3.initiate('mybucket', 'mykey')
+        request = self._request('DELETE', 'mybucket/mykey',
+                                {'uploadId': upload_id})
+        self.assertEqual(request.responseCode, 204)
+        self.failIf(self.s3.uploads)
+        request = self._request('DELETE', 'mybucket/mykey',
+                                {'uploadId': upload_id})
+        self.assertEqual(request.responseCode, 404)
+        self.assertEqual(XML(self._body(request)).findtext('Code'),
+                         'NoSuchUpload')
+
+    def test_put_and_get(self):
+        request = self._request('PUT', 'mybucket/mykey', body='0123456789')
+        etag = request.responseHeaders.getRawHeaders('etag')
+        request = self._request('GET', 'mybucket/mykey')
+        self.assertEqual(self._body(request), '0123456789')
+        self.assertEqual(request.responseHeaders.getRawHeaders('etag'), etag)
+        self.assertEqual(request.responseCode, None)
+
+    def test_range_get(self):
+        self.s3.put('mybucket', 'mykey', '0123456789')
+        for (header, body, content_range) in [
+                ('bytes=2-4', '234', 'bytes 2-4/10'),
+                ('bytes=7-', '789', 'bytes 7-9/10'),
+                ('bytes=-2', '89', 'bytes 8-9/10'),
+                ('bytes=8-20', '89', 'bytes 8-9/10')]:
+            request = self._request('GET', 'mybucket/mykey',
+                                    headers={'range': header})
+            self.assertEqual(request.responseCode, 206)
+            self.assertEqual(self._body(request), body)
+            self.assertEqual(
+                request.responseHeaders.getRawHeaders('content-range'),
+                [content_range])
+        for header in ['bytes=10-', 'bytes=5-2', 'lines=1-2', 'bytes=x-']:
+            request = self._request('GET', 'mybucket/mykey',
+                                    headers={'range': header})
+            self.assertEqual(request.responseCode, 416)
+
+    def test_errors(self):
+        self.faults.random = lambda: 0.5
+        self.faults.error_rate = 0.6
+        request = self._request('PUT', 'mybucket/mykey', body='data')
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(XML(self._body(request)).findtext('Code'),
+                         'InternalError')
+        self.faults.error_rate = 0
+        self.faults.throttle_rate = 0.6
+        request = self._request('PUT', 'mybucket/mykey', body='data')
+        self.assertEqual(request.responseCode, 503)
+        self.failIf(self.s3.buckets)
+
+    def test_reset(self):
+        self.faults.random = lambda: 0.5
+        self.faults.reset_rate = 0.6
+        request = DummyRequest(['mybucket', 'mykey'])
+        request.method = 'PUT'
+        request.content = StringIO('data')
+        request.transport = StringTransport()
+        self.resource.render(request)
+        self.clock.advance(1)
+        self.assert_(request.transport.disconnecting)
+        self.failIf(request.written)
+        self.failIf(self.s3.buckets)
+
+    def test_client_gone(self):
+        request = DummyRequest(['mybucket', 'mykey'])
+        request.method = 'PUT'
+        request.content = StringIO('data')
+        self.resource.render(request)
+        request.processingFailed(Exception('gone'))
+        self.failIf(self.clock.getDelayedCalls())
+
+    def test_not_an_object(self):
+        request = self._request('GET', 'mybucket/')
+        self.assertEqual(request.responseCode, 501)
+
+
+class FakeS3ServerTestCase(TestCase):
+
+    def setUp(self):
+        self.s3 = FakeS3()
+        site = Site(FakeS3Resource(self.s3))
+        self.port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.region = AWSServiceRegion(creds=AWSCredentials('key', 'secret'),
+            s3_uri='http://127.0.0.1:%d/' % self.port.getHost().port)
+
+    def test_put_and_get(self):
+        manager = MultipartUploadsManager(log=FakeLog(), region=self.region,
+                                          single_put_threshold=100)
+        d = manager.upload(StringIO('0123456789'), 'mybucket', 'mykey')
+
+        def check(task):
+            self.assertEqual(self.s3.get('mybucket', 'mykey')[0],
+                             '0123456789')
+            client = self.region.get_s3_client()
+            return client.get_object('mybucket', 'mykey')
+
+        d.addCallback(check)
+        return d.addCallback(self.assertEqual, '0123456789')
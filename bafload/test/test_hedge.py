@@ -0,0 +1,173 @@
+from zope.interface import implements
+from zope.interface.verify import verifyClass, verifyObject
+
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from bafload.interfaces import IPartHandler
+from bafload.hedge import HedgingPartHandler
+from bafload.producers import FileRangeBodyProducer
+from bafload.throttle import MaxConcurrentThrottler
+from bafload.up import SingleProcessPartUploader
+from bafload.test.util import FakeLog
+
+
+class SlowPartHandler(object):
+    """
+    Part handler whose uploads finish when the test fires them.
+    """
+    implements(IPartHandler)
+
+    bucket = None
+    object_name = None
+    upload_id = None
+    client = None
+
+    def __init__(self):
+        self.calls = []
+        self.cancelled = []
+        self.parts = []
+
+    def set_log(self, log):
+        pass
+
+    def handle_part(self, part, part_number):
+        d = Deferred(lambda d: self.cancelled.append(part_number))
+        self.calls.append((part_number, d))
+        self.parts.append(part)
+        return d
+
+    def finish(self, index, etag='etag'):
+        (part_number, d) = self.calls[index]
+        d.callback((part_number, etag))
+
+
+class HedgingPartHandlerTestCase(TestCase):
+
+    def setUp(self):
+        super(HedgingPartHandlerTestCase, self).setUp()
+        self.clock = Clock()
+        self.slow = SlowPartHandler()
+        self.handler = HedgingPartHandler(self.slow, percentile=0.5,
+            min_samples=3, clock=self.clock, log=FakeLog())
+
+    def _warm_up(self, durations=(1, 2, 3)):
+        for (i, duration) in enumerate(durations):
+            self.handler.handle_part('x', i + 1)
+            self.clock.advance(duration)
+            self.slow.finish(-1)
+
+    def test_iface(self):
+        verifyClass(IPartHandler, HedgingPartHandler)
+        verifyObject(IPartHandler, self.handler)
+
+    def test_forwards_attributes(self):
+        uploader = SingleProcessPartUploader()
+        handler = HedgingPartHandler(uploader, clock=self.clock)
+        handler.bucket = 'mybucket'
+        handler.upload_id = '1234'
+        self.assertEqual(uploader.bucket, 'mybucket')
+        self.assertEqual(handler.upload_id, '1234')
+
+    def test_deadline(self):
+        self.assertIdentical(self.handler.deadline(), None)
+        self._warm_up((3, 1, 2))
+        self.assertEqual(self.handler.durations, [1, 2, 3])
+        self.assertEqual(self.handler.deadline(), 2)
+        self.handler.factor = 1.5
+        self.assertEqual(self.handler.deadline(), 3)
+
+    def test_window(self):
+        self.handler = HedgingPartHandler(self.slow, percentile=0.5,
+            min_samples=10, window=3, clock=self.clock, log=FakeLog())
+        self._warm_up((3, 1, 2, 5, 4))
+        self.assertEqual(self.handler.durations, [2, 4, 5])
+        self.handler.min_samples = 3
+        self.assertEqual(self.handler.deadline(), 4)
+
+    def test_no_hedge_before_deadline(self):
+        self._warm_up()
+        results = []
+        self.handler.handle_part('x', 4).addCallback(results.append)
+        self.clock.advance(1.5)
+        self.slow.finish(3)
+        self.assertEqual(results, [(4, 'etag')])
+        self.clock.advance(10)
+        self.assertEqual(len(self.slow.calls), 4)
+        self.failIf(self.handler.hedged)
+
+    def test_hedge_wins(self):
+        self._warm_up()
+        results = []
+        self.handler.handle_part('x', 4).addCallback(results.append)
+        self.clock.advance(2)
+        self.assertEqual(len(self.slow.calls), 5)
+        self.assertEqual(self.handler.hedged, 1)
+        self.slow.finish(4, 'hedged')
+        self.assertEqual(results, [(4, 'hedged')])
+        self.assertEqual(self.slow.cancelled, [4])
+
+    def test_hedge_copies_part(self):
+        self._warm_up()
+        part = FileRangeBodyProducer(None, 0, 10)
+        self.handler.handle_part(part, 4)
+        self.clock.advance(2)
+        (first, second) = self.slow.parts[3:]
+        self.assertIdentical(first, part)
+        self.assertIsInstance(second, FileRangeBodyProducer)
+        self.assertNotIdentical(second, part)
+        self.assertEqual((second.offset, second.length), (0, 10))
+
+    def test_hedge_throttled(self):
+        self._warm_up()
+        throttler = MaxConcurrentThrottler(1)
+        self.handler.throttler = throttler
+        results = []
+        # The first upload of the part holds the throttler's only slot.
+        throttler.throttle(self.handler.handle_part, 'x', 4).addCallback(
+            results.append)
+        self.clock.advance(2)
+        self.assertEqual(self.handler.hedged, 1)
+        self.assertEqual(len(self.slow.calls), 4)
+        self.assertEqual(throttler.waiting, 1)
+        self.slow.finish(3, 'original')
+        self.assertEqual(results, [(4, 'original')])
+        self.assertEqual(len(self.slow.calls), 4)
+        self.failIf(throttler.pending)
+
+    def test_original_wins(self):
+        self._warm_up()
+        results = []
+        self.handler.handle_part('x', 4).addCallback(results.append)
+        self.clock.advance(2)
+        self.slow.finish(3, 'original')
+        self.assertEqual(results, [(4, 'original')])
+        self.assertEqual(self.slow.cancelled, [4])
+
+    def test_failure_waits_for_other_upload(self):
+        self._warm_up()
+        results = []
+        self.handler.handle_part('x', 4).addCallback(results.append)
+        self.clock.advance(2)
+        self.slow.calls[3][1].errback(ValueError())
+        self.failIf(results)
+        self.slow.finish(4, 'hedged')
+        self.assertEqual(results, [(4, 'hedged')])
+
+    def test_failure(self):
+        self._warm_up()
+        d = self.handler.handle_part('x', 4)
+        self.clock.advance(2)
+        self.slow.calls[3][1].errback(ValueError())
+        self.slow.calls[4][1].errback(ValueError())
+        self.failIf(self.clock.getDelayedCalls())
+        return self.assertFailure(d, ValueError)
+
+    def test_cancel(self):
+        self._warm_up()
+        d = self.handler.handle_part('x', 4)
+        self.clock.advance(2)
+        d.cancel()
+        self.assertEqual(self.slow.cancelled, [4, 4])
+        return self.assertFailure(d, CancelledError)
@@ -0,0 +1,145 @@
+import os
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from bafload.journal import file_identity, UploadJournal, JournalDirectory
+
+
+class FileIdentityTestCase(TestCase):
+
+    def test_file(self):
+        path = self.mktemp()
+        with open(path, 'wb') as fd:
+            fd.write('x' * 20)
+        with open(path, 'rb') as fd:
+            identity = file_identity(fd)
+        st = os.stat(path)
+        self.assertEqual(identity, {'size': 20, 'name': os.path.abspath(path),
+            'device': st.st_dev, 'inode': st.st_ino, 'mtime': st.st_mtime})
+
+    def test_stringio(self):
+        self.assertEqual(file_identity(StringIO('x' * 7)), {'size': 7})
+
+    def test_unknown(self):
+        self.assertEqual(file_identity(object()), {'size': None})
+
+
+class UploadJournalTestCase(TestCase):
+
+    def setUp(self):
+        super(UploadJournalTestCase, self).setUp()
+        self.path = self.mktemp()
+        self.identity = {'size': 100, 'bucket': 'mybucket',
+                         'object_name': 'mykey', 'mtime': 1349971200.25}
+
+    def _journal(self, identity=None):
+        if identity is None:
+            identity = self.identity
+        journal = UploadJournal(self.path, identity, sync=False)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_load_missing(self):
+        self.failIf(self._journal().load())
+
+    def test_round_trip(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.record_part(1, '"etag1"')
+        journal.record_part(3, '"etag3"')
+        journal.close()
+        journal = self._journal()
+        self.assert_(journal.load())
+        self.assertEqual(journal.upload_id, 'upload-1')
+        self.assertEqual(journal.part_size, 10)
+        self.assertEqual(journal.parts, {1: '"etag1"', 3: '"etag3"'})
+
+    def test_record_after_load(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.record_part(1, '"etag1"')
+        journal.close()
+        journal = self._journal()
+        journal.load()
+        journal.record_part(2, '"etag2"')
+        journal.close()
+        journal = self._journal()
+        journal.load()
+        self.assertEqual(journal.parts, {1: '"etag1"', 2: '"etag2"'})
+
+    def test_identity_mismatch(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.close()
+        identity = dict(self.identity, size=101)
+        journal = self._journal(identity)
+        self.failIf(journal.load())
+        self.assertIdentical(journal.upload_id, None)
+
+    def test_start_replaces(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.record_part(1, '"etag1"')
+        journal.start('upload-2', 20)
+        journal.close()
+        journal = self._journal()
+        journal.load()
+        self.assertEqual(journal.upload_id, 'upload-2')
+        self.assertEqual(journal.parts, {})
+
+    def test_replace_parts(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.record_part(1, '"etag1"')
+        journal.close()
+        journal = self._journal()
+        journal.load()
+        journal.replace_parts({2: '"etag2"', 3: '"etag3"'})
+        self.assertEqual(journal.parts, {2: '"etag2"', 3: '"etag3"'})
+        journal.record_part(4, '"etag4"')
+        journal.close()
+        journal = self._journal()
+        self.assert_(journal.load())
+        self.assertEqual(journal.upload_id, 'upload-1')
+        self.assertEqual(journal.part_size, 10)
+        self.assertEqual(journal.parts, {2: '"etag2"', 3: '"etag3"',
+                                         4: '"etag4"'})
+
+    def test_torn_record(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.record_part(1, '"etag1"')
+        journal.close()
+        with open(self.path, 'ab') as fd:
+            fd.write('{"etag": "\\"et')
+        journal = self._journal()
+        self.assert_(journal.load())
+        self.assertEqual(journal.parts, {1: '"etag1"'})
+        journal.record_part(2, '"etag2"')
+        journal.close()
+        journal = self._journal()
+        journal.load()
+        self.assertEqual(journal.parts, {1: '"etag1"', 2: '"etag2"'})
+
+    def test_finish(self):
+        journal = self._journal()
+        journal.start('upload-1', 10)
+        journal.finish()
+        self.failIf(os.path.exists(self.path))
+
+
+class JournalDirectoryTestCase(TestCase):
+
+    def test_journal_for(self):
+        path = self.mktemp()
+        journals = JournalDirectory(path)
+        self.assert_(os.path.isdir(path))
+        first = journals.journal_for(StringIO('x'), 'mybucket', 'mykey')
+        again = journals.journal_for(StringIO('x'), 'mybucket', 'mykey')
+        other = journals.journal_for(StringIO('x'), 'mybucket', 'other')
+        self.assertEqual(os.path.dirname(first.path), path)
+        self.assertEqual(first.path, again.path)
+        self.assertNotEqual(first.path, other.path)
+        self.assertEqual(first.identity, {'size': 1, 'bucket': 'mybucket',
+                                          'object_name': 'mykey'})
@@ -0,0 +1,130 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Cooperator
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from bafload.metrics import MetricsResource
+from bafload.pool import ClientPool
+from bafload.stats import SlidingStats, ThroughputCounter, LatencyStats
+from bafload.throttle import FairThrottler, ByteRateThrottler
+from bafload.up import MultipartUploadsManager
+from bafload.test.util import FakeClock, FakeLog
+
+
+class MetricsResourceTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100)
+        counter = ThroughputCounter(self.clock,
+                                    SlidingStats(100, 1, 100))
+        self.latencies = LatencyStats()
+        self.manager = MultipartUploadsManager(log=FakeLog(),
+            throughput_counter=counter, latencies=self.latencies,
+            throttler=FairThrottler(throttler=ByteRateThrottler(
+                1000, clock=self.clock)))
+        self.resource = MetricsResource(self.manager, windows=(1, 10),
+                                        quantiles=(0.9, 0.5))
+        self.scheduled = []
+        self.resource.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+
+    def _run_scheduled(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+    def _render(self):
+        request = DummyRequest([''])
+        self.assertEqual(self.resource.render_GET(request), NOT_DONE_YET)
+        self._run_scheduled()
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                         ['text/plain; version=0.0.4'])
+        return ''.join(request.written).splitlines()
+
+    def _samples(self, lines):
+        return dict(line.rsplit(' ', 1) for line in lines
+                    if not line.startswith('#'))
+
+    def test_render(self):
+        counter = self.manager.throughput_counter
+        counter.start_entity('a')
+        self.clock.tick(5)
+        counter.stop_entity('a', 500)
+        self.latencies.event('init', 0, 0.5, attempt=1, queued=0)
+        self.latencies.event('init', 1, 1.5, attempt=2, queued=0,
+                             error='woops')
+        lines = self._render()
+        self.assertIn('# TYPE bafload_uploads_active gauge', lines)
+        self.assertIn('# TYPE bafload_latency_seconds summary', lines)
+        samples = self._samples(lines)
+        self.assertEqual(samples['bafload_uploads_active'], '0.0')
+        self.assertEqual(samples['bafload_bytes_in_flight'], '0.0')
+        self.assertEqual(samples[
+            'bafload_throughput_bytes_per_second{window="1s"}'], '100.0')
+        self.assertEqual(samples[
+            'bafload_throughput_bytes_per_second{window="10s"}'], '50.0')
+        self.assertEqual(samples[
+            'bafload_throttler_running{throttler="FairThrottler"}'], '0.0')
+        self.assertEqual(samples[
+            'bafload_throttler_waiting{throttler="ByteRateThrottler"}'],
+            '0.0')
+        self.assertAlmostEqual(float(samples[
+            'bafload_latency_seconds{phase="init",quantile="0.5"}']), 0.5, 2)
+        self.assertAlmostEqual(float(samples[
+            'bafload_latency_seconds{phase="init",quantile="0.9"}']), 1.5, 2)
+        self.assertEqual(samples[
+            'bafload_latency_seconds_count{phase="init"}'], '2.0')
+        self.assertEqual(samples[
+            'bafload_latency_seconds_sum{phase="init"}'], '2.0')
+        self.assertEqual(samples['bafload_retries_total{phase="init"}'],
+                         '1.0')
+        self.assertEqual(samples['bafload_failures_total{phase="init"}'],
+                         '1.0')
+        self.failIf([key for key in samples if 'connection_pool' in key])
+
+    def test_throttler_running(self):
+        throttler = self.manager.throttler
+        throttler.max = 2
+        for i in range(3):
+            throttler.throttle(Deferred)
+        samples = self._samples(self._render())
+        self.assertEqual(samples[
+            'bafload_throttler_running{throttler="FairThrottler"}'], '2.0')
+        self.assertEqual(samples[
+            'bafload_throttler_waiting{throttler="FairThrottler"}'], '1.0')
+
+    def test_connection_pool(self):
+        self.manager.clients = ClientPool(self.manager.region)
+        self.manager.clients.connections.hits = 3
+        samples = self._samples(self._render())
+        self.assertEqual(samples['bafload_connection_pool_hits_total'],
+                         '3.0')
+        self.assertEqual(samples['bafload_connection_pool_misses_total'],
+                         '0.0')
+
+    def test_empty_histogram(self):
+        self.latencies.histogram('complete')
+        samples = self._samples(self._render())
+        self.assertEqual(samples[
+            'bafload_latency_seconds{phase="complete",quantile="0.5"}'],
+            'NaN')
+
+    def test_one_family_per_iteration(self):
+        request = DummyRequest([''])
+        self.resource.render_GET(request)
+        self.scheduled.pop(0)()
+        self.assertEqual(len(request.written), 1)
+        self.failIf(request.finished)
+
+    def test_client_gone(self):
+        request = DummyRequest([''])
+        self.resource.render_GET(request)
+        self.scheduled.pop(0)()
+        request.processingFailed(Failure(ConnectionDone()))
+        self._run_scheduled()
+        self.assertEqual(len(request.written), 1)
+        self.failIf(request.finished)
@@ -0,0 +1,179 @@
+from zope.interface.verify import verifyClass, verifyObject
+
+from twisted.internet.defer import succeed
+from twisted.protocols import amp
+from twisted.protocols.loopback import loopbackAsync
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceRegion
+
+from bafload.interfaces import IPartHandler
+from bafload.multiproc import (UploadPart, PartUploaderWorker, WorkerPool,
+    MultiProcessPartUploader)
+from bafload.producers import FileRangeBodyProducer
+from bafload.test.util import FakeS3Client, FakeLog
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, command, **kw):
+        self.calls.append((command, kw))
+        return succeed({'etag': '"abc"'})
+
+
+class FakeProcessTransport(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.written = []
+        self.stdin_closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, data):
+        self.written.append(''.join(data))
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+
+class FakeReactor(object):
+
+    def __init__(self):
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env):
+        self.spawned.append((protocol, executable, args, env))
+        protocol.makeConnection(FakeProcessTransport(len(self.spawned)))
+
+
+class MultiProcessPartUploaderTestCase(TestCase):
+
+    def test_iface(self):
+        verifyClass(IPartHandler, MultiProcessPartUploader)
+        verifyObject(IPartHandler, MultiProcessPartUploader())
+
+    def test_handle_part(self):
+        path = self.mktemp()
+        with open(path, 'wb') as fd:
+            fd.write('x' * 30)
+        fd = open(path, 'rb')
+        self.addCleanup(fd.close)
+        pool = FakePool()
+        handler = MultiProcessPartUploader(pool)
+        handler.bucket = 'mybucket'
+        handler.object_name = 'mykey'
+        handler.upload_id = 'theupload'
+
+        def check(result):
+            self.assertEqual(result, (2, '"abc"'))
+            self.assertEqual(pool.calls, [(UploadPart, {
+                'path': path, 'offset': 10, 'length': 10,
+                'bucket': 'mybucket', 'object_name': 'mykey',
+                'upload_id': 'theupload', 'part_number': 2})])
+
+        d = handler.handle_part(FileRangeBodyProducer(fd, 10, 10), 2)
+        return d.addCallback(check)
+
+
+class PartUploaderWorkerTestCase(TestCase):
+
+    def setUp(self):
+        super(PartUploaderWorkerTestCase, self).setUp()
+        self.path = self.mktemp()
+        with open(self.path, 'wb') as fd:
+            fd.write('a' * 10 + 'b' * 10 + 'c' * 5)
+        self.client = FakeS3Client()
+
+    def test_upload_part(self):
+        worker = PartUploaderWorker(self.client)
+
+        def check(response):
+            self.assertEqual(response, {'etag': '"0123456789"'})
+            self.assertEqual(self.client.calls, [('upload_part', 'mybucket',
+                'mykey', 'theupload', 3, 'bbbbbccccc', None)])
+
+        d = worker.upload_part(self.path, 15, 10, 'mybucket', 'mykey',
+                               'theupload', 3)
+        return d.addCallback(check)
+
+    def test_upload_part_over_amp(self):
+        disconnected = []
+        worker = PartUploaderWorker(self.client,
+            on_disconnect=lambda: disconnected.append(True))
+        parent = amp.AMP()
+        finished = loopbackAsync(worker, parent)
+        responses = []
+
+        def respond(response):
+            responses.append(response)
+            parent.transport.loseConnection()
+
+        parent.callRemote(UploadPart, path=self.path, offset=0, length=10,
+            bucket='mybucket', object_name='mykey', upload_id='theupload',
+            part_number=1).addCallback(respond)
+
+        def check(ignore):
+            self.assertEqual(responses, [{'etag': '"0123456789"'}])
+            self.assertEqual(self.client.calls[0][5], 'a' * 10)
+            self.assertEqual(disconnected, [True])
+
+        return finished.addCallback(check)
+
+
+class WorkerPoolTestCase(TestCase):
+
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+        self.reactor = FakeReactor()
+        self.log = FakeLog()
+        region = AWSServiceRegion(creds=AWSCredentials('key', 'secret'),
+                                  s3_uri='http://localhost:9000/')
+        self.pool = WorkerPool(region, size=2, executable='/bin/python',
+                               reactor=self.reactor, log=self.log)
+
+    def test_start(self):
+        self.pool.start()
+        self.assertEqual(len(self.pool.workers), 2)
+        (protocol, executable, args, env) = self.reactor.spawned[0]
+        self.assertEqual(executable, '/bin/python')
+        self.assertEqual(args, ['/bin/python', '-m',
+            'bafload.scripts.partworker', 'http://localhost:9000/'])
+        self.assertEqual(env['AWS_ACCESS_KEY_ID'], 'key')
+        self.assertEqual(env['AWS_SECRET_ACCESS_KEY'], 'secret')
+
+    def test_dispatch_to_least_busy(self):
+        self.pool.start()
+        (first, second) = self.pool.workers
+        kw = dict(path='/x', offset=0, length=1, bucket='b',
+                  object_name='k', upload_id='u', part_number=1)
+        for _ in range(3):
+            self.pool.callRemote(UploadPart, **kw)
+        self.assertEqual((first.pending, second.pending), (2, 1))
+        self.assertEqual(len(first.transport.written), 2)
+
+    def test_restart_worker(self):
+        self.pool.start()
+        worker = self.pool.workers[0]
+        worker.processEnded(Failure(Exception('killed')))
+        self.assertEqual(len(self.pool.workers), 2)
+        self.assertEqual(len(self.reactor.spawned), 3)
+        self.assertNotIn(worker, self.pool.workers)
+        self.assertTrue(self.log.buffer)
+
+    def test_stop(self):
+        self.pool.start()
+        workers = list(self.pool.workers)
+        d = self.pool.stop()
+        for worker in workers:
+            self.assertTrue(worker.transport.stdin_closed)
+            worker.processEnded(Failure(Exception('done')))
+        self.assertEqual(self.pool.workers, [])
+        self.assertEqual(len(self.reactor.spawned), 2)
+        return d
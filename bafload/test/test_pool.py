@@ -0,0 +1,116 @@
+from twisted.internet.defer import succeed, fail
+from twisted.internet.endpoints import TCP4ClientEndpoint, SSL4ClientEndpoint
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.client import URI
+
+from txaws.service import AWSServiceRegion
+
+from bafload.pool import MeteredConnectionPool, ClientPool
+
+
+class FakeEndpoint(object):
+
+    def __init__(self, refuse=False):
+        self.refuse = refuse
+        self.connected = []
+
+    def connect(self, factory):
+        if self.refuse:
+            return fail(ConnectionRefusedError())
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        self.connected.append(protocol)
+        return succeed(protocol)
+
+
+class FakeEndpointFactory(object):
+
+    def __init__(self):
+        self.endpoint = FakeEndpoint()
+        self.uris = []
+
+    def endpointForURI(self, uri):
+        self.uris.append(uri)
+        return self.endpoint
+
+
+class MeteredConnectionPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = MeteredConnectionPool(self.clock)
+        self.pool.maxPersistentPerHost = 2
+        self.endpoint = FakeEndpoint()
+        self.key = ('https', 'example.com', 443)
+
+    def test_warm(self):
+        self.pool.warm(self.key, self.endpoint, 3)
+        self.assertEqual(len(self.endpoint.connected), 2)
+        self.assertEqual(self.pool.idle(self.key), 2)
+        self.assertEqual(self.pool.warmed, 2)
+        self.pool.warm(self.key, self.endpoint, 2)
+        self.assertEqual(len(self.endpoint.connected), 2)
+
+    def test_warm_failure(self):
+        self.endpoint.refuse = True
+        self.pool.warm(self.key, self.endpoint, 2)
+        self.failIf(self.pool.idle(self.key))
+        self.failIf(self.pool.warmed)
+        self.assertEqual(self.pool._warming, {})
+
+    def test_hits_and_misses(self):
+        self.assertIdentical(self.pool.hit_ratio, None)
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual((self.pool.hits, self.pool.misses), (0, 1))
+        self.pool.warm(self.key, self.endpoint, 1)
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+        self.assertEqual(self.pool.hit_ratio, 0.5)
+        self.assertEqual(len(self.endpoint.connected), 2)
+
+
+class ClientPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.region = AWSServiceRegion()
+        self.endpoints = FakeEndpointFactory()
+        self.clients = ClientPool(self.region, 3,
+                                  endpoint_factory=self.endpoints,
+                                  reactor=Clock())
+
+    def test_size(self):
+        self.assertEqual(self.clients.size, 3)
+        self.assertEqual(self.clients.connections.maxPersistentPerHost, 3)
+
+    def test_client_for(self):
+        client = self.clients.client_for('mybucket')
+        self.assertIdentical(client.agent, self.clients.agent)
+        self.assertIdentical(client.creds, self.region.creds)
+        self.assertIdentical(self.clients.client_for('mybucket'), client)
+        self.assertNotIdentical(self.clients.client_for('other'), client)
+
+    def test_warm(self):
+        self.clients.warm(2)
+        self.assertEqual(self.endpoints.uris[0].host, 's3.amazonaws.com')
+        key = ('https', 's3.amazonaws.com', 443)
+        self.assertEqual(self.clients.connections.idle(key), 2)
+        self.clients.warm()
+        self.assertEqual(self.clients.connections.idle(key), 3)
+
+    def test_default_endpoint_factory(self):
+        clients = ClientPool(self.region, reactor=Clock())
+        endpoint = clients.endpoint_factory.endpointForURI(
+            URI.fromBytes('https://s3.amazonaws.com/'))
+        self.assertIsInstance(endpoint, SSL4ClientEndpoint)
+        endpoint = clients.endpoint_factory.endpointForURI(
+            URI.fromBytes('http://localhost:8080/'))
+        self.assertIsInstance(endpoint, TCP4ClientEndpoint)
+
+    def test_close(self):
+        self.clients.warm()
+        self.clients.close()
+        key = ('https', 's3.amazonaws.com', 443)
+        self.failIf(self.clients.connections.idle(key))
@@ -0,0 +1,133 @@
+from StringIO import StringIO
+
+from zope.interface.verify import verifyClass, verifyObject
+
+from twisted.internet.task import Cooperator, TaskStopped
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.iweb import IBodyProducer
+
+from bafload.interfaces import IByteLength
+from bafload.producers import FileRangeBodyProducer
+
+
+class FileRangeBodyProducerTestCase(TestCase):
+
+    def setUp(self):
+        super(FileRangeBodyProducerTestCase, self).setUp()
+        self.scheduled = []
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+        self.fd = StringIO("abcdefghijklmnopqrstuvwxyz")
+
+    def _producer(self, offset, length):
+        return FileRangeBodyProducer(self.fd, offset, length,
+                                     cooperator=self.cooperator, read_size=3)
+
+    def _step(self):
+        if self.scheduled:
+            self.scheduled.pop(0)()
+
+    def _drain(self):
+        for _ in range(100):
+            self._step()
+
+    def test_iface(self):
+        verifyClass(IBodyProducer, FileRangeBodyProducer)
+        verifyObject(IBodyProducer, self._producer(0, 1))
+
+    def test_byte_length(self):
+        self.assertEqual(IByteLength(self._producer(4, 11)), 11)
+
+    def test_produce_range(self):
+        consumer = StringTransport()
+        producer = self._producer(4, 11)
+        finished = []
+        producer.startProducing(consumer).addCallback(finished.append)
+        self._drain()
+        self.assertEqual(consumer.value(), "efghijklmno")
+        self.assertEqual(finished, [None])
+
+    def test_writes_bounded_by_read_size(self):
+        writes = []
+
+        class Consumer(object):
+            write = writes.append
+
+        self._producer(0, 8).startProducing(Consumer())
+        self._drain()
+        self.assertEqual(writes, ["abc", "def", "gh"])
+
+    def test_produce_again_rereads(self):
+        producer = self._producer(20, 6)
+        for _ in range(2):
+            consumer = StringTransport()
+            producer.startProducing(consumer)
+            self._drain()
+            self.assertEqual(consumer.value(), "uvwxyz")
+
+    def test_shared_file(self):
+        first = StringTransport()
+        second = StringTransport()
+        self._producer(0, 6).startProducing(first)
+        self._producer(10, 6).startProducing(second)
+        self._drain()
+        self.assertEqual(first.value(), "abcdef")
+        self.assertEqual(second.value(), "klmnop")
+
+    def test_copy(self):
+        producer = self._producer(20, 6)
+        copy = producer.copy()
+        self.assertNotIdentical(copy, producer)
+        first = StringTransport()
+        second = StringTransport()
+        producer.startProducing(first)
+        copy.startProducing(second)
+        self._drain()
+        self.assertEqual(first.value(), "uvwxyz")
+        self.assertEqual(second.value(), "uvwxyz")
+
+    def test_pause_resume(self):
+        consumer = StringTransport()
+        producer = self._producer(0, 9)
+        producer.startProducing(consumer)
+        self._step()
+        producer.pauseProducing()
+        self._drain()
+        written = consumer.value()
+        self.assertNotEqual(written, "abcdefghi")
+        producer.resumeProducing()
+        self._drain()
+        self.assertEqual(consumer.value(), "abcdefghi")
+
+    def test_stop_producing(self):
+        consumer = StringTransport()
+        producer = self._producer(0, 9)
+        d = producer.startProducing(consumer)
+        producer.stopProducing()
+        self._drain()
+        self.assertEqual(consumer.value(), "")
+        return self.assertFailure(d, TaskStopped)
+
+    def test_stopped_while_writing(self):
+        writes = []
+        producer = self._producer(0, 9)
+
+        class Consumer(object):
+
+            def write(self, data):
+                # A lost connection stops the producer from within write.
+                writes.append(data)
+                producer.stopProducing()
+
+        d = producer.startProducing(Consumer())
+        self._drain()
+        self.assertEqual(writes, ["abc"])
+        return self.assertFailure(d, TaskStopped)
+
+    def test_short_file(self):
+        consumer = StringTransport()
+        d = self._producer(20, 10).startProducing(consumer)
+        self._drain()
+        return self.assertFailure(d, IOError)
@@ -0,0 +1,94 @@
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+
+from bafload.interfaces import ITransmissionCounter
+from bafload.progress import ProgressReporter
+from bafload.test.util import FakeClock, FakeLog
+
+
+class ProgressReporterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(100)
+        self.log = FakeLog()
+        self.reporter = ProgressReporter(interval=5, smoothing=10,
+                                         clock=self.clock, log=self.log)
+
+    def _lines(self):
+        return [message[0] for (kind, message, kw) in self.log.buffer]
+
+    def test_counter_iface(self):
+        counter = self.reporter.counter(2)
+        verifyObject(ITransmissionCounter, counter)
+        self.assertEqual(counter.expected, 2)
+        self.failIf(counter.receiving)
+
+    def test_totals(self):
+        a = self.reporter.counter(2)
+        a.expected_bytes = 200
+        b = self.reporter.counter('?')
+        self.assertEqual(self.reporter.expected_parts, 2)
+        self.assertEqual(self.reporter.unsized, 1)
+        self.clock.tick(1)
+        a.increment_count(100)
+        b.increment_count(50)
+        self.assertEqual((a.completed, a.bytes), (1, 100))
+        self.assertEqual((b.completed, b.bytes), (1, 50))
+        self.assertEqual((self.reporter.parts, self.reporter.bytes), (2, 150))
+        self.assertIdentical(self.reporter.eta, None)
+        b.expected_bytes = 50
+        self.assertEqual(self.reporter.unsized, 0)
+        self.assertEqual(self.reporter.expected_bytes, 250)
+
+    def test_resumed(self):
+        counter = self.reporter.counter(4)
+        counter.completed = 3
+        self.assertEqual(self.reporter.parts, 3)
+        counter.increment_count(10)
+        self.assertEqual(counter.completed, 4)
+        self.assertEqual(self.reporter.parts, 4)
+
+    def test_rate(self):
+        counter = self.reporter.counter(10)
+        self.clock.tick(2)
+        counter.increment_count(200)
+        self.assertEqual(self.reporter.rate, 100)
+        # Parts completing at the same time are rated with the next.
+        counter.increment_count(100)
+        self.assertEqual(self.reporter.rate, 100)
+        self.clock.tick(10)
+        counter.increment_count(100)
+        self.assertAlmostEqual(self.reporter.rate,
+                               100 + (1 - 1 / 2.718281828459045) * -80)
+
+    def test_eta(self):
+        counter = self.reporter.counter(4)
+        counter.expected_bytes = 400
+        self.assertIdentical(self.reporter.eta, None)
+        self.clock.tick(1)
+        counter.increment_count(100)
+        self.assertEqual(self.reporter.eta, 3)
+        counter.increment_count(300)
+        self.assertEqual(self.reporter.eta, 0)
+
+    def test_rate_limited(self):
+        counter = self.reporter.counter(10)
+        counter.expected_bytes = 10 * 2 ** 20
+        self.clock.tick(1)
+        counter.increment_count(2 ** 20)
+        for i in range(4):
+            self.clock.tick(1)
+            counter.increment_count(2 ** 20)
+        self.assertEqual(self._lines(), [
+            'progress: parts 1/10, 1.0/10.0 MB, 1.00 MB/s, eta 0:00:09'])
+        self.clock.tick(1)
+        counter.increment_count(2 ** 20)
+        self.assertEqual(len(self._lines()), 2)
+        self.assert_(self._lines()[-1].startswith(
+            'progress: parts 6/10, 6.0/10.0 MB, 1.00 MB/s'))
+
+    def test_report(self):
+        self.reporter.counter('?')
+        self.reporter.report()
+        self.assertEqual(self._lines(), ['progress: parts 0/0, 0.0/? MB'])
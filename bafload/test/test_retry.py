@@ -1,9 +1,20 @@
+from zope.interface.verify import verifyObject
+
 from twisted.trial.unittest import TestCase
 from twisted.python.failure import Failure
-from twisted.internet.defer import succeed, fail
+from twisted.internet import error
+from twisted.internet.defer import succeed, fail, Deferred, CancelledError
+from twisted.internet.task import Clock
+from twisted.web.client import ResponseNeverReceived
+from twisted.web.error import Error as WebError
+from twisted.web.http_headers import Headers
+
+from txaws.s3.exception import S3Error
 
 from bafload.test.util import FakeClock, FakeLog
-from bafload.retry import BinaryExponentialBackoff
+from bafload.retry import (BinaryExponentialBackoff, ClassifyingBackoff,
+        IRetryDeferred, is_retryable, retry_after, full_jitter, equal_jitter,
+        decorrelated_jitter)
 
 
 class BinaryExponentialBackoffTestCase(TestCase):
@@ -69,6 +80,188 @@ class BinaryExponentialBackoffTestCase(TestCase):
         d.addErrback(eb)
         return self.assertFailure(d, ValueError)
 
+    def test_cancel_waiting(self):
+        clock = Clock()
+        self.algo.clock = clock
+        d = self.algo.retry(fail, ValueError('woops'))
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        d.cancel()
+        self.failIf(clock.getDelayedCalls())
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_attempt(self):
+        attempt = Deferred()
+        d = self.algo.retry(lambda: attempt)
+        d.cancel()
+        self.assert_(attempt.called)
+        self.failIf(self.clock.calls)
+        self.assertNErrorsLogged(0)
+        return self.assertFailure(d, CancelledError)
+
     def assertNErrorsLogged(self, n):
         error_ct = len([e for e in self.log.buffer if e[0] == 'err'])
         self.assertEquals(error_ct, n)
+
+
+def web_error(status, code=None):
+    if code is None:
+        return WebError(status)
+    xml = ('<Error><Code>%s</Code><Message>m</Message></Error>' % code)
+    return S3Error(xml, status)
+
+
+class IsRetryableTestCase(TestCase):
+
+    def assertRetryable(self, exc, retryable=True):
+        self.assertEqual(is_retryable(Failure(exc)), retryable)
+
+    def test_server_errors(self):
+        self.assertRetryable(web_error('500'))
+        self.assertRetryable(web_error('503', 'SlowDown'))
+        self.assertRetryable(web_error(429))
+
+    def test_retryable_client_errors(self):
+        self.assertRetryable(web_error('400', 'RequestTimeout'))
+        self.assertRetryable(web_error('408'))
+
+    def test_fatal_client_errors(self):
+        self.assertRetryable(web_error('403', 'AccessDenied'), False)
+        self.assertRetryable(web_error('400', 'BadDigest'), False)
+        self.assertRetryable(web_error('404'), False)
+
+    def test_connection_errors(self):
+        self.assertRetryable(error.ConnectionRefusedError())
+        self.assertRetryable(error.TimeoutError())
+        self.assertRetryable(error.ConnectionLost())
+        self.assertRetryable(ResponseNeverReceived([]))
+
+    def test_other_errors(self):
+        self.assertRetryable(ValueError('woops'), False)
+        self.assertRetryable(CancelledError(), False)
+
+
+class RetryAfterTestCase(TestCase):
+
+    def test_no_hint(self):
+        self.assertIdentical(retry_after(Failure(ValueError())), None)
+        self.assertIdentical(retry_after(Failure(web_error('503'))), None)
+
+    def test_attribute(self):
+        exc = web_error('503')
+        exc.retry_after = 3
+        self.assertEqual(retry_after(Failure(exc)), 3)
+
+    def test_headers(self):
+        exc = web_error('503')
+        exc.headers = Headers({'Retry-After': ['5']})
+        self.assertEqual(retry_after(Failure(exc)), 5)
+        exc.headers = {'Retry-After': 'Fri, 31 Dec 1999 23:59:59 GMT'}
+        self.assertIdentical(retry_after(Failure(exc)), None)
+
+
+class JitterTestCase(TestCase):
+
+    def setUp(self):
+        self.backoff = ClassifyingBackoff(base=1, cap=10, clock=FakeClock())
+        self.backoff.scatter = lambda: 0.5
+
+    def test_ceiling(self):
+        self.assertEqual([self.backoff.ceiling(i) for i in range(1, 7)],
+                         [1, 2, 4, 8, 10, 10])
+
+    def test_full_jitter(self):
+        self.assertEqual(full_jitter(self.backoff, 3, None), 2)
+
+    def test_equal_jitter(self):
+        self.assertEqual(equal_jitter(self.backoff, 3, None), 3)
+
+    def test_decorrelated_jitter(self):
+        self.assertEqual(decorrelated_jitter(self.backoff, 1, 0), 1)
+        self.assertEqual(decorrelated_jitter(self.backoff, 2, 3), 5)
+        self.assertEqual(decorrelated_jitter(self.backoff, 3, 10), 10)
+
+
+class ClassifyingBackoffTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.log = FakeLog()
+        self.algo = ClassifyingBackoff(base=1, cap=100, clock=self.clock,
+                                       log=self.log)
+        self.algo.scatter = lambda: 1
+
+    def _failing(self, failures, result='ok'):
+        calls = []
+
+        def f(a, k=0):
+            calls.append((a, k))
+            if failures:
+                return fail(failures.pop(0))
+            return succeed(result)
+
+        return (f, calls)
+
+    def test_iface(self):
+        verifyObject(IRetryDeferred, self.algo)
+
+    def test_retry(self):
+        (f, calls) = self._failing([web_error('500')] * 3)
+
+        def check(result):
+            self.assertEqual(result, 'ok')
+            self.assertEqual(calls, [('a', 45)] * 4)
+            self.assertEqual([c[0] for c in self.clock.calls], [1, 2, 4])
+
+        return self.algo.retry(f, 'a', k=45).addCallback(check)
+
+    def test_fatal(self):
+        (f, calls) = self._failing([web_error('403', 'AccessDenied')])
+
+        def check(why):
+            self.assertEqual(len(calls), 1)
+            self.failIf(self.clock.calls)
+            return why
+
+        d = self.algo.retry(f, 'a')
+        d.addErrback(check)
+        return self.assertFailure(d, S3Error)
+
+    def test_give_up(self):
+        self.algo.max_attempts = 3
+        (f, calls) = self._failing([error.ConnectionLost()] * 5)
+
+        def check(why):
+            self.assertEqual(len(calls), 3)
+            return why
+
+        d = self.algo.retry(f, 'a')
+        d.addErrback(check)
+        return self.assertFailure(d, error.ConnectionLost)
+
+    def test_retry_after(self):
+        exc = web_error('503', 'SlowDown')
+        exc.retry_after = 30
+        (f, calls) = self._failing([exc, web_error('503')])
+
+        def check(result):
+            self.assertEqual([c[0] for c in self.clock.calls], [30, 2])
+
+        return self.algo.retry(f, 'a').addCallback(check)
+
+    def test_cancel(self):
+        clock = Clock()
+        self.algo.clock = clock
+        d = self.algo.retry(fail, error.ConnectionLost())
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        d.cancel()
+        self.failIf(clock.getDelayedCalls())
+        return self.assertFailure(d, CancelledError)
+
+    def test_decorrelated(self):
+        self.algo.jitter = decorrelated_jitter
+        (f, calls) = self._failing([web_error('500')] * 3)
+
+        def check(result):
+            self.assertEqual([c[0] for c in self.clock.calls], [1, 3, 9])
+
+        return self.algo.retry(f, 'a').addCallback(check)
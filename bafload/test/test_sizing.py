@@ -0,0 +1,67 @@
+from zope.interface.verify import verifyClass, verifyObject
+
+from twisted.trial.unittest import TestCase
+
+from bafload.interfaces import IPartSizePolicy
+from bafload.sizing import (PartSizePolicy, MIN_PART_SIZE, MAX_PART_SIZE,
+    MAX_PARTS)
+from bafload.stats import ThroughputCounter
+from bafload.test.util import FakeClock
+
+
+MB = 0x100000
+GB = 0x40000000
+
+
+class PartSizePolicyTestCase(TestCase):
+
+    def test_iface(self):
+        verifyClass(IPartSizePolicy, PartSizePolicy)
+        verifyObject(IPartSizePolicy, PartSizePolicy())
+
+    def test_defaults(self):
+        self.assertEqual(MIN_PART_SIZE, 5 * MB)
+        self.assertEqual(MAX_PART_SIZE, 5 * GB)
+        self.assertEqual(MAX_PARTS, 10000)
+
+    def test_small_object(self):
+        policy = PartSizePolicy()
+        self.assertEqual(policy.part_size_for(4096), 5 * MB)
+        self.assertEqual(policy.part_size_for(40 * GB), 5 * MB)
+
+    def test_unknown_size(self):
+        policy = PartSizePolicy()
+        self.assertEqual(policy.part_size_for([]), 5 * MB)
+
+    def test_part_count_limit(self):
+        policy = PartSizePolicy()
+        size = 100 * GB
+        part_size = policy.part_size_for(size)
+        self.assertEqual(part_size, 11 * MB)
+        self.assert_(size / part_size < MAX_PARTS)
+
+    def test_max_part_size(self):
+        policy = PartSizePolicy(max_parts=10)
+        self.assertEqual(policy.part_size_for(50 * GB), 5 * GB)
+
+    def test_too_large(self):
+        policy = PartSizePolicy(max_parts=10)
+        self.assertRaises(ValueError, policy.part_size_for, 51 * GB)
+
+    def test_alignment(self):
+        policy = PartSizePolicy(min_part_size=10, max_part_size=100,
+                                max_parts=3, alignment=8)
+        self.assertEqual(policy.part_size_for(50), 24)
+        self.assertEqual(policy.part_size_for(299), 100)
+
+    def test_target_part_duration(self):
+        clock = FakeClock()
+        counter = ThroughputCounter(clock)
+        policy = PartSizePolicy(target_part_duration=2,
+                                throughput_counter=counter)
+        self.assertEqual(policy.part_size_for(GB), 5 * MB)
+        counter.start_entity('a')
+        clock.tick(2)
+        counter.stop_entity('a', 20 * MB)
+        self.assertEqual(policy.part_size_for(GB), 20 * MB)
+        self.assertEqual(policy.part_size_for(1000 * GB), 103 * MB)
@@ -1,10 +1,13 @@
+from array import array
+
 from zope.interface.verify import verifyClass, verifyObject
 
 from twisted.trial.unittest import TestCase
 
 from bafload.test.util import FakeClock
-from bafload.interfaces import IThrouputCounter
-from bafload.stats import SlidingStats, ThroughputCounter
+from bafload.interfaces import IThrouputCounter, ITracer
+from bafload.stats import (SlidingStats, ThroughputCounter,
+        ThroughputSummary, LatencyHistogram, LatencyStats)
 
 
 class SlidingStatsTestCase(TestCase):
@@ -47,6 +50,72 @@ class SlidingStatsTestCase(TestCase):
         expected = zip(window, [0] * 99 + [7])
         self.assertEquals(list(stats.slots), expected)
 
+    def test_stale_slots_read_as_zero(self):
+        stats = SlidingStats(10, 1, 10)
+        stats.update(10, 3)
+        stats.update(15, 4)
+        stats.update(20, 5)
+        window = range(11, 21)
+        self.assertEquals(list(stats.slots),
+                          zip(window, [0] * 4 + [4] + [0] * 4 + [5]))
+        stats.update(10, 1)
+        self.assertEquals(stats.slots[-1], (20, 5))
+
+    def test_slots_view(self):
+        stats = SlidingStats(10, 1, 10)
+        stats.update(9, 2)
+        self.assertEquals(len(stats.slots), 10)
+        self.assertEquals(stats.slots[-2], (9, 2))
+        self.assertEquals(stats.slots[7:9], [(8, 0), (9, 2)])
+        self.assertEquals(list(reversed(stats.slots))[1], (9, 2))
+        self.assertRaises(IndexError, stats.slots.__getitem__, 10)
+
+    def test_add_range(self):
+        stats = SlidingStats(10, 1, 10)
+        stats.add_range(12, 14, 2)
+        stats.update(13, 1)
+        stats.add_range(5, 15.5, 0.5)
+        self.assertEquals(stats.last, 15)
+        self.assertEquals(stats.counts().tolist(),
+                          [0.5] * 6 + [2.5, 3.5, 2.5, 0.5])
+        self.failIf(stats._pending)
+        self.failIf(any(stats._deltas) or any(stats._ends))
+
+    def test_add_range_before_window(self):
+        stats = SlidingStats(10, 1, 10)
+        stats.add_range(0, 0.5, 2)
+        stats.add_range(8, 12, 1)
+        stats.update(25, 5)
+        self.assertEquals(list(stats.slots),
+                          zip(range(16, 26), [0] * 9 + [5]))
+
+    def test_pending_ranges_bounded(self):
+        stats = SlidingStats(10, 1, 10)
+        for i in range(10):
+            stats.add_range(9, 10, 1)
+        self.failIf(stats._pending)
+        self.assertEquals(stats.slots[-1], (10, 10))
+
+
+class ThroughputSummaryTestCase(TestCase):
+
+    def test_summary(self):
+        summary = ThroughputSummary(array('d', [0, 0, 4, 0, 8, 2, 0]), 2)
+        self.assertEquals(summary.counts.tolist(), [4, 0, 8, 2])
+        self.assertEquals(summary.elapsed, 8)
+        self.assertEquals(summary.total, 14)
+        self.assertEquals(summary.average, 1.75)
+        self.assertEquals(summary.max, 4)
+        self.assertEquals(summary.min, 0)
+        self.assertEquals(summary.percentile(0.5), 2)
+        self.assertEquals(summary.percentile(1), 4)
+
+    def test_empty(self):
+        summary = ThroughputSummary(array('d', [0, 0]))
+        self.assertEquals((summary.total, summary.average, summary.max,
+                           summary.min, summary.percentile(0.9)),
+                          (0, 0, 0, 0, 0))
+
 
 class ThroughputCounterTestCase(TestCase):
 
@@ -73,6 +142,7 @@ class ThroughputCounterTestCase(TestCase):
         window = map(float, range(1, 51))
         expected = zip(window, [0] * 50)
         self.assertEquals(counter.read(), expected)
+        self.assertIdentical(counter.read(), counter.stats.slots)
         clock.tick(5)
         counter.start_entity('b')
         clock.tick(15)
@@ -91,3 +161,118 @@ class ThroughputCounterTestCase(TestCase):
         expected = zip(window, [0] * 5 + [2] * 5 + [2.5] * 15 + [0.5] * 24
                                + [10.5])
         self.assertEquals(counter.read(), expected)
+
+    def test_summary(self):
+        counter = self._build_counter()
+        counter.start_entity('a')
+        counter.clock.tick(4)
+        counter.stop_entity('a', 40)
+        summary = counter.summary()
+        self.assertEquals(summary.total, 40)
+        self.assertEquals(summary.elapsed, 4)
+        self.assertEquals(summary.max, 10)
+
+    def test_entity_rate(self):
+        counter = self._build_counter()
+        clock = counter.clock
+        self.assertIdentical(counter.entity_rate, None)
+        counter.start_entity('a')
+        clock.tick(2)
+        counter.stop_entity('a', 100)
+        self.assertEquals(counter.entity_rate, 50)
+        counter.start_entity('b')
+        clock.tick(1)
+        counter.stop_entity('b', 100)
+        self.assertEquals(counter.entity_rate, 60)
+        counter.start_entity('c')
+        counter.stop_entity('c', 100)
+        self.assertEquals(counter.entity_rate, 60)
+
+
+class LatencyHistogramTestCase(TestCase):
+
+    def setUp(self):
+        self.histogram = LatencyHistogram()
+
+    def test_empty(self):
+        self.assertIdentical(self.histogram.percentile(0.5), None)
+        self.assertIdentical(self.histogram.mean, None)
+
+    def test_percentile(self):
+        for i in range(1, 101):
+            self.histogram.record(i / 100.0)
+        self.assertEqual(self.histogram.count, 100)
+        self.assertAlmostEqual(self.histogram.mean, 0.505)
+        for (p, expected) in [(0.5, 0.5), (0.9, 0.9), (0.99, 0.99)]:
+            value = self.histogram.percentile(p)
+            self.assert_(expected <= value <= expected * 1.01, value)
+        self.assertEqual(self.histogram.percentile(1), 1)
+        self.assertAlmostEqual(self.histogram.percentile(0), 0.01, 3)
+
+    def test_out_of_range(self):
+        self.histogram.record(0)
+        self.histogram.record(10000)
+        self.assertEqual(self.histogram.counts[0], 1)
+        self.assertEqual(self.histogram.counts[-1], 1)
+        self.assertEqual(self.histogram.percentile(0.5), 0.0001)
+        self.assertEqual(self.histogram.percentile(1), 10000)
+
+    def test_fixed_memory(self):
+        size = len(self.histogram.counts)
+        for i in range(1000):
+            self.histogram.record(i * 0.37)
+        self.assertEqual(len(self.histogram.counts), size)
+
+    def test_merge(self):
+        other = LatencyHistogram()
+        self.histogram.record(0.1, 3)
+        other.record(2)
+        other.record(0.05)
+        self.histogram.merge(other)
+        self.assertEqual(self.histogram.count, 5)
+        self.assertEqual((self.histogram.min, self.histogram.max), (0.05, 2))
+        self.assertAlmostEqual(self.histogram.total, 2.35)
+        self.assertEqual(self.histogram.percentile(1), 2)
+
+    def test_merge_different_buckets(self):
+        self.assertRaises(ValueError, self.histogram.merge,
+                          LatencyHistogram(precision=0.1))
+
+
+class LatencyStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.latencies = LatencyStats()
+
+    def test_iface(self):
+        verifyObject(ITracer, self.latencies)
+
+    def test_record(self):
+        self.latencies.record('init', 0.5)
+        self.latencies.record('init', 1.5)
+        self.assertEqual(self.latencies.phases(), ['init'])
+        self.assertEqual(self.latencies.percentile('init', 1), 1.5)
+
+    def test_event(self):
+        self.latencies.event('put', 10, 3, attempt=1, queued=2)
+        self.latencies.event('read', 10, 0.5, part_number=1)
+        self.assertEqual(self.latencies.phases(), ['put', 'queued', 'read'])
+        self.assertEqual(self.latencies.histogram('queued').max, 2)
+        self.assertEqual(self.latencies.histogram('put').max, 3)
+        self.failIf(self.latencies.retries)
+
+    def test_retries(self):
+        for attempt in (1, 2, 3):
+            self.latencies.event('init', 0, 1, attempt=attempt, queued=0)
+        self.assertEqual(self.latencies.retries, {'init': 2})
+        self.assertEqual(self.latencies.histogram('init').count, 3)
+
+    def test_merge(self):
+        other = LatencyStats()
+        other.record('init', 1)
+        other.retries['init'] = 2
+        self.latencies.record('init', 2)
+        self.latencies.retries['init'] = 1
+        self.latencies.merge(other)
+        self.assertEqual(self.latencies.histogram('init').count, 2)
+        self.assertEqual(self.latencies.retries, {'init': 3})
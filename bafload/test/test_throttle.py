@@ -1,10 +1,19 @@
+from StringIO import StringIO
+
 from zope.interface.verify import verifyObject, verifyClass
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.defer import (Deferred, gatherResults, succeed,
+        CancelledError)
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.web.error import Error as WebError
 
-from bafload.interfaces import IThrottler
-from bafload.throttle import MaxConcurrentThrottler, PassThruThrottler
+from bafload.interfaces import IThrottler, IFairThrottler
+from bafload.test.util import FakeClock
+from bafload.throttle import (MaxConcurrentThrottler, PassThruThrottler,
+        FairThrottler, AIMDThrottler, ByteRateThrottler, payload_size)
+from bafload.producers import FileRangeBodyProducer
 
 
 class TestFunc(object):
@@ -72,3 +81,416 @@ class MaxConcurrentThrottlerTestCase(TestCase):
             self.assertEqual(r, [1, 1, 1, 1, 1])
 
         return finished.addCallback(check)
+
+
+class FairThrottlerTestCase(TestCase):
+
+    def test_iface(self):
+        verifyClass(IFairThrottler, FairThrottler)
+        verifyObject(IFairThrottler, FairThrottler())
+        verifyObject(IThrottler, FairThrottler().queue())
+        verifyObject(IThrottler, FairThrottler().control_throttler)
+
+    def test_throttle(self):
+        test_func = TestFunc()
+        throttler = FairThrottler(3)
+        ds = []
+        for i in range(5):
+            ds.append(throttler.throttle(test_func, a=i))
+        finished = gatherResults(list(ds))
+        self.assertEqual(len(test_func.called), 3)
+        self.assertEqual(throttler.waiting, 2)
+        ds.pop(0).callback(1)
+        ds.pop(0).callback(1)
+        self.assertEqual(len(test_func.called), 5)
+        self.assertEqual(throttler.pending, 3)
+        for d in list(test_func.finished):
+            d.callback(1)
+        self.failIf(throttler.pending)
+        self.failIf(throttler.waiting)
+
+        def check(r):
+            self.assertEqual(r, [1, 1, 1, 1, 1])
+
+        return finished.addCallback(check)
+
+    def _finish_one(self, test_func):
+        test_func.finished[0].callback(None)
+
+    def test_round_robin(self):
+        test_func = TestFunc()
+        throttler = FairThrottler(1)
+        big = throttler.queue()
+        small = throttler.queue()
+        for i in range(4):
+            big.throttle(test_func, 'big', i)
+        small.throttle(test_func, 'small', 0)
+        small.throttle(test_func, 'small', 1)
+        for i in range(5):
+            self._finish_one(test_func)
+        self.assertEqual([args for (args, kw) in test_func.called], [
+            ('big', 0), ('big', 1), ('small', 0), ('big', 2), ('small', 1),
+            ('big', 3)])
+
+    def test_weight(self):
+        test_func = TestFunc()
+        throttler = FairThrottler(1)
+        heavy = throttler.queue(weight=2)
+        light = throttler.queue()
+        throttler.throttle(test_func, 'first')
+        for i in range(4):
+            heavy.throttle(test_func, 'heavy', i)
+        for i in range(2):
+            light.throttle(test_func, 'light', i)
+        for i in range(6):
+            self._finish_one(test_func)
+        self.assertEqual([args for (args, kw) in test_func.called], [
+            ('first',), ('heavy', 0), ('heavy', 1), ('light', 0),
+            ('heavy', 2), ('heavy', 3), ('light', 1)])
+
+    def test_control_priority(self):
+        test_func = TestFunc()
+        throttler = FairThrottler(1)
+        queue = throttler.queue()
+        for i in range(3):
+            queue.throttle(test_func, 'part', i)
+        throttler.control_throttler.throttle(test_func, 'complete')
+        for i in range(3):
+            self._finish_one(test_func)
+        self.assertEqual([args for (args, kw) in test_func.called], [
+            ('part', 0), ('complete',), ('part', 1), ('part', 2)])
+
+    def test_complete_skips_rate_backlog(self):
+        test_func = TestFunc()
+        rate = ByteRateThrottler(10, clock=Clock())
+        throttler = FairThrottler(10, throttler=rate)
+        queue = throttler.queue()
+        for i in range(3):
+            queue.throttle(test_func, 'mybucket', 'mykey', '1234',
+                           part_number=i, data='x' * 10)
+        self.assertEqual(rate.waiting, 2)
+        # Its bucket, key, upload id and parts list are not payload.
+        throttler.control_throttler.throttle(test_func, 'mybucket', 'mykey',
+                                             '1234', [(1, 'etag')])
+        self.assertEqual([args[3:] for (args, kw) in test_func.called],
+                         [(), ([(1, 'etag')],)])
+        self.assertEqual(rate.waiting, 2)
+
+    def test_chained_rate_throttler(self):
+        test_func = TestFunc()
+        clock = Clock()
+        rate = ByteRateThrottler(10, clock=clock)
+        throttler = FairThrottler(2, throttler=rate)
+        queue = throttler.queue()
+        for i in range(3):
+            queue.throttle(test_func, i, data='x' * 10)
+        throttler.control_throttler.throttle(test_func, None)
+        self.assertEqual(len(test_func.called), 1)
+        self.assertEqual(throttler.waiting, 2)
+        self.assertEqual(rate.waiting, 1)
+        # The control call leaves the queues first and, sending nothing,
+        # doesn't wait for tokens.
+        self._finish_one(test_func)
+        self.assertEqual([args[0] for (args, kw) in test_func.called],
+                         [0, None])
+        clock.advance(1)
+        self.assertEqual([args[0] for (args, kw) in test_func.called],
+                         [0, None, 1])
+
+
+class AIMDThrottlerTestCase(TestCase):
+
+    def setUp(self):
+        super(AIMDThrottlerTestCase, self).setUp()
+        self.clock = FakeClock()
+
+    def test_iface(self):
+        verifyClass(IThrottler, AIMDThrottler)
+        verifyObject(IThrottler, AIMDThrottler(clock=self.clock))
+
+    def test_throttle(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=2, clock=self.clock)
+        ds = [throttler.throttle(test_func, a=i) for i in range(3)]
+        self.assertEqual(len(test_func.called), 2)
+        self.assertEqual(throttler.waiting, 1)
+        ds[0].callback(1)
+        self.assertEqual(len(test_func.called), 3)
+        self.failIf(throttler.waiting)
+        for d in list(test_func.finished):
+            d.callback(1)
+        self.failIf(throttler.running)
+        return gatherResults(ds)
+
+    def test_additive_increase(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=2, maximum=3, clock=self.clock)
+        for i in range(3):
+            throttler.throttle(test_func)
+            self.clock.tick(1)
+            test_func.finished[0].callback(None)
+        self.assertEqual(throttler.baseline, 1)
+        self.assertEqual(throttler.max, 3)
+        for i in range(10):
+            throttler.throttle(test_func)
+            self.clock.tick(1)
+            test_func.finished[0].callback(None)
+        self.assertEqual(throttler.window, 3)
+
+    def test_increase_starts_waiting_calls(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=1, clock=self.clock)
+        for i in range(4):
+            throttler.throttle(test_func, i)
+        test_func.finished[0].callback(None)
+        test_func.finished[0].callback(None)
+        self.assertEqual(throttler.max, 2)
+        self.assertEqual(len(test_func.called), 4)
+        self.assertEqual(throttler.running, 2)
+
+    def test_decrease_on_error(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=8, minimum=3, clock=self.clock)
+        ds = []
+        ds.append(throttler.throttle(test_func))
+        test_func.finished[0].errback(ConnectionLost())
+        self.assertEqual(throttler.max, 4)
+        self.clock.tick(1)
+        ds.append(throttler.throttle(test_func))
+        test_func.finished[0].errback(ConnectionLost())
+        self.assertEqual(throttler.max, 3)
+        for d in ds:
+            self.assertFailure(d, ConnectionLost)
+        return gatherResults(ds)
+
+    def test_no_decrease_on_other_errors(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=8, clock=self.clock)
+        ds = [throttler.throttle(test_func) for i in range(2)]
+        test_func.finished[0].cancel()
+        test_func.finished[0].errback(WebError('403'))
+        self.assertEqual(throttler.max, 8)
+        self.assertEqual(throttler.running, 0)
+        self.assertFailure(ds[0], CancelledError)
+        self.assertFailure(ds[1], WebError)
+        return gatherResults(ds)
+
+    def test_decrease_on_latency(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=8, clock=self.clock)
+        throttler.throttle(test_func)
+        self.clock.tick(1)
+        test_func.finished[0].callback(None)
+        window = throttler.window
+        throttler.throttle(test_func)
+        self.clock.tick(3)
+        test_func.finished[0].callback(None)
+        self.assertEqual(throttler.window, window / 2)
+        self.assertApproximates(throttler.baseline, 1.2, 0.0001)
+
+    def test_baseline_follows_slower_calls(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=4, clock=self.clock)
+        for i in range(30):
+            throttler.throttle(test_func)
+            self.clock.tick(1 if i == 0 else 5)
+            test_func.finished[0].callback(None)
+        self.assertTrue(throttler.window > 4)
+
+    def test_parts_after_fast_control_call(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=4, clock=self.clock)
+        throttler.throttle(test_func, 'mybucket', 'mykey')
+        self.clock.tick(0.05)
+        test_func.finished[0].callback('1234')
+        for i in range(20):
+            throttler.throttle(test_func, 'mybucket', 'mykey', '1234',
+                               part_number=i + 1,
+                               data='x' * (100 if i % 2 else 200))
+            self.clock.tick(1)
+            test_func.finished[0].callback(None)
+        self.assertTrue(throttler.window > 4 + 2, throttler.window)
+
+    def test_decrease_once_per_baseline(self):
+        test_func = TestFunc()
+        throttler = AIMDThrottler(initial=8, clock=self.clock)
+        throttler.throttle(test_func)
+        self.clock.tick(2)
+        test_func.finished[0].callback(None)
+        ds = [throttler.throttle(test_func) for i in range(3)]
+        for d in list(test_func.finished):
+            d.errback(ConnectionLost())
+        self.assertEqual(throttler.max, 4)
+        for d in ds:
+            self.assertFailure(d, ConnectionLost)
+        return gatherResults(ds)
+
+
+class PayloadSizeTestCase(TestCase):
+
+    def test_payload_size(self):
+        producer = FileRangeBodyProducer(StringIO('x' * 100), 10, 50)
+        self.assertEqual(payload_size((), {'part': 'x' * 10,
+                                           'part_number': 1}), 10)
+        self.assertEqual(payload_size((), {'body_producer': producer}), 50)
+        self.assertEqual(payload_size(('b', 'k'), {'data': 'x' * 10}), 10)
+        # Bucket names, keys and upload ids are not payload.
+        self.assertEqual(payload_size(('b', 'k', 'upload-id', [1, 2]), {}),
+                         0)
+        self.assertEqual(payload_size((1,), {'metadata': {}}), 0)
+
+
+class ByteRateThrottlerTestCase(TestCase):
+
+    def setUp(self):
+        super(ByteRateThrottlerTestCase, self).setUp()
+        self.clock = Clock()
+
+    def _throttler(self, rate, burst=None):
+        return ByteRateThrottler(rate, burst, clock=self.clock)
+
+    def _immediate(self, data):
+        return succeed(len(data))
+
+    def test_iface(self):
+        verifyClass(IThrottler, ByteRateThrottler)
+        verifyObject(IThrottler, self._throttler(100))
+
+    def test_burst(self):
+        throttler = self._throttler(100, burst=200)
+        called = []
+        for i in range(3):
+            throttler.throttle(self._immediate, data='x' * 100).addCallback(
+                called.append)
+        self.assertEqual(called, [100, 100])
+        self.assertEqual(throttler.waiting, 1)
+        self.clock.advance(0.5)
+        self.assertEqual(called, [100, 100])
+        self.clock.advance(0.5)
+        self.assertEqual(called, [100, 100, 100])
+        self.failIf(throttler.waiting)
+
+    def test_rate_with_varying_sizes(self):
+        throttler = self._throttler(100)
+        times = []
+
+        def call(data):
+            times.append((self.clock.seconds(), len(data)))
+            return succeed(None)
+
+        for size in (100, 50, 250, 10, 100):
+            throttler.throttle(call, data='x' * size)
+        self.clock.pump([0.1] * 60)
+        self.assertEqual([size for (t, size) in times],
+                         [100, 50, 250, 10, 100])
+        (t1, t2, t3, t4, t5) = [t for (t, size) in times]
+        self.assertApproximates(t1, 0, 0.01)
+        self.assertApproximates(t2, 0.5, 0.01)
+        # A call larger than the bucket waits for a full bucket only.
+        self.assertApproximates(t3, 1.5, 0.01)
+        self.assertApproximates(t4, 3.1, 0.01)
+        self.assertApproximates(t5, 4.1, 0.01)
+
+    def test_set_rate(self):
+        throttler = self._throttler(10)
+        called = []
+        for i in range(2):
+            throttler.throttle(self._immediate, data='x' * 10).addCallback(
+                called.append)
+        self.assertEqual(called, [10])
+        throttler.set_rate(100)
+        self.clock.advance(0.1)
+        self.assertEqual(called, [10, 10])
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, self._throttler, 0)
+        throttler = self._throttler(10)
+        self.assertRaises(ValueError, throttler.set_rate, 0)
+        self.assertRaises(ValueError, throttler.set_rate, -1)
+        self.assertEqual(throttler.rate, 10)
+
+    def test_no_payload(self):
+        throttler = self._throttler(10)
+        called = []
+        throttler.throttle(self._immediate, data='x' * 10).addCallback(
+            called.append)
+        throttler.throttle(self._immediate, data='x' * 10).addCallback(
+            called.append)
+        throttler.throttle(lambda: succeed('done')).addCallback(
+            called.append)
+        self.assertEqual(called, [10, 'done'])
+        self.assertEqual(throttler.waiting, 1)
+
+    def test_cancel_first_waiting(self):
+        throttler = self._throttler(10)
+        called = []
+        throttler.throttle(self._immediate, data='x' * 10)
+        d = throttler.throttle(self._immediate, data='x' * 10)
+        throttler.throttle(self._immediate, data='x').addCallback(called.append)
+        d.cancel()
+        self.assertFailure(d, CancelledError)
+        # The next call waits for its own tokens, not for the cancelled
+        # call's.
+        self.clock.advance(0.1)
+        self.assertEqual(called, [1])
+        self.failIf(throttler.waiting)
+        self.failIf(self.clock.getDelayedCalls())
+        return d
+
+    def test_chained_throttler(self):
+        test_func = TestFunc()
+        inner = MaxConcurrentThrottler(1)
+        throttler = ByteRateThrottler(1000, throttler=inner, clock=self.clock)
+        d1 = throttler.throttle(test_func, 'x')
+        d2 = throttler.throttle(test_func, 'y')
+        self.assertEqual(len(test_func.called), 1)
+        self.assertEqual(inner.pending, 2)
+        test_func.finished[0].callback(1)
+        test_func.finished[0].callback(2)
+        return gatherResults([d1, d2]).addCallback(self.assertEqual, [1, 2])
+
+
+class CancelTestCase(TestCase):
+
+    def _throttlers(self):
+        clock = Clock()
+        return [MaxConcurrentThrottler(1), FairThrottler(1),
+                AIMDThrottler(initial=1, clock=clock),
+                ByteRateThrottler(1, burst=1, clock=clock)]
+
+    def test_cancel_waiting(self):
+        for throttler in self._throttlers():
+            test_func = TestFunc()
+            first = throttler.throttle(test_func, data='x')
+            d = throttler.throttle(test_func, data='y')
+            d.cancel()
+            self.assertFailure(d, CancelledError)
+            self.failIf(throttler.waiting)
+            for pending in list(test_func.finished):
+                pending.callback(None)
+            self.failIf([kw for (args, kw) in test_func.called
+                         if kw == {'data': 'y'}], throttler)
+            first.addErrback(lambda why: None)
+
+    def test_cancel_started(self):
+        test_func = TestFunc()
+        throttler = MaxConcurrentThrottler(1)
+        throttler.throttle(test_func, 'x')
+        d = throttler.throttle(test_func, 'y')
+        test_func.finished[0].callback(None)
+        self.assertEqual(len(test_func.finished), 1)
+        d.cancel()
+        self.failIf(test_func.finished)
+        self.failIf(throttler.pending)
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_fair_queue(self):
+        test_func = TestFunc()
+        throttler = FairThrottler(1)
+        queue = throttler.queue()
+        throttler.throttle(test_func, 'x')
+        d = queue.throttle(test_func, 'y')
+        d.cancel()
+        self.failIf(throttler._ready)
+        self.assertEqual(throttler.pending, 1)
+        return self.assertFailure(d, CancelledError)
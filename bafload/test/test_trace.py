@@ -0,0 +1,77 @@
+import json
+from StringIO import StringIO
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+
+from bafload.interfaces import ITracer
+from bafload.trace import UploadTimings, JSONLinesExporter
+
+
+class UploadTimingsTestCase(TestCase):
+
+    def setUp(self):
+        self.timings = UploadTimings()
+
+    def test_iface(self):
+        verifyObject(ITracer, self.timings)
+
+    def test_empty(self):
+        self.assertEqual(self.timings.elapsed, 0)
+        self.assertEqual(self.timings.breakdown(), {'queued': 0})
+
+    def test_event(self):
+        self.timings.event('init', 10, 1, attempt=1, queued=0.5)
+        self.timings.event('read', 11, 0.25, part_number=1, bytes=10)
+        self.timings.event('upload_part', 11, 2, attempt=1, queued=0,
+                           part_number=1, bytes=10, error='woops')
+        self.timings.event('upload_part', 13, 1, attempt=2, queued=1,
+                           part_number=1, bytes=10)
+        self.assertEqual(self.timings.phases, {'init': [1, 1],
+            'read': [1, 0.25], 'upload_part': [2, 3]})
+        self.assertEqual(self.timings.breakdown(), {'init': 1, 'read': 0.25,
+            'upload_part': 3, 'queued': 1.5})
+        self.assertEqual(self.timings.retries, 1)
+        self.assertEqual(self.timings.failures, 1)
+        self.assertEqual(self.timings.bytes, 10)
+        self.assertEqual((self.timings.started, self.timings.finished),
+                         (10, 14))
+        self.assertEqual(self.timings.elapsed, 4)
+
+
+class JSONLinesExporterTestCase(TestCase):
+
+    def setUp(self):
+        self.fd = StringIO()
+        self.exporter = JSONLinesExporter(self.fd, buffer_size=2)
+
+    def _lines(self):
+        return [json.loads(line) for line in self.fd.getvalue().splitlines()]
+
+    def test_iface(self):
+        verifyObject(ITracer, self.exporter)
+
+    def test_buffered(self):
+        self.exporter.event('init', 10, 1.5, bucket='mybucket', attempt=1)
+        self.assertEqual(self.fd.getvalue(), '')
+        self.exporter.event('complete', 12, 0.5, bucket='mybucket')
+        self.assertEqual(self._lines(), [
+            {'event': 'init', 'start': 10, 'duration': 1.5,
+             'bucket': 'mybucket', 'attempt': 1},
+            {'event': 'complete', 'start': 12, 'duration': 0.5,
+             'bucket': 'mybucket'}])
+
+    def test_flush(self):
+        self.exporter.event('init', 10, 1.5, upload_id=None)
+        self.exporter.flush()
+        self.assertEqual(self._lines(), [
+            {'event': 'init', 'start': 10, 'duration': 1.5,
+             'upload_id': None}])
+        self.exporter.flush()
+        self.assertEqual(len(self._lines()), 1)
+
+    def test_close(self):
+        self.exporter.event('init', 10, 1.5)
+        self.exporter.close()
+        self.assert_(self.fd.closed)
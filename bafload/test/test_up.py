@@ -1,24 +1,42 @@
+import os
 from StringIO import StringIO
 from hashlib import md5
 
 from zope.interface.verify import verifyClass, verifyObject
 from zope.interface import implements
 
-from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.defer import (Deferred, succeed, fail, gatherResults,
+        CancelledError)
+from twisted.internet.task import Cooperator, Clock
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.trial.unittest import TestCase
 
-from txaws.s3.client import S3Client
 from txaws.s3.model import (MultipartInitiationResponse,
     MultipartCompletionResponse)
 from txaws.service import AWSServiceRegion
 from txaws.credentials import AWSCredentials
 
+from bafload.client import S3Client
 from bafload.interfaces import (IPartsGenerator, ITransmissionCounter,
     IPartHandler, IMultipartUploadsManager)
 from bafload.up import (FileIOPartsGenerator, PartsTransferredCounter,
-    SingleProcessPartUploader, MultipartUploadsManager, MultipartUpload)
-from bafload.test.util import FakeLog, FakeS3Client, FakeClock
-from bafload.stats import ThroughputCounter, SlidingStats
+    SingleProcessPartUploader, MultipartUploadsManager, MultipartUpload,
+    SinglePutUpload, PartsTracker,
+    MmapPartsGenerator, ThreadPoolPartsGenerator, StreamingPartsGenerator)
+from bafload.producers import FileRangeBodyProducer
+from bafload.budget import ByteBudget
+from bafload.sizing import PartSizePolicy
+from bafload.journal import UploadJournal
+from bafload.hedge import HedgingPartHandler
+from bafload.pool import ClientPool
+from bafload.retry import ClassifyingBackoff
+from bafload.throttle import (PassThruThrottler, FairThrottler,
+        MaxConcurrentThrottler)
+from bafload.test.util import (FakeLog, FakeS3Client, FakeClock, FakeTracer,
+        FakeAgent, FakeResponse)
+from bafload.stats import ThroughputCounter, SlidingStats, LatencyStats
+from bafload.test.test_pool import FakeEndpointFactory
 from bafload import up as up_module
 
 
@@ -29,6 +47,21 @@ class InterfacesTestCase(TestCase):
         parts_gen = FileIOPartsGenerator()
         verifyObject(IPartsGenerator, parts_gen)
 
+    def test_mmap_parts_generator_ifaces(self):
+        verifyClass(IPartsGenerator, MmapPartsGenerator)
+        parts_gen = MmapPartsGenerator()
+        verifyObject(IPartsGenerator, parts_gen)
+
+    def test_thread_pool_parts_generator_ifaces(self):
+        verifyClass(IPartsGenerator, ThreadPoolPartsGenerator)
+        parts_gen = ThreadPoolPartsGenerator()
+        verifyObject(IPartsGenerator, parts_gen)
+
+    def test_streaming_parts_generator_ifaces(self):
+        verifyClass(IPartsGenerator, StreamingPartsGenerator)
+        parts_gen = StreamingPartsGenerator()
+        verifyObject(IPartsGenerator, parts_gen)
+
     def test_parts_transmission_counter_ifaces(self):
         verifyClass(ITransmissionCounter, PartsTransferredCounter)
         counter = PartsTransferredCounter(365)
@@ -55,6 +88,22 @@ class TestMultipartUpload(MultipartUpload):
         self.amz_headers = amz_headers
         self.finished.callback(self)
 
+    def resume(self, bucket, object_name, upload_id, parts, reconcile=False):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.resumed = (upload_id, parts, reconcile)
+        self.finished.callback(self)
+
+
+class TestSinglePutUpload(SinglePutUpload):
+
+    def upload(self, bucket, object_name, content_type, metadata,
+               amz_headers={}):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.amz_headers = amz_headers
+        self.finished.callback(self)
+
 
 class FileIOPartsGeneratorTestCase(TestCase):
 
@@ -89,14 +138,213 @@ class FileIOPartsGeneratorTestCase(TestCase):
         count = self.generator.count_parts(fd)
         self.assertEqual(count, 6)
 
+    def test_count_parts_for_buffer_types(self):
+        self.assertEqual(self.generator.count_parts("x" * 53), 6)
+        self.assertEqual(self.generator.count_parts(bytearray(30)), 3)
+        self.assertEqual(self.generator.count_parts(buffer("x" * 21)), 3)
+
     def test_count_parts_for_other_type(self):
         count = self.generator.count_parts([])
         self.assertEqual(count, "?")
 
 
+class MmapPartsGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        super(MmapPartsGeneratorTestCase, self).setUp()
+        self.generator = MmapPartsGenerator()
+        self.generator.part_size = 10
+
+    def _open(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as fd:
+            fd.write(data)
+        fd = open(path, "rb")
+        self.addCleanup(fd.close)
+        return fd
+
+    def test_generate_parts_from_file(self):
+        fd = self._open("x" * 5 + "y" * 10 + "z" * 13)
+        generated = [(str(part), part_number) for (part, part_number)
+                     in self.generator.generate_parts(fd)]
+        self.assertEqual(generated, [('xxxxxyyyyy', 1),
+                                     ('yyyyyzzzzz', 2),
+                                     ('zzzzzzzz', 3)])
+
+    def test_generate_parts_from_file_are_not_copies(self):
+        fd = self._open("x" * 25)
+        for (part, part_number) in self.generator.generate_parts(fd):
+            self.assertNotIsInstance(part, str)
+
+    def test_generate_parts_from_empty_file(self):
+        fd = self._open("")
+        self.assertEqual(list(self.generator.generate_parts(fd)), [])
+
+    def test_generate_parts_from_bytearray(self):
+        data = bytearray("a" * 10 + "b" * 5)
+        generated = list(self.generator.generate_parts(data))
+        self.assertEqual([(part.tobytes(), n) for (part, n) in generated],
+                         [('aaaaaaaaaa', 1), ('bbbbb', 2)])
+        data[10] = 'c'
+        self.assertEqual(generated[1][0].tobytes(), 'cbbbb')
+
+    def test_generate_parts_from_str(self):
+        generated = [(part.tobytes(), n) for (part, n)
+                     in self.generator.generate_parts("q" * 12)]
+        self.assertEqual(generated, [('qqqqqqqqqq', 1), ('qq', 2)])
+
+    def test_count_parts(self):
+        fd = self._open("x" * 53)
+        self.assertEqual(self.generator.count_parts(fd), 6)
+        self.assertEqual(self.generator.count_parts(bytearray(53)), 6)
+
+
+class ThreadPoolPartsGeneratorTestCase(TestCase):
+
+    def setUp(self):
+        super(ThreadPoolPartsGeneratorTestCase, self).setUp()
+        self.threadpool = ThreadPool(1, 2)
+        self.threadpool.start()
+        self.addCleanup(self.threadpool.stop)
+        self.generator = ThreadPoolPartsGenerator(self.threadpool, reads=2)
+        self.generator.part_size = 10
+
+    def _open(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as fd:
+            fd.write(data)
+        fd = open(path, "rb")
+        self.addCleanup(fd.close)
+        return fd
+
+    def test_generate_parts(self):
+        fd = self._open("x" * 5 + "y" * 10 + "z" * 13)
+        generated = list(self.generator.generate_parts(fd))
+        self.assertEqual([n for (part, n) in generated], [1, 2, 3])
+
+        def check(parts):
+            self.assertEqual(parts, ['xxxxxyyyyy', 'yyyyyzzzzz', 'zzzzzzzz'])
+
+        d = gatherResults([part for (part, n) in generated])
+        return d.addCallback(check)
+
+    def test_reads_in_flight(self):
+        reads = []
+
+        def read(reader, size, offset):
+            reads.append(offset)
+            return Deferred()
+
+        self.generator._read = read
+        gen = self.generator.generate_parts(self._open("x" * 45))
+        self.assertEqual(gen.next()[1], 1)
+        self.assertEqual(reads, [0, 10])
+        self.assertEqual(gen.next()[1], 2)
+        self.assertEqual(reads, [0, 10, 20])
+        self.assertEqual([n for (part, n) in gen], [3, 4, 5])
+        self.assertEqual(reads, [0, 10, 20, 30, 40])
+
+    def test_generate_parts_from_empty_file(self):
+        fd = self._open("")
+        self.assertEqual(list(self.generator.generate_parts(fd)), [])
+
+    def test_reads_within_byte_budget(self):
+        reads = []
+
+        def read(reader, size, offset):
+            d = Deferred()
+            reads.append((offset, d))
+            return d
+
+        self.generator._read = read
+        self.generator.reads = 4
+        budget = self.generator.byte_budget = ByteBudget(20)
+        gen = self.generator.generate_parts(self._open("x" * 45))
+        self.assertEqual(gen.next()[1], 1)
+        # Only the parts the budget has room for are read ahead.
+        self.assertEqual([offset for (offset, d) in reads], [0, 10])
+        self.assertEqual(budget.in_flight, 20)
+        self.assertEqual(budget.waiting, 2)
+        reads[0][1].callback("x" * 10)
+        budget.release(10)
+        self.assertEqual([offset for (offset, d) in reads], [0, 10, 20])
+        self.assertEqual(budget.in_flight, 20)
+        # Parts read ahead but not generated return their bytes.
+        gen.close()
+        self.failIf(budget.waiting)
+        self.assertEqual(budget.in_flight, 20)
+        reads[1][1].callback("x" * 10)
+        reads[2][1].errback(IOError())
+        self.assertEqual(budget.in_flight, 0)
+
+    def test_reads_keep_file_offset(self):
+        fd = self._open("x" * 25)
+        fd.seek(3)
+        d = gatherResults([part for (part, n)
+                           in self.generator.generate_parts(fd)])
+
+        def check(parts):
+            self.assertEqual(parts, ['x' * 10, 'x' * 10, 'x' * 5])
+            self.assertEqual(fd.tell(), 3)
+
+        return d.addCallback(check)
+
+
+class PositionalReaderTestCase(TestCase):
+
+    def _open(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as fd:
+            fd.write(data)
+        fd = open(path, "rb")
+        self.addCleanup(fd.close)
+        return fd
+
+    def test_read_with_own_descriptor(self):
+        fd = self._open("0123456789")
+        reader = up_module._PositionalReader(fd)
+        self.assertEqual(reader.read(4, 3), '3456')
+        self.assertEqual(reader.read(4, 8), '89')
+        self.assertEqual(fd.tell(), 0)
+        self.assertEqual(len(reader._opened), 1)
+        (fileno,) = reader._opened
+        self.assertNotEqual(fileno, fd.fileno())
+        reader.started()
+        reader.close()
+        os.fstat(fileno)
+        reader.finished(None)
+        self.failIf(reader._opened)
+        self.assertRaises(OSError, os.fstat, fileno)
+
+    def test_read_without_path(self):
+        fd = os.fdopen(os.dup(self._open("0123456789").fileno()), 'rb')
+        self.addCleanup(fd.close)
+        reader = up_module._PositionalReader(fd)
+        self.assertIdentical(reader.path, None)
+        self.assertEqual(reader.read(4, 3), '3456')
+        self.failIf(reader._opened)
+
+
+class StreamingPartsGeneratorTestCase(TestCase):
+
+    def test_generate_parts(self):
+        generator = StreamingPartsGenerator()
+        generator.part_size = 10
+        fd = StringIO("x" * 28)
+        generated = list(generator.generate_parts(fd))
+        self.assertEqual([n for (p, n) in generated], [1, 2, 3])
+        for (producer, n) in generated:
+            self.assertIsInstance(producer, FileRangeBodyProducer)
+            self.assertIdentical(producer.fd, fd)
+        self.assertEqual([(p.offset, p.length) for (p, n) in generated],
+                         [(0, 10), (10, 10), (20, 8)])
+
+
 class DummyPartsGenerator(object):
     implements(IPartsGenerator)
 
+    part_size = 10
+
     def __init__(self):
         self.generated = []
 
@@ -107,6 +355,21 @@ class DummyPartsGenerator(object):
             yield entity
 
 
+class DeferredPartsGenerator(DummyPartsGenerator):
+
+    def __init__(self, error=None):
+        DummyPartsGenerator.__init__(self)
+        self.error = error
+
+    def generate_parts(self, fd):
+        for (part, part_number) in DummyPartsGenerator.generate_parts(self,
+                                                                       fd):
+            if self.error is not None and part_number == 5:
+                yield (fail(self.error), part_number)
+            else:
+                yield (succeed(part), part_number)
+
+
 class DummyPartHandler(object):
 
     def __init__(self):
@@ -118,6 +381,23 @@ class DummyPartHandler(object):
         return succeed((etag, part_number))
 
 
+class DeferredPartHandler(object):
+
+    def __init__(self):
+        self.handled = []
+        self.pending = []
+
+    def handle_part(self, part, part_number):
+        self.handled.append((part, part_number))
+        d = Deferred()
+        self.pending.append((d, (md5(part).hexdigest(), part_number)))
+        return d
+
+    def finish_part(self):
+        (d, result) = self.pending.pop(0)
+        d.callback(result)
+
+
 class ErroringPartHandler(object):
 
     def __init__(self, error_count=3):
@@ -163,9 +443,71 @@ class SingleProcessPartUploaderTestCase(TestCase):
 
         d = handler.handle_part("aaaaaaaaaa", 1)
         d.addCallback(check)
+        self.assertEqual(client.calls, [('upload_part', 'mybucket', 'mykey',
+            'theupload', 1, 'aaaaaaaaaa', None)])
+        return d
+
+    def test_handle_body_producer_part(self):
+        client = FakeS3Client()
+        handler = SingleProcessPartUploader()
+        handler.bucket = "mybucket"
+        handler.object_name = "mykey"
+        handler.upload_id = "theupload"
+        handler.client = client
+        producer = FileRangeBodyProducer(StringIO("a" * 20), 10, 10)
+        d = handler.handle_part(producer, 2)
+        self.assertEqual(client.calls, [('upload_part', 'mybucket', 'mykey',
+            'theupload', 2, None, producer)])
         return d
 
 
+class PartsTrackerTestCase(TestCase):
+
+    def test_done(self):
+        tracker = PartsTracker(3)
+        done = []
+        tracker.done.addCallback(done.append)
+        parts = [Deferred() for _ in range(3)]
+        for (part_number, d) in enumerate(parts, 1):
+            tracker.track(part_number, d)
+        tracker.close()
+        self.assertEqual(tracker.outstanding, 3)
+        parts[2].callback((3, 'etag3'))
+        parts[0].callback((1, 'etag1'))
+        self.assertEqual(tracker.in_flight, {2: parts[1]})
+        self.failIf(done)
+        parts[1].callback((2, 'etag2'))
+        self.assertEqual(done, [tracker])
+        self.assertEqual(tracker.in_flight, {})
+        self.assertEqual(tracker.parts(), [(1, 'etag1'), (2, 'etag2'),
+                                           (3, 'etag3')])
+        self.assertIdentical(tracker.failure, None)
+
+    def test_not_done_until_closed(self):
+        tracker = PartsTracker()
+        tracker.track(1, succeed((1, 'etag1')))
+        self.assertEqual(tracker.outstanding, 0)
+        self.assertIsInstance(tracker.done, Deferred)
+        tracker.close()
+        self.assertIdentical(tracker.done, None)
+
+    def test_unexpected_parts(self):
+        tracker = PartsTracker(1)
+        tracker.track(2, succeed((2, 'etag2')))
+        tracker.track(5, succeed((5, 'etag5')))
+        tracker.close()
+        self.assertEqual(tracker.parts(), [(2, 'etag2'), (5, 'etag5')])
+
+    def test_failure(self):
+        tracker = PartsTracker(2)
+        tracker.track(1, fail(ValueError('woops')))
+        tracker.track(2, fail(KeyError('woops')))
+        tracker.close()
+        self.assertIdentical(tracker.done, None)
+        tracker.failure.trap(ValueError)
+        self.assertEqual(tracker.parts(), [])
+
+
 class MultipartUploadTestCase(TestCase):
 
     def setUp(self):
@@ -230,6 +572,7 @@ class MultipartUploadTestCase(TestCase):
             self.assertIdentical(task, upload)
             self._assertPartsCompleted(parts_generator, part_handler,
                                       received, task, client)
+            self.assertEqual((counter.completed, counter.bytes), (10, 100))
 
         d.addCallback(check)
         received = []
@@ -237,6 +580,322 @@ class MultipartUploadTestCase(TestCase):
         upload.upload('mybucket', 'mykey', '', {}, amz_headers)
         return d
 
+    def test_upload_with_deferred_parts(self):
+        client = FakeS3Client()
+        parts_generator = DeferredPartsGenerator()
+        part_handler = DummyPartHandler()
+        counter = PartsTransferredCounter('?')
+        d = Deferred()
+        amz_headers = {'acl': 'public-read'}
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+
+        def check(task):
+            self.assertIdentical(task, upload)
+            self._assertPartsCompleted(parts_generator, part_handler,
+                                      received, task, client)
+
+        d.addCallback(check)
+        received = []
+        upload.on_part_generated = received.append
+        upload.upload('mybucket', 'mykey', '', {}, amz_headers)
+        return d
+
+    def test_upload_with_deferred_part_error(self):
+        client = FakeS3Client()
+        parts_generator = DeferredPartsGenerator(IOError('disk'))
+        part_handler = DummyPartHandler()
+        counter = PartsTransferredCounter('?')
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        return self.assertFailure(d, IOError)
+
+    def test_deferred_part_error_cancels_parts(self):
+        (upload, part_handler, work, d) = self._deferred_upload()
+        parts_generator = DeferredPartsGenerator(IOError('disk'))
+        work = upload._generate_parts(parts_generator.generate_parts(None))
+        self.assertEqual(len(list(work)), 9)
+        self.assertEqual(len(part_handler.handled), 4)
+        self.assertIsInstance(upload.cancelled.value, IOError)
+        self.assertEqual(upload.client.calls, [
+            ('abort_multipart_upload', 'mybucket', 'mykey', '1234')])
+        return self.assertFailure(d, IOError)
+
+    def test_generate_parts_with_byte_budget(self):
+        client = FakeS3Client()
+        parts_generator = DummyPartsGenerator()
+        part_handler = DeferredPartHandler()
+        part_handler.bucket = 'mybucket'
+        part_handler.object_name = 'mykey'
+        counter = PartsTransferredCounter('?')
+        budget = ByteBudget(30)
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.init_response = MultipartInitiationResponse('mybucket',
+            'mykey', '1234')
+        upload.retry_strategy.clock = self.clock
+        upload.throttler = PassThruThrottler()
+        upload.byte_budget = budget
+        received = []
+        upload.on_part_generated = received.append
+        work = upload._generate_parts(parts_generator.generate_parts(None))
+        for _ in range(3):
+            self.assertIdentical(work.next(), None)
+        self.assertEqual(budget.in_flight, 30)
+        self.assertEqual(upload.bytes_in_flight, 30)
+        waiting = work.next()
+        self.assertIsInstance(waiting, Deferred)
+        self.failIf(waiting.called)
+        self.assertEqual(len(parts_generator.generated), 3)
+        part_handler.finish_part()
+        self.assert_(waiting.called)
+        self.assertEqual(len(received), 1)
+        self.assertIdentical(work.next(), None)
+        self.assertEqual(len(parts_generator.generated), 4)
+        self.assertEqual(budget.in_flight, 30)
+        for _ in work:
+            while part_handler.pending:
+                part_handler.finish_part()
+        while part_handler.pending:
+            part_handler.finish_part()
+
+        def check(task):
+            self.assertIdentical(task, upload)
+            self.assertEqual(len(received), 10)
+            self.assertEqual(budget.in_flight, 0)
+            self.assertEqual(upload.bytes_in_flight, 0)
+
+        return d.addCallback(check)
+
+    def _deferred_upload(self, client=None):
+        if client is None:
+            client = FakeS3Client()
+        parts_generator = DummyPartsGenerator()
+        part_handler = DeferredPartHandler()
+        part_handler.bucket = 'mybucket'
+        part_handler.object_name = 'mykey'
+        counter = PartsTransferredCounter('?')
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.init_response = MultipartInitiationResponse('mybucket',
+            'mykey', '1234')
+        upload.retry_strategy = ClassifyingBackoff(clock=self.clock,
+                                                   log=self.log)
+        upload.throttler = PassThruThrottler()
+        work = upload._generate_parts(parts_generator.generate_parts(None))
+        return (upload, part_handler, work, d)
+
+    def test_fail_fast(self):
+        client = FakeS3Client()
+        (upload, part_handler, work, d) = self._deferred_upload(client)
+        throttler = upload.throttler = MaxConcurrentThrottler(2)
+        for _ in range(5):
+            self.assertIdentical(work.next(), None)
+        self.assertEqual(len(part_handler.handled), 2)
+        self.assertEqual(throttler.pending, 5)
+        part_handler.pending[0][0].errback(ValueError('woops'))
+        # The failed part's slot went to part 3 before the failure was
+        # known; it and part 2 are cancelled and parts 4 and 5 dropped.
+        self.assertEqual(throttler.pending, 0)
+        self.assertEqual(len(part_handler.handled), 3)
+        self.assertEqual(list(work), [])
+        self.assertEqual(client.calls, [
+            ('abort_multipart_upload', 'mybucket', 'mykey', '1234')])
+        return self.assertFailure(d, ValueError)
+
+    def test_cancel_aborts_with_s3_client(self):
+        region = AWSServiceRegion(creds=AWSCredentials('key', 'secret'),
+                                  s3_uri='http://s3.example.com/')
+        agent = FakeAgent(FakeResponse(code=204))
+        client = S3Client(creds=region.creds, endpoint=region.s3_endpoint,
+                          agent=agent)
+        (upload, part_handler, work, d) = self._deferred_upload(client)
+        work.next()
+        upload.cancel()
+        self.assertEqual(list(work), [])
+        self.assertEqual([(method, uri) for (method, uri, headers, producer)
+                          in agent.requests], [
+            ('DELETE', 'http://s3.example.com/mybucket/mykey?uploadId=1234')])
+        self.failIf([entry for entry in self.log.buffer if entry[0] == 'err'])
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_without_abort(self):
+        client = FakeS3Client()
+        client.abort_multipart_upload = None
+        (upload, part_handler, work, d) = self._deferred_upload(client)
+        work.next()
+        upload.cancel()
+        self.assertEqual(list(work), [])
+        self.assertIn('left behind',
+                      ' '.join(' '.join(entry[1]) for entry in self.log.buffer
+                               if entry[0] == 'msg'))
+        return self.assertFailure(d, CancelledError)
+
+    def test_fail_fast_journaled(self):
+        client = FakeS3Client()
+        (upload, part_handler, work, d) = self._deferred_upload(client)
+        upload.journal = UploadJournal(self.mktemp(), {}, sync=False)
+        work.next()
+        work.next()
+        part_handler.pending[0][0].errback(ValueError('woops'))
+        self.assertEqual(list(work), [])
+        self.failIf(client.calls)
+        return self.assertFailure(d, ValueError)
+
+    def test_cancel(self):
+        (upload, part_handler, work, d) = self._deferred_upload()
+        work.next()
+        work.next()
+        upload.cancel()
+        self.assertEqual(list(work), [])
+        self.assertEqual(len(part_handler.handled), 2)
+        return self.assertFailure(d, CancelledError)
+
+    def test_read_ahead_within_byte_budget(self):
+        client = FakeS3Client()
+        parts_generator = ThreadPoolPartsGenerator(reads=4)
+        parts_generator.part_size = 10
+        part_handler = DeferredPartHandler()
+        budget = ByteBudget(20)
+        buffered = []
+
+        def read(reader, size, offset):
+            buffered.append(budget.in_flight)
+            return succeed('x' * min(size, 95 - offset))
+
+        parts_generator._read = read
+        path = self.mktemp()
+        with open(path, 'wb') as fd:
+            fd.write('x' * 95)
+        fd = open(path, 'rb')
+        self.addCleanup(fd.close)
+        d = Deferred()
+        upload = MultipartUpload(client, fd, parts_generator, part_handler,
+            PartsTransferredCounter('?'), d, self.log)
+        upload.retry_strategy.clock = self.clock
+        upload.throttler = PassThruThrottler()
+        upload.byte_budget = budget
+        works = []
+        self.patch(up_module, 'coiterate',
+                   lambda work: works.append(work) or Deferred())
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        self.assertIdentical(parts_generator.byte_budget, budget)
+        for waiting in works[0]:
+            self.assert_(budget.in_flight <= 20)
+            self.assert_(upload.bytes_in_flight <= budget.in_flight)
+            while waiting is not None and not waiting.called:
+                part_handler.finish_part()
+        while part_handler.pending:
+            self.assert_(budget.in_flight <= 20)
+            self.assertEqual(upload.bytes_in_flight, budget.in_flight)
+            part_handler.finish_part()
+        self.assertEqual(len(part_handler.handled), 10)
+        self.assertEqual(max(buffered), 20)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(upload.bytes_in_flight, 0)
+        return d
+
+    def test_cancel_waiting_for_byte_budget(self):
+        (upload, part_handler, work, d) = self._deferred_upload()
+        budget = upload.byte_budget = ByteBudget(10)
+        self.assertIdentical(work.next(), None)
+        waiting = work.next()
+        self.failIf(waiting.called)
+        upload.cancel()
+        self.assert_(waiting.called)
+        self.assertEqual(list(work), [])
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.waiting, 0)
+        self.assertEqual(upload.bytes_in_flight, 0)
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_during_init(self):
+        client = FakeS3Client()
+        client.init_multipart_upload = lambda *a, **kw: Deferred()
+        (upload, part_handler, work, d) = self._deferred_upload(client)
+        upload.init_response = None
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        upload.cancel()
+        self.failIf(part_handler.handled)
+        self.failIf(client.calls)
+        return self.assertFailure(d, CancelledError)
+
+    def _journaled_upload(self, client, data='x' * 30):
+        parts_generator = FileIOPartsGenerator()
+        parts_generator.part_size = 10
+        part_handler = SingleProcessPartUploader()
+        part_handler.client = client
+        counter = PartsTransferredCounter('?')
+        d = Deferred()
+        upload = MultipartUpload(client, StringIO(data), parts_generator,
+            part_handler, counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+        upload.journal = UploadJournal(self.mktemp(), {}, sync=False)
+        return (upload, d)
+
+    def test_upload_with_journal(self):
+        client = FakeS3Client()
+        (upload, d) = self._journaled_upload(client)
+        recorded = []
+        record_part = upload.journal.record_part
+        upload.journal.record_part = lambda *a: (recorded.append(a),
+                                                 record_part(*a))
+
+        def check(task):
+            self.assertEqual(recorded, [(1, '"0123456789"'),
+                                        (2, '"0123456789"'),
+                                        (3, '"0123456789"')])
+            self.failIf(os.path.exists(upload.journal.path))
+
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        return d.addCallback(check)
+
+    def test_resume(self):
+        client = FakeS3Client()
+        (upload, d) = self._journaled_upload(client)
+        upload.journal.start('1234', 10)
+
+        def check(task):
+            uploaded = [c[4:6] for c in client.calls]
+            self.assertEqual(uploaded, [(1, 'xxxxxxxxxx'),
+                                        (3, 'xxxxxxxxxx')])
+            self.assertEqual(client.completed, [('1234', [
+                (1, '"0123456789"'), (2, '"etag2"'), (3, '"0123456789"')])])
+            self.assertEqual(upload.parts_generator.skip_parts,
+                             frozenset([2]))
+
+        upload.resume('mybucket', 'mykey', '1234', {2: '"etag2"'})
+        return d.addCallback(check)
+
+    def test_resume_reconcile(self):
+        client = FakeS3Client()
+        client.listed_parts = [(1, '"etag1"'), (3, '"etag3"')]
+        (upload, d) = self._journaled_upload(client)
+        journal = upload.journal
+        journal.start('1234', 10)
+        journal.record_part(2, '"etag2"')
+        # Keep the journal of the completed upload to check it.
+        journal.finish = journal.close
+
+        def check(task):
+            self.assertEqual([c[4] for c in client.calls], [2])
+            self.assertEqual(client.completed, [('1234', [
+                (1, '"etag1"'), (2, '"0123456789"'), (3, '"etag3"')])])
+            journal = UploadJournal(upload.journal.path, {})
+            self.assert_(journal.load())
+            self.assertEqual(journal.parts, {1: '"etag1"',
+                2: '"0123456789"', 3: '"etag3"'})
+
+        upload.resume('mybucket', 'mykey', '1234', {2: '"etag2"'},
+                      reconcile=True)
+        return d.addCallback(check)
+
     def test_upload_error_recovery(self):
         client = FakeS3Client()
         parts_generator = DummyPartsGenerator()
@@ -279,7 +938,9 @@ class MultipartUploadTestCase(TestCase):
 
         def eb(why):
             self.flushLoggedErrors()
-            self.assertEquals(len(self.clock.calls), 110)
+            # The first part fails for good and no more are generated.
+            self.assertEquals(len(self.clock.calls), 11)
+            self.assertEquals(part_handler.errors.keys(), [1])
             return why
 
         d.addErrback(eb)
@@ -331,6 +992,106 @@ class MultipartUploadTestCase(TestCase):
         d.addErrback(eb)
         return self.assertFailure(d, ValueError)
 
+    def test_upload_with_control_throttler(self):
+        client = FakeS3Client()
+        parts_generator = DummyPartsGenerator()
+        part_handler = DummyPartHandler()
+        counter = PartsTransferredCounter('?')
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+        control_calls = []
+        part_calls = []
+
+        class RecordingThrottler(PassThruThrottler):
+
+            def __init__(self, calls):
+                self.calls = calls
+
+            def throttle(self, func, *args, **kwargs):
+                self.calls.append((args, kwargs))
+                return func(*args, **kwargs)
+
+        upload.throttler = RecordingThrottler(part_calls)
+        upload.control_throttler = RecordingThrottler(control_calls)
+
+        def check(task):
+            # init_multipart_upload and complete_multipart_upload
+            self.assertEqual([args[:2] for (args, kwargs) in control_calls],
+                             [('mybucket', 'mykey')] * 2)
+            self.assertEqual(control_calls[1][0][2], '1234')
+            self.assertEqual([kwargs['part_number'] for (args, kwargs)
+                              in part_calls], range(1, 11))
+
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        return d.addCallback(check)
+
+    def test_upload_traced(self):
+        client = FakeS3Client()
+        parts_generator = DummyPartsGenerator()
+        part_handler = ErroringPartHandler(1)
+        counter = PartsTransferredCounter('?')
+        tracer = FakeTracer()
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+        upload.clock = self.clock
+        upload.tracer = tracer
+
+        def check(task):
+            self.flushLoggedErrors()
+            events = tracer.events
+            self.assertEqual([e[0] for e in events[:4]],
+                             ['init', 'read', 'upload_part', 'upload_part'])
+            self.assertEqual(events[0][3], {'bucket': 'mybucket',
+                'key': 'mykey', 'upload_id': '1234', 'attempt': 1,
+                'queued': 0})
+            (name, start, duration, tags) = events[3]
+            self.assertEqual(tags, {'bucket': 'mybucket', 'key': 'mykey',
+                'upload_id': '1234', 'attempt': 2, 'queued': 0,
+                'part_number': 1, 'bytes': 10})
+            self.assertEqual(events[2][3]['error'], 'woops')
+            self.assertEqual(events[-1][0], 'complete')
+            timings = task.timings
+            self.assertEqual(sorted(timings.phases),
+                             ['complete', 'init', 'read', 'upload_part'])
+            self.assertEqual(timings.phases['upload_part'][0], 20)
+            self.assertEqual(timings.retries, 10)
+            self.assertEqual(timings.failures, 10)
+            self.assertEqual(timings.bytes, 100)
+
+        d.addCallback(check)
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        return d
+
+    def test_upload_with_latencies(self):
+        client = FakeS3Client()
+        parts_generator = DummyPartsGenerator()
+        part_handler = DummyPartHandler()
+        counter = PartsTransferredCounter('?')
+        latencies = LatencyStats()
+        d = Deferred()
+        upload = MultipartUpload(client, None, parts_generator, part_handler,
+            counter, d, self.log)
+        upload.retry_strategy.clock = self.clock
+        upload.latencies = latencies
+
+        def check(task):
+            self.assertEqual(latencies.phases(),
+                             ['complete', 'init', 'queued', 'read',
+                              'upload_part'])
+            self.assertEqual(latencies.histogram('upload_part').count, 10)
+            self.assertEqual(latencies.histogram('read').count, 10)
+            self.assertEqual(latencies.histogram('queued').count, 12)
+            self.assertEqual(latencies.histogram('init').count, 1)
+            self.assertEqual(latencies.retries, {})
+
+        d.addCallback(check)
+        upload.upload('mybucket', 'mykey', '', {}, {})
+        return d
+
     def test_upload_with_throughput_counter(self):
         client = FakeS3Client()
         parts_generator = DummyPartsGenerator()
@@ -375,7 +1136,7 @@ class MultipartUploadTestCase(TestCase):
 
         def eb(why):
             self.flushLoggedErrors()
-            self.assertEquals(len(self.clock.calls), 110)
+            self.assertEquals(len(self.clock.calls), 11)
             self.assertEquals(throughput_counter.read()[-1], (0, 0))
             return why
 
@@ -384,6 +1145,118 @@ class MultipartUploadTestCase(TestCase):
         return self.assertFailure(d, ValueError)
 
 
+class ErroringPutS3Client(FakeS3Client):
+
+    def __init__(self, error_count=3):
+        FakeS3Client.__init__(self)
+        self.error_count = error_count
+
+    def put_object(self, *p, **kw):
+        if not self.error_count:
+            return FakeS3Client.put_object(self, *p, **kw)
+        self.error_count -= 1
+        return fail(ValueError('woops'))
+
+
+class SinglePutUploadTestCase(TestCase):
+
+    def setUp(self):
+        super(SinglePutUploadTestCase, self).setUp()
+        self.log = FakeLog()
+        self.clock = FakeClock()
+
+    def _upload(self, client, data='some data'):
+        d = Deferred()
+        upload = SinglePutUpload(client, StringIO(data),
+            PartsTransferredCounter(1), d, self.log)
+        upload.retry_strategy.clock = self.clock
+        return (upload, d)
+
+    def test_upload(self):
+        client = FakeS3Client()
+        (upload, d) = self._upload(client)
+        stats = SlidingStats(self.clock.seconds(), size=100)
+        upload.throughput_counter = ThroughputCounter(clock=self.clock,
+                                                      stats=stats)
+
+        def check(task):
+            self.assertIdentical(task, upload)
+            self.assertEqual(client.calls, [('put_object', 'mybucket',
+                'mykey', 'some data', 'text/plain', {},
+                {'acl': 'public-read'})])
+            self.assertEqual(task.counter.completed, 1)
+            self.assertEqual(task.counter.bytes, 9)
+            self.assertEqual(task.put_response, '')
+            self.assertEqual(upload.throughput_counter.read()[-1], (0, 9))
+            self.assertEqual(str(task), 'SinglePutUpload bucket=mybucket, '
+                                        'object_name=mykey')
+
+        upload.upload('mybucket', 'mykey', 'text/plain', {},
+                      {'acl': 'public-read'})
+        return d.addCallback(check)
+
+    def test_upload_with_byte_budget(self):
+        client = FakeS3Client()
+        budget = ByteBudget(5)
+        budget.acquire(5)
+        (upload, d) = self._upload(client)
+        upload.byte_budget = budget
+        upload.upload('mybucket', 'mykey', None, {})
+        self.assertEqual(client.calls, [])
+        budget.release(5)
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(budget.in_flight, 0)
+        return d
+
+    def test_cancel(self):
+        client = FakeS3Client()
+        client.put_object = lambda *a, **kw: Deferred()
+        budget = ByteBudget(100)
+        (upload, d) = self._upload(client)
+        upload.retry_strategy = ClassifyingBackoff(clock=self.clock,
+                                                   log=self.log)
+        upload.byte_budget = budget
+        upload.upload('mybucket', 'mykey', 'text/plain', {}, {})
+        self.assertEqual(budget.in_flight, 9)
+        upload.cancel()
+        self.assertEqual(budget.in_flight, 0)
+        return self.assertFailure(d, CancelledError)
+
+    def test_upload_traced(self):
+        client = FakeS3Client()
+        (upload, d) = self._upload(client)
+        upload.clock = self.clock
+        upload.tracer = FakeTracer()
+
+        def check(task):
+            self.assertEqual(upload.tracer.events, [('put', 0, 0, {
+                'bucket': 'mybucket', 'key': 'mykey', 'upload_id': None,
+                'attempt': 1, 'queued': 0, 'bytes': 9})])
+            self.assertEqual(task.timings.bytes, 9)
+
+        upload.upload('mybucket', 'mykey', None, {})
+        return d.addCallback(check)
+
+    def test_upload_error_recovery(self):
+        client = ErroringPutS3Client()
+        (upload, d) = self._upload(client)
+
+        def check(task):
+            self.flushLoggedErrors()
+            self.assertEqual(len(self.clock.calls), 3)
+            self.assertEqual(len(client.calls), 1)
+
+        upload.upload('mybucket', 'mykey', None, {})
+        return d.addCallback(check)
+
+    def test_upload_error_timeout_finally(self):
+        client = ErroringPutS3Client(100)
+        (upload, d) = self._upload(client)
+        upload.upload('mybucket', 'mykey', None, {})
+        d.addErrback(lambda why: (self.flushLoggedErrors(), why)[1])
+        return self.assertFailure(d, ValueError)
+
+
 class MultipartUploadsManagerTestCase(TestCase):
 
     def setUp(self):
@@ -422,3 +1295,357 @@ class MultipartUploadsManagerTestCase(TestCase):
                            amz_headers={'acl': 'public-read'})
         d.addCallback(check)
         return d
+
+    def test_upload_with_byte_budget(self):
+        budget = ByteBudget(100)
+        manager = MultipartUploadsManager(log=self.log, byte_budget=budget)
+
+        def check(task):
+            self.assertIdentical(task.byte_budget, budget)
+            self.assertEqual(manager.bytes_in_flight, 0)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_with_throttler(self):
+        throttler = PassThruThrottler()
+        manager = MultipartUploadsManager(log=self.log, throttler=throttler)
+
+        def check(task):
+            self.assertIdentical(task.throttler, throttler)
+            self.assertIdentical(task.control_throttler, None)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_cancel(self):
+        cancelled = []
+
+        class Task(object):
+
+            def cancel(self):
+                cancelled.append(self)
+
+        task = Task()
+        manager = MultipartUploadsManager(log=self.log)
+        manager.cancel(task)
+        self.assertEqual(cancelled, [task])
+
+    def test_upload_with_latencies(self):
+        latencies = LatencyStats()
+        manager = MultipartUploadsManager(log=self.log, latencies=latencies)
+
+        def check(task):
+            self.assertIdentical(task.latencies, latencies)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_with_tracer(self):
+        tracer = FakeTracer()
+        manager = MultipartUploadsManager(log=self.log, tracer=tracer)
+
+        def check(task):
+            self.assertIdentical(task.tracer, tracer)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_with_retry_strategy(self):
+        retry_strategy = ClassifyingBackoff()
+        manager = MultipartUploadsManager(log=self.log,
+                                          retry_strategy=retry_strategy)
+
+        def check(task):
+            self.assertIdentical(task.retry_strategy, retry_strategy)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_connection_pool_size(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          connection_pool_size=4)
+        self.assertIsInstance(manager.clients, ClientPool)
+        self.assertIdentical(manager.clients.region, manager.region)
+        self.assertEqual(manager.clients.size, 4)
+
+    def test_upload_with_client_pool(self):
+        manager = MultipartUploadsManager(log=self.log)
+        endpoints = FakeEndpointFactory()
+        manager.clients = ClientPool(manager.region, 4,
+                                     endpoint_factory=endpoints,
+                                     reactor=Clock())
+
+        def check(task):
+            self.assertIdentical(task.client,
+                                 manager.clients.client_for('mybucket'))
+            self.assertIdentical(task.part_handler.client, task.client)
+            # The upload has one part, so only one connection is opened.
+            self.assertEqual(len(endpoints.endpoint.connected), 1)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_hedged(self):
+        manager = MultipartUploadsManager(log=self.log, hedge_percentile=0.9)
+
+        def check(task):
+            self.assertIsInstance(task.part_handler, HedgingPartHandler)
+            self.assertEqual(task.part_handler.percentile, 0.9)
+            self.assertIsInstance(task.part_handler.part_handler,
+                                  SingleProcessPartUploader)
+            self.assertIsInstance(task.part_handler.client, S3Client)
+            self.assertIdentical(task.part_handler.throttler, task.throttler)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_with_fair_throttler(self):
+        throttler = FairThrottler()
+        manager = MultipartUploadsManager(log=self.log, throttler=throttler)
+        tasks = []
+
+        def check(ignore):
+            (first, second) = tasks
+            self.assertIdentical(first.throttler.throttler, throttler)
+            self.assertNotIdentical(first.throttler, second.throttler)
+            self.assertIdentical(first.control_throttler,
+                                 throttler.control_throttler)
+
+        ds = [manager.upload(StringIO("some data"), 'mybucket', key)
+              for key in ('key1', 'key2')]
+        for d in ds:
+            d.addCallback(tasks.append)
+        return gatherResults(ds).addCallback(check)
+
+    def test_upload_part_size_policy(self):
+        manager = MultipartUploadsManager(log=self.log,
+            part_size_policy=PartSizePolicy(min_part_size=4, alignment=1))
+
+        def check(task):
+            self.assertEqual(task.parts_generator.part_size, 4)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_upload_part_size_policy_not_applied_to_given_generator(self):
+        manager = MultipartUploadsManager(log=self.log,
+            part_size_policy=PartSizePolicy(min_part_size=4, alignment=1))
+        parts_generator = FileIOPartsGenerator()
+        parts_generator.part_size = 3
+
+        def check(task):
+            self.assertEqual(task.parts_generator.part_size, 3)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey',
+                           parts_generator=parts_generator)
+        return d.addCallback(check)
+
+    def test_upload_with_part_size_policy(self):
+        manager = MultipartUploadsManager(log=self.log)
+        parts_generator = FileIOPartsGenerator()
+        parts_generator.part_size = 3
+
+        def check(task):
+            self.assertEqual(task.parts_generator.part_size, 2)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey',
+            parts_generator=parts_generator,
+            part_size_policy=PartSizePolicy(min_part_size=2, alignment=1))
+        return d.addCallback(check)
+
+    def test_resume_without_journal_dir(self):
+        manager = MultipartUploadsManager(log=self.log)
+        self.assertRaises(ValueError, manager.upload, StringIO("some data"),
+                          'mybucket', 'mykey', resume=True)
+
+    def test_upload_journaled(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          journal_dir=self.mktemp())
+
+        def check(task):
+            self.assertIsInstance(task.journal, UploadJournal)
+            self.assertIdentical(getattr(task, 'resumed', None), None)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey')
+        return d.addCallback(check)
+
+    def test_resume(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          journal_dir=self.mktemp())
+        fd = StringIO("some data")
+        journal = manager.journals.journal_for(fd, 'mybucket', 'mykey')
+        journal.start('1234', 3)
+        journal.record_part(2, '"etag2"')
+        journal.close()
+
+        def check(task):
+            self.assertEqual(task.resumed, ('1234', {2: '"etag2"'}, True))
+            self.assertEqual(task.parts_generator.part_size, 3)
+            self.assertEqual(task.counter.completed, 1)
+
+        d = manager.upload(fd, 'mybucket', 'mykey', resume=True,
+                           reconcile=True)
+        return d.addCallback(check)
+
+    def test_resume_reconcile_without_list_parts(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          journal_dir=self.mktemp())
+        manager._client_for = lambda bucket: object()
+        self.assertRaises(ValueError, manager.upload, StringIO("some data"),
+                          'mybucket', 'mykey', resume=True, reconcile=True)
+
+    def test_resume_nothing_journaled(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          journal_dir=self.mktemp())
+
+        def check(task):
+            self.assertIdentical(getattr(task, 'resumed', None), None)
+            self.assertEqual(task.bucket, 'mybucket')
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey',
+                           resume=True)
+        return d.addCallback(check)
+
+    def test_single_put(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          single_put_threshold=10)
+        self.patch(up_module, 'SinglePutUpload', TestSinglePutUpload)
+
+        def check(task):
+            self.assertIsInstance(task, TestSinglePutUpload)
+            self.assertEqual(task.counter.expected, 1)
+            self.assertEqual(task.counter.expected_bytes, 9)
+            self.assertEqual(task.amz_headers, {'acl': 'public-read'})
+            self.assertIsInstance(task.client, S3Client)
+            self.failIf(manager.uploads)
+
+        d = manager.upload(StringIO("some data"), 'mybucket', 'mykey',
+                           amz_headers={'acl': 'public-read'})
+        return d.addCallback(check)
+
+    def test_single_put_not_used_with_part_arguments(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          single_put_threshold=10)
+        self.patch(up_module, 'SinglePutUpload', TestSinglePutUpload)
+        part_handler = DummyPartHandler()
+        ds = [manager.upload(StringIO("some data"), 'mybucket', 'mykey', **kw)
+              for kw in [{'parts_generator': FileIOPartsGenerator()},
+                         {'part_handler': part_handler},
+                         {'on_part_generated': lambda result: result}]]
+
+        def check(tasks):
+            for task in tasks:
+                self.assertIsInstance(task, TestMultipartUpload)
+            self.assertIdentical(tasks[1].part_handler, part_handler)
+
+        return gatherResults(ds).addCallback(check)
+
+    def test_single_put_threshold(self):
+        manager = MultipartUploadsManager(log=self.log,
+                                          single_put_threshold=9)
+        self.assert_(manager._use_single_put(StringIO("x" * 8)))
+        self.failIf(manager._use_single_put(StringIO("x" * 9)))
+        self.failIf(manager._use_single_put([]))
+        manager.single_put_threshold = None
+        self.failIf(manager._use_single_put(StringIO("x" * 8)))
+
+    def _write_files(self, count):
+        paths = []
+        for i in range(count):
+            path = self.mktemp() + '.txt'
+            with open(path, 'wb') as fd:
+                fd.write('data %d' % i)
+            paths.append(path)
+        return paths
+
+    def test_upload_many(self):
+        manager = MultipartUploadsManager(log=self.log)
+        (first, second) = self._write_files(2)
+        third = (lambda: (StringIO('more data'), 'third'))
+        results = []
+
+        def on_result(source, result):
+            results.append((source, result))
+
+        def check(counts):
+            self.assertEqual(counts, (3, 0))
+            self.assertEqual([r[0] for r in results],
+                             [first, (second, 'second'), third])
+            tasks = [r[1] for r in results]
+            self.assertEqual([t.object_name for t in tasks],
+                             [os.path.basename(first), 'second', 'third'])
+            self.assertEqual(tasks[0].fd.name, first)
+            self.assert_(tasks[0].fd.closed)
+            self.assertEqual(tasks[0].amz_headers, {'acl': 'public-read'})
+
+        d = manager.upload_many([first, (second, 'second'), third],
+                                'mybucket', concurrency=2,
+                                on_result=on_result,
+                                amz_headers={'acl': 'public-read'})
+        return d.addCallback(check)
+
+    def test_upload_many_failures(self):
+        manager = MultipartUploadsManager(log=self.log)
+        results = []
+        missing = self.mktemp()
+
+        def boom():
+            raise ValueError('boom')
+
+        def check(counts):
+            self.assertEqual(counts, (0, 2))
+            self.assertEqual([r[0] for r in results], [missing, boom])
+            results[0][1].trap(IOError)
+            results[1][1].trap(ValueError)
+
+        d = manager.upload_many([missing, boom], 'mybucket',
+            on_result=lambda *a: results.append(a))
+        return d.addCallback(check)
+
+    def test_upload_many_bounded_and_lazy(self):
+        manager = MultipartUploadsManager(log=self.log)
+        uploads = []
+        opened = []
+
+        def upload(fd, bucket, object_name, **kw):
+            d = Deferred()
+            uploads.append(d)
+            return d
+
+        def source(i):
+            def open_source():
+                opened.append(i)
+                return (StringIO('x'), 'key%d' % i)
+            return open_source
+
+        scheduled = []
+
+        def run():
+            while scheduled:
+                scheduled.pop(0)()
+
+        manager.upload = upload
+        manager.cooperator = Cooperator(scheduler=scheduled.append)
+        results = []
+        d = manager.upload_many((source(i) for i in range(5)), 'mybucket',
+            concurrency=2, on_result=lambda *a: results.append(a))
+        run()
+        self.assertEqual(opened, [0, 1])
+        task = TestMultipartUpload(None, None, None, None, None, None)
+        uploads[0].callback(task)
+        run()
+        self.assertEqual(opened, [0, 1, 2])
+        task = TestMultipartUpload(None, None, None, None, None, None)
+        task.failure = Failure(ValueError('woops'))
+        uploads[1].callback(task)
+        run()
+        self.assertEqual(opened, [0, 1, 2, 3])
+        for i in range(2, 5):
+            uploads[i].callback(TestMultipartUpload(None, None, None, None,
+                                                    None, None))
+            run()
+        self.assertEqual(opened, [0, 1, 2, 3, 4])
+        self.assertEqual(len(results), 5)
+        self.assertIdentical(results[1][1], task.failure)
+        return d.addCallback(self.assertEqual, (4, 1))
@@ -1,11 +1,14 @@
 from zope.interface import implements
 
 from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
 
 from txaws.s3.model import (MultipartInitiationResponse,
     MultipartCompletionResponse)
 
-from bafload.interfaces import ILog
+from bafload.interfaces import ILog, ITracer
 
 
 class FakeClock(object):
@@ -38,10 +41,22 @@ class FakeLog(object):
         self.buffer.append(('err', stuff, why, kw))
 
 
+class FakeTracer(object):
+    implements(ITracer)
+
+    def __init__(self):
+        self.events = []
+
+    def event(self, name, start, duration, **tags):
+        self.events.append((name, start, duration, tags))
+
+
 class FakeS3Client(object):
 
     def __init__(self):
         self.calls = []
+        self.completed = []
+        self.listed_parts = []
 
     def init_multipart_upload(self, bucket, object_name, content_type,
                               metadata, amz_headers={}):
@@ -53,10 +68,55 @@ class FakeS3Client(object):
     def upload_part(self, bucket, object_name, upload_id, part_number,
                     data=None, content_type=None, metadata={},
                     body_producer=None):
+        self.calls.append(('upload_part', bucket, object_name, upload_id,
+            part_number, data, body_producer))
         return succeed({'ETag': '"0123456789"'})
 
+    def put_object(self, bucket, object_name, data=None, content_type=None,
+                   metadata={}, amz_headers={}, body_producer=None):
+        self.calls.append(('put_object', bucket, object_name, data,
+            content_type, metadata, amz_headers))
+        return succeed('')
+
+    def list_parts(self, bucket, object_name, upload_id):
+        return succeed(self.listed_parts)
+
+    def abort_multipart_upload(self, bucket, object_name, upload_id):
+        self.calls.append(('abort_multipart_upload', bucket, object_name,
+            upload_id))
+        return succeed(None)
+
     def complete_multipart_upload(self, bucket, object_name, upload_id,
                                   parts_list):
+        self.completed.append((upload_id, sorted(parts_list)))
         return succeed(MultipartCompletionResponse(
             'http://%s.example.com/%s' % (bucket, object_name),
             bucket, object_name, '"0123456789"'))
+
+
+class FakeResponse(object):
+
+    def __init__(self, code=200, headers={}, body=''):
+        self.code = code
+        self.headers = Headers(dict((k, [v]) for (k, v) in headers.items()))
+        self.length = len(body)
+        self.body = body
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+    """
+    Agent recording the requests made with it and answering them with
+    C{responses} in turn.
+    """
+
+    def __init__(self, *responses):
+        self.requests = []
+        self.responses = list(responses)
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers, bodyProducer))
+        return succeed(self.responses.pop(0))
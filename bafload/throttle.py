@@ -2,9 +2,42 @@ from collections import deque
 
 from zope.interface import implements
 
+from twisted.internet import reactor
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from twisted.web.iweb import IBodyProducer
 
-from bafload.interfaces import IThrottler
+from bafload import adapters
+from bafload.interfaces import (IThrottler, IFairThrottler, IBuffer,
+        IByteLength)
+from bafload.retry import is_retryable
+
+
+class _Call(object):
+    """
+    A call waiting in a throttler's backlog. Cancelling its C{deferred}
+    removes the call from the backlog with C{dequeue} or, once the call
+    has started, cancels the call.
+    """
+
+    started = None
+
+    def __init__(self, func, args, kwargs, dequeue):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.dequeue = dequeue
+        self.deferred = Deferred(self._cancel)
+
+    def start(self, do_call):
+        self.started = do_call(self.func, self.args, self.kwargs)
+        self.started.chainDeferred(self.deferred)
+
+    def _cancel(self, d):
+        if self.started is not None:
+            self.started.cancel()
+        else:
+            self.dequeue(self)
 
 
 class PassThruThrottler(object):
@@ -22,10 +55,25 @@ class MaxConcurrentThrottler(object):
         self.pending = 0
         self._backlog = deque()
 
+    @property
+    def running(self):
+        """
+        Number of calls made and not yet finished.
+        """
+        return self.pending - self.waiting
+
+    @property
+    def waiting(self):
+        """
+        Number of calls waiting to be made.
+        """
+        return len(self._backlog)
+
     def throttle(self, func, *args, **kwargs):
         if self.pending >= self.max:
-            d = Deferred()
-            self._backlog.append((d, func, args, kwargs))
+            call = _Call(func, args, kwargs, self._dequeue)
+            self._backlog.append(call)
+            d = call.deferred
         else:
             d = self._do_call(func, args, kwargs)
         self.pending += 1
@@ -36,9 +84,426 @@ class MaxConcurrentThrottler(object):
         d.addBoth(self._finish_call)
         return d
 
+    def _dequeue(self, call):
+        self._backlog.remove(call)
+        self.pending -= 1
+
     def _finish_call(self, passthru):
         self.pending -= 1
         if self._backlog:
-            (d, func, args, kwargs) = self._backlog.popleft()
-            self._do_call(func, args, kwargs).chainDeferred(d)
+            self._backlog.popleft().start(self._do_call)
+        return passthru
+
+
+class FairThrottler(object):
+    """
+    Throttler allowing at most C{max} concurrent calls which, when calls
+    must wait, takes them round-robin from its queues instead of first come
+    first served. A queue with many waiting calls (a large upload) so
+    cannot hold back calls of queues behind it (small uploads), and calls
+    of the C{control_throttler} skip all queues.
+
+    Calls made to the throttler directly share a default queue.
+
+    Calls leaving the queues are passed on to C{throttler}, so a
+    L{ByteRateThrottler} given as C{throttler} limits the rate of all
+    queues without hiding them from the managers installing them::
+
+        manager = MultipartUploadsManager(throttler=FairThrottler(
+            throttler=ByteRateThrottler(2**20)))
+
+    @param max: Maximum number of concurrent calls
+    @param throttler: L{IThrottler} calls are passed on to as they leave
+        the queues. default: a L{PassThruThrottler}
+    """
+    implements(IFairThrottler)
+
+    def __init__(self, max=10, throttler=None):
+        if throttler is None:
+            throttler = PassThruThrottler()
+        self.max = max
+        self.throttler = throttler
+        self.pending = 0
+        self.control_throttler = _ControlQueue(self)
+        self._control = deque()
+        self._ready = deque()
+        self._default = self.queue()
+
+    @property
+    def running(self):
+        """
+        Number of calls made and not yet finished.
+        """
+        return self.pending - self.waiting
+
+    @property
+    def waiting(self):
+        """
+        Number of calls waiting to be made.
+        """
+        return len(self._control) + sum(len(q.backlog) for q in self._ready)
+
+    def throttle(self, func, *args, **kwargs):
+        return self._default.throttle(func, *args, **kwargs)
+
+    def queue(self, weight=1):
+        return _FairQueue(self, weight)
+
+    def _call(self, queue, func, args, kwargs):
+        if self.pending >= self.max:
+            call = _Call(func, args, kwargs, self._dequeue)
+            call.queue = queue
+            if queue is None:
+                self._control.append(call)
+            else:
+                if not queue.backlog:
+                    self._ready.append(queue)
+                queue.backlog.append(call)
+            d = call.deferred
+        else:
+            d = self._do_call(func, args, kwargs)
+        self.pending += 1
+        return d
+
+    def _dequeue(self, call):
+        queue = call.queue
+        if queue is None:
+            self._control.remove(call)
+        else:
+            queue.backlog.remove(call)
+            if not queue.backlog:
+                self._ready.remove(queue)
+                queue.turns = 0
+        self.pending -= 1
+
+    def _do_call(self, func, args, kwargs):
+        d = self.throttler.throttle(func, *args, **kwargs)
+        d.addBoth(self._finish_call)
+        return d
+
+    def _finish_call(self, passthru):
+        self.pending -= 1
+        call = self._next_call()
+        if call is not None:
+            call.start(self._do_call)
         return passthru
+
+    def _next_call(self):
+        if self._control:
+            return self._control.popleft()
+        if not self._ready:
+            return None
+        queue = self._ready[0]
+        call = queue.backlog.popleft()
+        queue.turns += 1
+        if not queue.backlog:
+            self._ready.popleft()
+            queue.turns = 0
+        elif queue.turns >= queue.weight:
+            self._ready.rotate(-1)
+            queue.turns = 0
+        return call
+
+
+class _FairQueue(object):
+    """
+    A queue of a L{FairThrottler}.
+    """
+    implements(IThrottler)
+
+    def __init__(self, throttler, weight):
+        self.throttler = throttler
+        self.weight = weight
+        self.turns = 0
+        self.backlog = deque()
+
+    def throttle(self, func, *args, **kwargs):
+        return self.throttler._call(self, func, args, kwargs)
+
+
+class _ControlQueue(object):
+    """
+    The priority queue of a L{FairThrottler}.
+    """
+    implements(IThrottler)
+
+    def __init__(self, throttler):
+        self.throttler = throttler
+
+    def throttle(self, func, *args, **kwargs):
+        return self.throttler._call(None, func, args, kwargs)
+
+
+class AIMDThrottler(object):
+    """
+    Throttler whose limit on concurrent calls (its window) adapts like TCP
+    congestion control: additive increase, by C{increase} for every
+    window's worth of calls which complete with a latency near the
+    baseline, and multiplicative decrease, by a factor of C{decrease}, when
+    a call fails with a sign of congestion (throttling, a server error or a
+    timed out or reset connection, as told by C{classify}) or takes
+    C{latency_factor} times longer than the baseline. Other failures, such
+    as cancelled calls or 403 Forbidden, leave the window alone. The window
+    decreases at most once per baseline latency so a burst of errors from
+    one overloaded moment shrinks it only once.
+
+    Calls sending a payload (see L{payload_size}) are compared by their
+    latency per byte against a baseline of their own, so fast control calls
+    don't make every part upload look congested, nor large parts small
+    ones. Each baseline is a slow moving average of all calls, updated
+    before the comparison, so it follows a persistently slower service
+    rather than shrinking the window for good. L{baseline} averages the
+    plain latencies and paces the decreases.
+
+    @param initial: Initial window
+    @param minimum: Smallest window
+    @param maximum: Largest window
+    @param increase: Window increase per window's worth of calls
+    @param decrease: Factor the window is multiplied by on congestion
+    @param latency_factor: Calls with a latency this many times the
+        baseline are taken as congestion.
+    @param classify: Callable taking the L{Failure} of a call, returning
+        True if it is a sign of congestion. default:
+        L{bafload.retry.is_retryable}
+    @param clock: Provider of C{seconds()}. default: the global reactor
+    """
+    implements(IThrottler)
+
+    baseline = None
+    baseline_weight = 0.1
+
+    def __init__(self, initial=10, minimum=1, maximum=200, increase=1,
+                 decrease=0.5, latency_factor=2.0, classify=is_retryable,
+                 clock=None):
+        if clock is None:
+            clock = reactor
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.classify = classify
+        self.clock = clock
+        self.running = 0
+        self._backlog = deque()
+        self._baselines = {}
+        self._last_decrease = None
+
+    @property
+    def max(self):
+        """
+        The current limit on concurrent calls.
+        """
+        return max(self.minimum, int(self.window))
+
+    @property
+    def waiting(self):
+        """
+        Number of calls waiting to be made.
+        """
+        return len(self._backlog)
+
+    def throttle(self, func, *args, **kwargs):
+        if self._backlog or self.running >= self.max:
+            call = _Call(func, args, kwargs, self._backlog.remove)
+            self._backlog.append(call)
+            return call.deferred
+        return self._do_call(func, args, kwargs)
+
+    def _do_call(self, func, args, kwargs):
+        self.running += 1
+        size = payload_size(args, kwargs)
+        d = func(*args, **kwargs)
+        d.addBoth(self._finish_call, self.clock.seconds(), size)
+        return d
+
+    def _finish_call(self, passthru, started, size):
+        self.running -= 1
+        now = self.clock.seconds()
+        if isinstance(passthru, Failure):
+            if self.classify(passthru):
+                self._congested(now)
+        else:
+            self._sample(now - started, size, now)
+        while self._backlog and self.running < self.max:
+            self._backlog.popleft().start(self._do_call)
+        return passthru
+
+    def _sample(self, latency, size, now):
+        self.baseline = self._average(self.baseline, latency)
+        if size:
+            cost = float(latency) / size
+        else:
+            cost = latency
+        kind = bool(size)
+        baseline = self._baselines[kind] = self._average(
+            self._baselines.get(kind), cost)
+        if cost > baseline * self.latency_factor:
+            self._congested(now)
+            return
+        self.window = min(self.maximum,
+                          self.window + float(self.increase) / self.window)
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        w = self.baseline_weight
+        return average * (1 - w) + sample * w
+
+    def _congested(self, now):
+        if self._last_decrease is not None and \
+                now - self._last_decrease < (self.baseline or 0):
+            return
+        self._last_decrease = now
+        self.window = max(self.minimum, self.window * self.decrease)
+
+
+PAYLOAD_ARGUMENTS = ('data', 'body_producer', 'part')
+
+
+def payload_size(args, kwargs):
+    """
+    Return the number of bytes a call with C{args} and C{kwargs} sends:
+    the total length of its L{PAYLOAD_ARGUMENTS}, passed by keyword as
+    C{put_object}, C{upload_part} and C{handle_part} calls are made.
+    Bucket names, keys and upload ids are not payload, so control calls
+    such as C{complete_multipart_upload} weigh nothing.
+    """
+    size = 0
+    for name in PAYLOAD_ARGUMENTS:
+        arg = kwargs.get(name)
+        if IBuffer.providedBy(arg) or IBodyProducer.providedBy(arg):
+            size += IByteLength(arg, 0)
+    return size
+
+
+class ByteRateThrottler(object):
+    """
+    Throttler limiting the rate at which bytes are sent with a token
+    bucket. Each call is charged its L{payload_size}; calls wait, in order,
+    until the bucket holds that many tokens (or is full, for calls larger
+    than the bucket) and are then passed on to C{throttler}. The bucket
+    refills at C{rate} bytes per second up to C{burst} bytes.
+
+    A call may take the bucket below empty, so calls of any size are
+    charged in full and the average rate holds, while a call is never
+    delayed longer than the calls before it require. Calls sending no
+    payload, such as completing an upload, are passed on at once.
+
+    One instance may be shared by several managers for a process-wide
+    limit, and chained for a per-manager limit within it::
+
+        process_limit = ByteRateThrottler(10 * 2**20)
+        manager = MultipartUploadsManager(throttler=ByteRateThrottler(
+            2**20, throttler=process_limit))
+
+    To rate-limit a L{FairThrottler}, give the L{ByteRateThrottler} to the
+    L{FairThrottler} as its C{throttler} rather than the other way round:
+    managers only give each upload its own queue of a L{FairThrottler}
+    they are given directly.
+
+    @param rate: Bytes per second, more than 0
+    @param burst: Size of the bucket in bytes. default: C{rate}
+    @param throttler: L{IThrottler} calls are passed on to once charged.
+        default: a L{PassThruThrottler}
+    @param clock: L{twisted.internet.interfaces.IReactorTime} provider.
+        default: the global reactor
+    """
+    implements(IThrottler)
+
+    def __init__(self, rate, burst=None, throttler=None, clock=None):
+        _check_rate(rate)
+        if burst is None:
+            burst = rate
+        if throttler is None:
+            throttler = PassThruThrottler()
+        if clock is None:
+            clock = reactor
+        self.rate = float(rate)
+        self.burst = burst
+        self.throttler = throttler
+        self.clock = clock
+        self.tokens = float(burst)
+        self._updated = clock.seconds()
+        self._backlog = deque()
+        self._timer = None
+
+    @property
+    def waiting(self):
+        """
+        Number of calls waiting for tokens.
+        """
+        return len(self._backlog)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate (and optionally the burst) of the bucket; waiting
+        calls are rescheduled for the new rate.
+        """
+        _check_rate(rate)
+        self._refill()
+        self.rate = float(rate)
+        if burst is not None:
+            self.burst = burst
+        self.tokens = min(self.tokens, self.burst)
+        self._reschedule()
+
+    def throttle(self, func, *args, **kwargs):
+        size = payload_size(args, kwargs)
+        if not size:
+            return self._do_call(func, args, kwargs)
+        call = _Call(func, args, kwargs, self._dequeue)
+        call.size = size
+        self._backlog.append(call)
+        if self._timer is None:
+            self._drain()
+        return call.deferred
+
+    def _dequeue(self, call):
+        head = self._backlog[0] is call
+        self._backlog.remove(call)
+        if head:
+            # The timer was waiting for tokens for this call.
+            self._reschedule()
+
+    def _reschedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._drain()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _drain(self):
+        self._refill()
+        while self._backlog:
+            call = self._backlog[0]
+            needed = min(call.size, self.burst)
+            if self.tokens < needed:
+                delay = (needed - self.tokens) / self.rate
+                self._timer = self.clock.callLater(delay, self._wake)
+                return
+            self._backlog.popleft()
+            self.tokens -= call.size
+            call.start(self._do_call)
+
+    def _do_call(self, func, args, kwargs):
+        return self.throttler.throttle(func, *args, **kwargs)
+
+    def _wake(self):
+        self._timer = None
+        self._drain()
+
+
+def _check_rate(rate):
+    if not rate > 0:
+        raise ValueError('rate must be more than 0, not %r' % (rate,))
+
+
+# make pyflakes happy
+_PYFLAKES = [adapters]
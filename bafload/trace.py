@@ -0,0 +1,125 @@
+"""
+Tracing uploads.
+
+Uploads emit an event to their L{ITracer}s for every call they make to S3
+(each attempt of C{init}, C{upload_part}, C{complete}, C{abort} and so
+on) and for every part they read. A L{JSONLinesExporter} writes the events
+to a file for offline analysis and L{UploadTimings}, which every upload
+keeps as its C{timings}, breaks down the time of one upload by phase.
+"""
+import json
+
+from zope.interface import implements
+
+from bafload.interfaces import ITracer
+
+
+__all__ = ['UploadTimings', 'JSONLinesExporter']
+
+
+class UploadTimings(object):
+    """
+    Breakdown of the time of one upload by phase.
+
+    @ivar phases: C{dict} of event name to a list of the number of events
+        and their total duration in seconds.
+    @ivar queued: Total seconds calls waited in the throttler
+    @ivar retries: Number of calls which were retries
+    @ivar failures: Number of calls which failed
+    @ivar bytes: Bytes of parts (or objects) uploaded
+    @ivar started: Start of the first event, or None
+    @ivar finished: End of the last event, or None
+    """
+    implements(ITracer)
+
+    queued = 0
+    retries = 0
+    failures = 0
+    bytes = 0
+    started = None
+    finished = None
+
+    def __init__(self):
+        self.phases = {}
+
+    @property
+    def elapsed(self):
+        """
+        Seconds from the start of the first event to the end of the last.
+        """
+        if self.started is None:
+            return 0
+        return self.finished - self.started
+
+    def event(self, name, start, duration, **tags):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0]
+        phase[0] += 1
+        phase[1] += duration
+        self.queued += tags.get('queued', 0)
+        if tags.get('attempt', 1) > 1:
+            self.retries += 1
+        if 'error' in tags:
+            self.failures += 1
+        elif name != 'read':
+            self.bytes += tags.get('bytes', 0)
+        if self.started is None or start < self.started:
+            self.started = start
+        if self.finished is None or start + duration > self.finished:
+            self.finished = start + duration
+
+    def breakdown(self):
+        """
+        Return a C{dict} of event name to total seconds, plus seconds
+        C{'queued'}.
+        """
+        breakdown = dict((name, seconds)
+                         for (name, (count, seconds)) in self.phases.items())
+        breakdown['queued'] = self.queued
+        return breakdown
+
+
+class JSONLinesExporter(object):
+    """
+    Tracer writing events to a file as JSON objects, one per line, with
+    the keys C{event}, C{start} and C{duration} and the event's tags.
+    Lines are buffered and written C{buffer_size} at a time, so the file
+    must be flushed with L{flush} or L{close} once uploads are finished.
+
+    @param fd: A file-like object to write lines to
+    @param buffer_size: Number of events buffered before writing
+    """
+    implements(ITracer)
+
+    def __init__(self, fd, buffer_size=1000):
+        self.fd = fd
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._encode = json.JSONEncoder(separators=(',', ':'),
+                                        default=str).encode
+
+    def event(self, name, start, duration, **tags):
+        tags['event'] = name
+        tags['start'] = start
+        tags['duration'] = duration
+        self._buffer.append(self._encode(tags))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered events.
+        """
+        if self._buffer:
+            self._buffer.append('')
+            self.fd.write('\n'.join(self._buffer))
+            self._buffer = []
+        self.fd.flush()
+
+    def close(self):
+        """
+        Write the buffered events and close the file.
+        """
+        self.flush()
+        self.fd.close()
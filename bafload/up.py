@@ -1,16 +1,36 @@
 # Copryright 2012 Drew Smathers, See LICENSE
+import mimetypes
+import mmap
+import os
+import threading
+from collections import deque
+
 from zope.interface import implements
 
-from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet import reactor as _reactor
+from twisted.internet.defer import (Deferred, gatherResults,
+        CancelledError,
+        maybeDeferred)
+from twisted.internet import task
 from twisted.internet.task import coiterate
+from twisted.internet.threads import deferToThreadPool
 from twisted.python.failure import Failure
+from twisted.web.iweb import IBodyProducer
 
+from txaws.s3.model import MultipartInitiationResponse
 from txaws.service import AWSServiceRegion
 
 from bafload import adapters
+from bafload.client import get_s3_client
 from bafload.interfaces import (IPartHandler, IPartsGenerator,
-        IMultipartUploadsManager, IByteLength)
+        IMultipartUploadsManager, IByteLength, IBuffer, IFairThrottler)
 from bafload.common import BaseCounter, ProgressLoggerMixin
+from bafload.producers import FileRangeBodyProducer
+from bafload.sizing import PartSizePolicy
+from bafload.journal import JournalDirectory
+from bafload.hedge import HedgingPartHandler
+from bafload.pool import ClientPool
+from bafload.trace import UploadTimings
 from bafload.retry import BinaryExponentialBackoff
 from bafload.throttle import MaxConcurrentThrottler
 
@@ -18,26 +38,172 @@ from bafload.throttle import MaxConcurrentThrottler
 DEFAULT_PART_SIZE = 0x500000
 
 
+class _TracedTaskMixin(object):
+    """
+    Calls of an upload task with retries, tracing each attempt with the
+    task's L{UploadTimings}, L{bafload.stats.LatencyStats} (if any) and
+    L{ITracer} (if any).
+
+    Classes using the mixin must define C{_trace_tags()}, returning the
+    tags of all events of the task: its C{bucket}, C{key} and
+    C{upload_id}.
+    """
+
+    clock = _reactor
+    latencies = None
+    tracer = None
+    timings = None
+
+    def _trace(self, name, start, duration, **tags):
+        for (tag, value) in self._trace_tags().iteritems():
+            tags.setdefault(tag, value)
+        self.timings.event(name, start, duration, **tags)
+        for tracer in (self.latencies, self.tracer):
+            if tracer is not None:
+                tracer.event(name, start, duration, **tags)
+
+    def _retry(self, phase, tags, throttle, f, *args, **kwargs):
+        """
+        Call C{f} with the task's retry strategy, each attempt through
+        C{throttle}, tracing each attempt as an event C{phase} with
+        C{tags}.
+        """
+        attempts = []
+        return self.retry_strategy.retry(self._attempt, phase, tags, attempts,
+                                         throttle, f, *args, **kwargs)
+
+    def _attempt(self, phase, tags, attempts, throttle, f, *args, **kwargs):
+        attempts.append(None)
+        attempt = len(attempts)
+        queued_at = self.clock.seconds()
+
+        def dequeued(*args, **kwargs):
+            start = self.clock.seconds()
+            d = maybeDeferred(f, *args, **kwargs)
+            d.addBoth(self._traced, phase, tags, attempt, start - queued_at,
+                      start)
+            return d
+
+        return throttle(dequeued, *args, **kwargs)
+
+    def _traced(self, result, phase, tags, attempt, queued, start):
+        tags = dict(tags, attempt=attempt, queued=queued)
+        if isinstance(result, Failure):
+            tags['error'] = result.getErrorMessage()
+        elif isinstance(result, MultipartInitiationResponse):
+            tags['upload_id'] = result.upload_id
+        self._trace(phase, start, self.clock.seconds() - start, **tags)
+        return result
+
+
 class PartsTransferredCounter(BaseCounter):
     receiving = False
 
 
+class PartsTracker(object):
+    """
+    Completion of the parts of a multipart upload. The results of parts
+    (the (part_number, etag) pairs of their part handler) are kept in a
+    list indexed by part number, preallocated for C{expected} parts, and
+    C{done} fires with the tracker once it's closed and no parts are
+    outstanding. Only the L{Deferred}s of parts in flight are kept, for
+    cancelling.
+
+    @param expected: Number of parts expected, if known
+    @ivar outstanding: Number of parts tracked but not yet finished
+    @ivar in_flight: C{dict} of part number to the L{Deferred} of each
+        outstanding part
+    @ivar failure: The L{Failure} of the first part to fail, or None
+    """
+
+    failure = None
+    closed = False
+
+    def __init__(self, expected=0):
+        self.results = [None] * expected
+        self.outstanding = 0
+        self.in_flight = {}
+        self.done = Deferred()
+
+    def track(self, part_number, d):
+        """
+        Track part C{part_number} finishing when C{d} fires. Errors of
+        C{d} are consumed.
+        """
+        self.outstanding += 1
+        self.in_flight[part_number] = d
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(part_number,),
+                       errbackArgs=(part_number,))
+
+    def close(self):
+        """
+        Stop tracking parts: C{done} fires once those outstanding finish.
+        """
+        self.closed = True
+        self._check()
+
+    def parts(self):
+        """
+        Return the results of the parts which succeeded, by part number.
+        """
+        return [result for result in self.results if result is not None]
+
+    def _succeeded(self, result, part_number):
+        results = self.results
+        if part_number > len(results):
+            # More parts than expected: grow geometrically.
+            results.extend([None] * max(part_number - len(results),
+                                        len(results)))
+        results[part_number - 1] = result
+        self._finished(part_number)
+
+    def _failed(self, why, part_number):
+        if self.failure is None:
+            self.failure = why
+        self._finished(part_number)
+
+    def _finished(self, part_number):
+        del self.in_flight[part_number]
+        self.outstanding -= 1
+        self._check()
+
+    def _check(self):
+        if self.closed and not self.outstanding and self.done is not None:
+            d = self.done
+            self.done = None
+            d.callback(self)
+
+
 class FileIOPartsGenerator(ProgressLoggerMixin):
+    """
+    Parts generator which reads parts from a file-like object.
+
+    Part numbers in C{skip_parts} (parts already uploaded by an earlier,
+    resumed upload) are not generated and their data is not read.
+    """
     implements(IPartsGenerator)
 
     part_size = DEFAULT_PART_SIZE
+    skip_parts = frozenset()
 
     def generate_parts(self, fd):
         seek = fd.seek
         read = fd.read
         size = self.part_size
+        skip = self.skip_parts
         seek(0)
         part_number = 1
-        part = read(size)
-        while part:
+        while True:
+            if part_number in skip:
+                seek(size, os.SEEK_CUR)
+                part_number += 1
+                continue
+            part = read(size)
+            if not part:
+                break
             yield (part, part_number)
             part_number += 1
-            part = read(size)
 
     def count_parts(self, fd):
         try:
@@ -50,6 +216,248 @@ class FileIOPartsGenerator(ProgressLoggerMixin):
         return count
 
 
+class MmapPartsGenerator(FileIOPartsGenerator):
+    """
+    Parts generator which memory-maps the file and generates zero-copy
+    slices of the mapping rather than reading each part into a new string.
+    In-memory sources (providers of L{IBuffer}) are sliced directly.
+
+    Only the pages of parts still referenced (in flight or being retried)
+    stay resident, so memory use follows upload concurrency rather than
+    the size of the file.
+    """
+
+    def generate_parts(self, fd):
+        data = self._map(fd)
+        if data is None:
+            return
+        try:
+            view = memoryview(data)
+        except TypeError:
+            # mmap only exposes the old buffer interface on Python 2;
+            # buffer() slices are zero-copy as well.
+            view = None
+        size = self.part_size
+        skip = self.skip_parts
+        for (part_number, offset) in enumerate(xrange(0, len(data), size), 1):
+            if part_number in skip:
+                continue
+            if view is None:
+                part = buffer(data, offset, size)
+            else:
+                part = view[offset:offset + size]
+            yield (part, part_number)
+
+    def _map(self, fd):
+        if IBuffer.providedBy(fd):
+            return fd
+        if not IByteLength(fd):
+            # Empty files cannot be mapped
+            return None
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _PositionalReader(object):
+    """
+    Positional reads of a file from the threads of a thread pool.
+
+    Without C{os.pread} (Python 2), each thread reads through its own file
+    descriptor for the file, opened on the thread's first read, so reads
+    in different threads run in parallel and never move the offset of the
+    file object being uploaded. Sources without a path to open again are
+    read through their own descriptor one read at a time.
+
+    Descriptors opened are closed by L{close} once no reads are running.
+
+    @param fd: The file object to read
+    """
+
+    def __init__(self, fd):
+        self.fileno = fd.fileno()
+        self.path = getattr(fd, 'name', None)
+        if not isinstance(self.path, basestring) or \
+                not os.path.isfile(self.path):
+            self.path = None
+        self.reading = 0
+        self.closed = False
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def read(self, size, offset):
+        """
+        Read up to C{size} bytes at C{offset}. Called in a thread.
+        """
+        chunks = []
+        while size:
+            chunk = self._read_once(size, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            offset += len(chunk)
+        return ''.join(chunks)
+
+    def _read_once(self, size, offset):
+        pread = getattr(os, 'pread', None)
+        if pread is not None:
+            return pread(self.fileno, size, offset)
+        if self.path is None:
+            with self._lock:
+                os.lseek(self.fileno, offset, os.SEEK_SET)
+                return os.read(self.fileno, size)
+        fileno = getattr(self._local, 'fileno', None)
+        if fileno is None:
+            fileno = self._local.fileno = os.open(self.path, os.O_RDONLY)
+            with self._lock:
+                self._opened.append(fileno)
+        os.lseek(fileno, offset, os.SEEK_SET)
+        return os.read(fileno, size)
+
+    def started(self):
+        self.reading += 1
+
+    def finished(self, result):
+        self.reading -= 1
+        self._close_opened()
+        return result
+
+    def close(self):
+        """
+        Close the descriptors opened for reading once reads in flight are
+        done.
+        """
+        self.closed = True
+        self._close_opened()
+
+    def _close_opened(self):
+        if not self.closed or self.reading:
+            return
+        while self._opened:
+            os.close(self._opened.pop())
+
+
+class ThreadPoolPartsGenerator(FileIOPartsGenerator):
+    """
+    Parts generator which reads each part with a positional read on a
+    thread pool so the reactor never blocks on the filesystem. Parts are
+    generated as L{Deferred}s firing with the part data, with up to
+    C{reads} reads in flight ahead of the upload.
+
+    If C{byte_budget} is set, as L{MultipartUpload} does with its own, each
+    read first reserves a part's worth of bytes from it, so parts read
+    ahead count against the budget too. A part generated hands its
+    reservation over to the upload; parts read ahead but never generated
+    (because the upload stopped) return theirs.
+
+    @param threadpool: The L{twisted.python.threadpool.ThreadPool} to read
+        on. default: the reactor's thread pool
+    @param reads: Maximum number of reads in flight.
+    @param reactor: The reactor to deliver results on. default: the global
+        reactor
+    """
+
+    byte_budget = None
+
+    def __init__(self, threadpool=None, reads=4, reactor=None):
+        if reactor is None:
+            reactor = _reactor
+        self.threadpool = threadpool
+        self.reads = reads
+        self.reactor = reactor
+
+    def generate_parts(self, fd):
+        reader = _PositionalReader(fd)
+        size = self.part_size
+        skip = self.skip_parts
+        reading = deque()
+        offsets = xrange(0, IByteLength(fd), size)
+        try:
+            for (part_number, offset) in enumerate(offsets, 1):
+                if part_number in skip:
+                    continue
+                reading.append(self._reserve_and_read(reader, size, offset,
+                                                      part_number))
+                if len(reading) >= self.reads:
+                    yield reading.popleft()[:2]
+            while reading:
+                yield reading.popleft()[:2]
+        finally:
+            reader.close()
+            for (part, part_number, granted) in reading:
+                self._return_bytes(part, granted)
+
+    def _reserve_and_read(self, reader, size, offset, part_number):
+        """
+        Return a (part, part_number, granted) triple for a read of the part
+        at C{offset}, made once the byte budget (if any) grants a part's
+        worth of bytes; C{granted} is a list which holds True once it has.
+        """
+        budget = self.byte_budget
+        if budget is None:
+            return (self._read(reader, size, offset), part_number, [True])
+        granted = []
+
+        def reserved(ignore):
+            granted.append(True)
+            return self._read(reader, size, offset)
+
+        def failed(why):
+            if granted:
+                budget.release(self.part_size)
+            return why
+
+        d = budget.acquire(self.part_size)
+        d.addCallback(reserved)
+        d.addErrback(failed)
+        return (d, part_number, granted)
+
+    def _return_bytes(self, part, granted):
+        """
+        Return the bytes reserved for a part read ahead but not generated.
+        """
+        budget = self.byte_budget
+        if budget is None:
+            return
+        if not granted:
+            part.cancel()
+            part.addErrback(lambda why: None)
+            return
+        # Failed reads have returned their bytes already.
+        part.addCallbacks(lambda ignore: budget.release(self.part_size),
+                          lambda why: None)
+
+    def _read(self, reader, size, offset):
+        if self.threadpool is None:
+            self.threadpool = self.reactor.getThreadPool()
+        reader.started()
+        d = deferToThreadPool(self.reactor, self.threadpool, reader.read,
+                              size, offset)
+        return d.addBoth(reader.finished)
+
+
+class StreamingPartsGenerator(FileIOPartsGenerator):
+    """
+    Parts generator which generates a L{FileRangeBodyProducer} for each part
+    instead of the part's data, so a part is streamed from disk to the
+    connection as it is sent and never held in memory as a whole. Retries
+    read the part from disk again.
+    """
+
+    read_size = FileRangeBodyProducer.read_size
+
+    def generate_parts(self, fd):
+        size = self.part_size
+        length = IByteLength(fd)
+        skip = self.skip_parts
+        for (part_number, offset) in enumerate(xrange(0, length, size), 1):
+            if part_number in skip:
+                continue
+            producer = FileRangeBodyProducer(fd, offset,
+                min(size, length - offset), read_size=self.read_size)
+            yield (producer, part_number)
+
+
 class SingleProcessPartUploader(ProgressLoggerMixin):
     implements(IPartHandler)
 
@@ -59,8 +467,12 @@ class SingleProcessPartUploader(ProgressLoggerMixin):
     client = None
 
     def handle_part(self, part, part_number):
-        d = self.client.upload_part(self.bucket, self.object_name,
-            self.upload_id, part_number, part)
+        if IBodyProducer.providedBy(part):
+            d = self.client.upload_part(self.bucket, self.object_name,
+                self.upload_id, part_number, body_producer=part)
+        else:
+            d = self.client.upload_part(self.bucket, self.object_name,
+                self.upload_id, part_number, part)
         d.addCallback(self._handle_headers, part_number)
         return d
 
@@ -68,14 +480,23 @@ class SingleProcessPartUploader(ProgressLoggerMixin):
         return (part_number, headers['ETag'])
 
 
-class MultipartUpload(ProgressLoggerMixin):
+class MultipartUpload(ProgressLoggerMixin, _TracedTaskMixin):
 
     init_response = None
     completion_response = None
+    failure = None
     on_part_generated = None
     retry_strategy = BinaryExponentialBackoff()
     throughput_counter = None
     throttler = MaxConcurrentThrottler()
+    control_throttler = None
+    byte_budget = None
+    bytes_in_flight = 0
+    journal = None
+    cancelled = None
+    _control = None
+    _waiting = None
+    _tracker = None
 
     def __init__(self, client, fd, parts_generator, part_handler, counter,
                  finished, log=None):
@@ -85,45 +506,258 @@ class MultipartUpload(ProgressLoggerMixin):
         self.part_handler = part_handler
         self.counter = counter
         self.finished = finished
+        self.completed_parts = {}
+        self.timings = UploadTimings()
         self.set_log(log)
 
     def upload(self, bucket, object_name, content_type, metadata,
                amz_headers={}):
         self.part_handler.bucket = bucket
         self.part_handler.object_name = object_name
-        retry = self.retry_strategy.retry
-        d = retry(self.throttler.throttle,
+        d = self._control = self._retry('init', {}, self._control_throttle,
                   self.client.init_multipart_upload, bucket, object_name,
                   content_type=content_type, metadata=metadata,
                   amz_headers=amz_headers)
-        d.addCallback(self._initialized)
+        d.addCallbacks(self._initialized, self._error)
+
+    def resume(self, bucket, object_name, upload_id, parts, reconcile=False):
+        """
+        Resume the multipart upload C{upload_id}, uploading only the parts
+        missing from C{parts}.
+
+        @param parts: C{dict} of part number to ETag of uploaded parts
+        @param reconcile: If True, replace C{parts} (and the parts recorded
+            in the journal, if any) with the parts S3 lists for the upload;
+            the client must then provide C{list_parts} which fires with
+            (part_number, etag) pairs, as L{bafload.client.S3Client} does.
+        """
+        self.part_handler.bucket = bucket
+        self.part_handler.object_name = object_name
+        self.completed_parts = dict(parts)
+        response = MultipartInitiationResponse(bucket, object_name, upload_id)
+        if not reconcile:
+            self._initialized(response)
+            return
+        d = self._control = self._retry('list_parts', {},
+                  self._control_throttle, self.client.list_parts, bucket,
+                  object_name, upload_id)
+        d.addCallback(self._reconciled, response)
+        d.addErrback(self._error)
+
+    def cancel(self, why=None):
+        """
+        Stop the upload: stop generating parts, cancel those waiting and in
+        flight and abort the multipart upload, if the client supports
+        C{abort_multipart_upload} and the upload isn't journaled (a
+        journaled upload is kept so it can be resumed).
+
+        @param why: The L{Failure} finished fails with. default: a
+            L{CancelledError}
+        """
+        if self.finished is None or self.cancelled is not None:
+            return
+        if why is None:
+            why = Failure(CancelledError('Upload cancelled'))
+        self.cancelled = why
+        work = []
+        if self._tracker is not None:
+            # Cancel the newest parts first so parts in flight finishing
+            # don't start queued ones.
+            in_flight = self._tracker.in_flight
+            work = [in_flight[part_number]
+                    for part_number in sorted(in_flight, reverse=True)]
+        for d in [self._waiting] + work + [self._control]:
+            if d is not None:
+                d.cancel()
+
+    def _control_throttle(self, func, *args, **kwargs):
+        """
+        Throttle a call which isn't a part upload with control_throttler,
+        if any, or else throttler.
+        """
+        throttler = self.control_throttler
+        if throttler is None:
+            throttler = self.throttler
+        return throttler.throttle(func, *args, **kwargs)
+
+    def _trace_tags(self):
+        upload_id = None
+        if self.init_response is not None:
+            upload_id = self.init_response.upload_id
+        return {'bucket': self.part_handler.bucket,
+                'key': self.part_handler.object_name,
+                'upload_id': upload_id}
+
+    def _reconciled(self, listed, response):
+        self.completed_parts = dict(listed)
+        if self.journal is not None:
+            self.journal.replace_parts(self.completed_parts)
+        self._initialized(response)
 
     def _initialized(self, response):
         self.part_handler.upload_id = response.upload_id
         self.init_response = response
-        coiterate(self._generate_parts(
+        if self.journal is not None and \
+                self.journal.upload_id != response.upload_id:
+            self.journal.start(response.upload_id,
+                               self.parts_generator.part_size)
+        if self.completed_parts and \
+                hasattr(self.parts_generator, 'skip_parts'):
+            self.parts_generator.skip_parts = frozenset(self.completed_parts)
+        if self.byte_budget is not None and \
+                hasattr(self.parts_generator, 'byte_budget'):
+            # Let the generator reserve bytes for the parts it reads ahead.
+            self.parts_generator.byte_budget = self.byte_budget
+        d = coiterate(self._generate_parts(
                     self.parts_generator.generate_parts(self.fd)))
+        d.addErrback(self._error)
 
     def _generate_parts(self, gen):
-        def count(result):
-            self.counter.increment_count()
+        def count(result, size):
+            self.counter.increment_count(size)
             return result
-        work = []
-        retry = self.retry_strategy.retry
-        for (part, part_number) in gen:
-            d = retry(self.throttler.throttle,
-                      self.part_handler.handle_part, part, part_number)
+        gen = iter(gen)
+        expected = self.counter.expected
+        if not isinstance(expected, (int, long)):
+            expected = 0
+        tracker = self._tracker = PartsTracker(expected)
+        tracker.done.addCallback(self._parts_uploaded)
+        # Whether the generator reserves the bytes of the parts it reads,
+        # handing the reservation over with each part read.
+        reserving = self.byte_budget is not None and getattr(
+            self.parts_generator, 'byte_budget', None) is self.byte_budget
+        while self.cancelled is None:
+            if self.byte_budget is not None and not reserving:
+                # Don't generate another part until the manager-wide budget
+                # of bytes in flight has room for it.
+                granted = []
+                reserved = self._reserve_bytes().addCallback(granted.append)
+                if not reserved.called:
+                    self._waiting = reserved
+                    yield reserved
+                    self._waiting = None
+                if self.cancelled is not None:
+                    if granted[0]:
+                        self._release_bytes(None)
+                    break
+            read_started = self.clock.seconds()
+            try:
+                (part, part_number) = gen.next()
+            except StopIteration:
+                if not reserving:
+                    self._release_bytes(None)
+                break
+            except Exception:
+                self._read_failed(Failure(), not reserving)
+                break
+            if part_number in self.completed_parts:
+                if not reserving:
+                    self._release_bytes(None)
+                elif isinstance(part, Deferred):
+                    part.addCallback(self._reserved_part).addCallbacks(
+                        self._release_bytes, lambda why: None)
+                continue
+            if isinstance(part, Deferred):
+                # The part is still being read; pause until it's available.
+                ready = []
+                if reserving:
+                    part.addCallback(self._reserved_part)
+                part.addCallbacks(ready.append, self._read_failed,
+                                  errbackArgs=(not reserving,))
+                self._waiting = part
+                yield part
+                self._waiting = None
+                if self.cancelled is not None:
+                    if ready:
+                        self._release_bytes(None)
+                    break
+                part = ready[0]
+            self._trace('read', read_started,
+                        self.clock.seconds() - read_started,
+                        part_number=part_number, bytes=IByteLength(part))
+            tags = {'part_number': part_number, 'bytes': IByteLength(part)}
+            d = self._retry('upload_part', tags, self.throttler.throttle,
+                            self.part_handler.handle_part, part=part,
+                            part_number=part_number)
             if self.throughput_counter is not None:
                 entity_id = '%s-%s' % (id(self), part_number)
                 self.throughput_counter.start_entity(entity_id)
-                d.addBoth(self._stop_entity, entity_id, len(part))
-            d.addCallback(count)
+                d.addBoth(self._stop_entity, entity_id, IByteLength(part))
+            if self.byte_budget is not None:
+                d.addBoth(self._release_bytes)
+            if self.journal is not None:
+                d.addCallback(self._record_part)
+            d.addCallback(count, IByteLength(part))
             if self.on_part_generated is not None:
                 d.addCallback(self.on_part_generated)
-            work.append(d)
+            d.addErrback(self._part_failed)
+            tracker.track(part_number, d)
             yield
-        d = DeferredList(work, consumeErrors=True)
-        d.addCallback(self._parts_uploaded)
+        close = getattr(gen, 'close', None)
+        if close is not None:
+            # Return the bytes of parts read ahead.
+            close()
+        tracker.close()
+
+    def _reserved_part(self, part):
+        """
+        Take over the reservation the parts generator made for C{part}.
+        """
+        self.bytes_in_flight += self.parts_generator.part_size
+        return part
+
+    def _read_failed(self, why, release=True):
+        """
+        Fail fast on a part which couldn't be read, as on a part which
+        failed to upload. C{release} is False if no bytes were reserved
+        for the part.
+        """
+        if release:
+            self._release_bytes(None)
+        if self.cancelled is None:
+            self.cancel(why)
+
+    def _part_failed(self, why):
+        """
+        Fail fast: once a part has failed for good, cancel the rest.
+        """
+        if self.cancelled is None:
+            self.cancel(why)
+        return why
+
+    def _reserve_bytes(self):
+        """
+        Reserve a part's worth of bytes from the byte budget, returning a
+        L{Deferred} which fires with True once the reservation is granted,
+        or False if it is cancelled.
+        """
+        size = self.parts_generator.part_size
+        d = self.byte_budget.acquire(size)
+
+        def reserved(result):
+            self.bytes_in_flight += size
+            return True
+
+        def cancelled(why):
+            why.trap(CancelledError)
+            return False
+
+        return d.addCallbacks(reserved, cancelled)
+
+    def _release_bytes(self, result):
+        """
+        Return a reserved part's worth of bytes to the byte budget (if any).
+        """
+        if self.byte_budget is not None:
+            size = self.parts_generator.part_size
+            self.bytes_in_flight -= size
+            self.byte_budget.release(size)
+        return result
+
+    def _record_part(self, result):
+        (part_number, etag) = result
+        self.journal.record_part(part_number, etag)
+        return result
 
     def _stop_entity(self, result, entity_id, size):
         """
@@ -135,31 +769,61 @@ class MultipartUpload(ProgressLoggerMixin):
         self.throughput_counter.stop_entity(entity_id, size)
         return result
 
-    def _parts_uploaded(self, result):
+    def _parts_uploaded(self, tracker):
         """
         Final callback when all multipart upload_part operations are complete.
         """
-        parts_list = [r[1] for r in result if r[0]]
-        error_list = [r[1] for r in result if not r[0]]
-        if error_list:
-            return self._error(error_list[0])
+        if self.cancelled is not None:
+            return self._abort()
+        if tracker.failure is not None:
+            return self._error(tracker.failure)
+        parts_list = self.completed_parts.items()
+        parts_list.extend(tracker.parts())
         bucket = self.part_handler.bucket
         object_name = self.part_handler.object_name
         upload_id = self.init_response.upload_id
-        retry = self.retry_strategy.retry
-        d = retry(self.throttler.throttle,
+        d = self._control = self._retry('complete', {},
+                  self._control_throttle,
                   self.client.complete_multipart_upload, bucket, object_name,
                   upload_id, parts_list)
         d.addCallback(self._completed)
         d.addErrback(self._error)
 
+    def _abort(self):
+        """
+        Abort the multipart upload of a cancelled upload, if the client
+        can and the upload isn't journaled, then fail.
+        """
+        if self.journal is not None:
+            self.log.msg('%s left to be resumed' % self)
+            return self._error(self.cancelled)
+        abort = getattr(self.client, 'abort_multipart_upload', None)
+        if abort is None:
+            self.log.msg('%s left behind: the client cannot abort multipart '
+                         'uploads' % self)
+            return self._error(self.cancelled)
+        d = self._retry('abort', {}, self._control_throttle, abort,
+                        self.part_handler.bucket,
+                        self.part_handler.object_name,
+                        self.init_response.upload_id)
+        d.addErrback(self._abort_failed)
+        d.addCallback(lambda ignore: self._error(self.cancelled))
+
+    def _abort_failed(self, why):
+        self.log.msg('Could not abort %s' % self)
+        self.log.err(why)
+
     def _completed(self, completion_response):
         self.completion_response = completion_response
+        if self.journal is not None:
+            self.journal.finish()
         d = self.finished
         self.finished = None
         d.callback(self)
 
     def _error(self, why):
+        if self.cancelled is not None:
+            why = self.cancelled
         d = self.finished
         self.finished = None
         d.errback(why)
@@ -176,6 +840,114 @@ class MultipartUpload(ProgressLoggerMixin):
         return s
 
 
+class SinglePutUpload(ProgressLoggerMixin, _TracedTaskMixin):
+    """
+    Upload an object with a single PUT request instead of a multipart
+    upload, saving the init and complete round trips for small objects.
+    Retries, throttling (the throttler is shared with L{MultipartUpload}),
+    byte budget, throughput and transmission counting work as they do for
+    a one part L{MultipartUpload}.
+    """
+
+    put_response = None
+    failure = None
+    retry_strategy = MultipartUpload.retry_strategy
+    throughput_counter = None
+    throttler = MultipartUpload.throttler
+    byte_budget = None
+    bytes_in_flight = 0
+    bucket = None
+    object_name = None
+    cancelled = None
+    _request = None
+
+    def __init__(self, client, fd, counter, finished, log=None):
+        self.client = client
+        self.fd = fd
+        self.counter = counter
+        self.finished = finished
+        self.timings = UploadTimings()
+        self.set_log(log)
+
+    def upload(self, bucket, object_name, content_type, metadata,
+               amz_headers={}):
+        self.bucket = bucket
+        self.object_name = object_name
+        size = IByteLength(self.fd)
+        if self.byte_budget is None:
+            self._put(None, size, content_type, metadata, amz_headers)
+            return
+        d = self._request = self.byte_budget.acquire(size)
+        d.addCallbacks(self._put, self._error, callbackArgs=(
+                       size, content_type, metadata, amz_headers))
+
+    def cancel(self, why=None):
+        """
+        Stop the upload, cancelling the PUT or the wait for the byte
+        budget.
+
+        @param why: The L{Failure} finished fails with. default: a
+            L{CancelledError}
+        """
+        if self.finished is None or self.cancelled is not None:
+            return
+        if why is None:
+            why = Failure(CancelledError('Upload cancelled'))
+        self.cancelled = why
+        if self._request is not None:
+            self._request.cancel()
+
+    def _put(self, ignore, size, content_type, metadata, amz_headers):
+        self.bytes_in_flight = size
+        self.fd.seek(0)
+        data = self.fd.read()
+        d = self._request = self._retry('put', {'bytes': len(data)},
+                  self.throttler.throttle,
+                  self.client.put_object, self.bucket, self.object_name,
+                  data=data, content_type=content_type, metadata=metadata,
+                  amz_headers=amz_headers)
+        if self.throughput_counter is not None:
+            entity_id = '%s-1' % (id(self),)
+            self.throughput_counter.start_entity(entity_id)
+            d.addBoth(self._stop_entity, entity_id, len(data))
+        d.addBoth(self._release_bytes, size)
+        d.addCallbacks(self._completed, self._error, callbackArgs=(len(data),))
+
+    def _trace_tags(self):
+        return {'bucket': self.bucket, 'key': self.object_name,
+                'upload_id': None}
+
+    def _stop_entity(self, result, entity_id, size):
+        if isinstance(result, Failure):
+            size = 0
+        self.throughput_counter.stop_entity(entity_id, size)
+        return result
+
+    def _release_bytes(self, result, size):
+        self.bytes_in_flight = 0
+        if self.byte_budget is not None:
+            self.byte_budget.release(size)
+        return result
+
+    def _completed(self, put_response, size):
+        self.put_response = put_response
+        self.counter.increment_count(size)
+        d = self.finished
+        self.finished = None
+        d.callback(self)
+
+    def _error(self, why):
+        if self.cancelled is not None:
+            why = self.cancelled
+        d = self.finished
+        self.finished = None
+        d.errback(why)
+
+    def __str__(self):
+        return '%s bucket=%s, object_name=%s' % (self.__class__.__name__,
+            self.bucket, self.object_name)
+
+
 class MultipartUploadsManager(ProgressLoggerMixin):
     """
     The L{MultipartUploadsManager} is the primary interface for optionally
@@ -186,13 +958,58 @@ class MultipartUploadsManager(ProgressLoggerMixin):
         and AWS_SECRET_ACCESS_KEY.
     @param counter_factory: A callable that takes no args and returns an
         L{ITransmissionCounter} provider. If None, the default class
-        L{PartsTransferredCounter} will be used.
+        L{PartsTransferredCounter} will be used. Pass the C{counter} method
+        of a L{bafload.progress.ProgressReporter} to log the aggregate
+        progress of all uploads rather than a line per part.
     @param log: An L{ILog} provider. default: L{twisted.python.log}
+    @param byte_budget: A L{bafload.budget.ByteBudget} limiting bytes of
+        parts generated but not yet uploaded across all uploads. If None,
+        part generation is not limited.
+    @param part_size_policy: An L{IPartSizePolicy} provider used to choose
+        the part size of default parts generators. If None, a default
+        L{bafload.sizing.PartSizePolicy} will be used.
+    @param journal_dir: Directory to keep L{bafload.journal.UploadJournal}s
+        of uploads in so they can be resumed. If None, uploads are not
+        journaled.
+    @param single_put_threshold: Objects smaller than this many bytes are
+        uploaded with a single PUT (L{SinglePutUpload}) rather than a
+        multipart upload, unless L{upload} is given a C{parts_generator},
+        C{part_handler} or C{on_part_generated}, which only apply to
+        multipart uploads. If None, all objects use multipart uploads.
+    @param throttler: An L{IThrottler} provider throttling this manager's
+        calls. An L{IFairThrottler} gives each upload its own queue and
+        control calls priority. If None, uploads share the class-level
+        throttler of L{MultipartUpload}.
+    @param hedge_percentile: If not None, part handlers are wrapped in
+        L{bafload.hedge.HedgingPartHandler}s which upload a part again when
+        it runs longer than this percentile of the upload's part durations.
+    @param retry_strategy: An L{IRetryDeferred} provider retrying this
+        manager's calls, such as a L{bafload.retry.ClassifyingBackoff}. If
+        None, uploads use the class-level retry strategy of
+        L{MultipartUpload}.
+    @param connection_pool_size: If not None, uploads use clients from a
+        L{bafload.pool.ClientPool} (one per bucket) keeping up to this many
+        persistent connections open, and connections for a multipart
+        upload's parts are opened while it is initiated. The pool's hits
+        and misses are counted by C{clients.connections}.
+    @param latencies: A L{bafload.stats.LatencyStats} recording the
+        latencies of the phases of uploads. If None, latencies are not
+        recorded.
+    @param tracer: An L{ITracer} provider receiving the events of uploads,
+        such as a L{bafload.trace.JSONLinesExporter}. Each upload also
+        keeps an L{bafload.trace.UploadTimings} of its events as its
+        C{timings}.
     """
     implements(IMultipartUploadsManager)
 
+    cooperator = task
+
     def __init__(self, creds=None, counter_factory=None, log=None, region=None,
-                 throughput_counter=None):
+                 throughput_counter=None, byte_budget=None,
+                 part_size_policy=None, journal_dir=None,
+                 single_put_threshold=None, throttler=None,
+                 hedge_percentile=None, retry_strategy=None,
+                 connection_pool_size=None, latencies=None, tracer=None):
         if counter_factory is None:
             counter_factory = PartsTransferredCounter
         if region is None:
@@ -200,44 +1017,272 @@ class MultipartUploadsManager(ProgressLoggerMixin):
         self.region = region
         self.counter_factory = counter_factory
         self.throughput_counter = throughput_counter
+        self.latencies = latencies
+        self.tracer = tracer
+        self.byte_budget = byte_budget
+        if part_size_policy is None:
+            part_size_policy = PartSizePolicy()
+        self.part_size_policy = part_size_policy
+        self.journals = None
+        if journal_dir is not None:
+            self.journals = JournalDirectory(journal_dir)
+        self.single_put_threshold = single_put_threshold
+        self.throttler = throttler
+        self.hedge_percentile = hedge_percentile
+        self.retry_strategy = retry_strategy
+        self.clients = None
+        if connection_pool_size is not None:
+            self.clients = ClientPool(region, connection_pool_size)
         self.set_log(log)
         self.uploads = set()
 
+    @property
+    def bytes_in_flight(self):
+        """
+        Bytes of parts generated but not yet uploaded for all uploads.
+        """
+        return sum(task.bytes_in_flight for task in self.uploads)
+
     def upload(self, fd, bucket, object_name, content_type=None,
                metadata={}, parts_generator=None, part_handler=None,
-               amz_headers={}, on_part_generated=None):
+               amz_headers={}, on_part_generated=None, part_size_policy=None,
+               resume=False, reconcile=False):
+        """
+        See L{IMultipartUploadsManager.upload}.
+
+        @param resume: If True, resume the upload recorded in this manager's
+            journal for C{fd}, C{bucket} and C{object_name} (if any),
+            generating only the parts which are still missing.
+        @param reconcile: If True when resuming, use the parts S3 lists for
+            the upload instead of those in the journal.
+        """
+        if resume and self.journals is None:
+            raise ValueError('Cannot resume uploads without a journal_dir')
         self.log.msg('Beginning upload to bucket=%s,key=%s' % (
                      bucket, object_name))
-        client = self.region.get_s3_client()
+        client = self._client_for(bucket)
+        if resume and reconcile and not hasattr(client, 'list_parts'):
+            raise ValueError('Cannot reconcile uploads with a client without '
+                             'list_parts')
+        multipart_only = (parts_generator, part_handler, on_part_generated)
+        if multipart_only == (None, None, None) and self._use_single_put(fd):
+            return self._put(client, fd, bucket, object_name, content_type,
+                             metadata, amz_headers)
         if parts_generator is None:
             parts_generator = FileIOPartsGenerator()
+            if part_size_policy is None:
+                part_size_policy = self.part_size_policy
+        if part_size_policy is not None:
+            parts_generator.part_size = part_size_policy.part_size_for(fd)
+        journal = None
+        if self.journals is not None:
+            journal = self.journals.journal_for(fd, bucket, object_name)
+            resume = resume and journal.load()
+            if resume:
+                self.log.msg('Resuming upload_id=%s with %d parts uploaded' % (
+                             journal.upload_id, len(journal.parts)))
+                parts_generator.part_size = journal.part_size
         if part_handler is None:
             part_handler = SingleProcessPartUploader()
+        if self.hedge_percentile is not None:
+            part_handler = HedgingPartHandler(part_handler,
+                                              self.hedge_percentile,
+                                              log=self.log)
         # TODO - probably need some pluggable strategy for getting the parts
         # count (if desired) or not (optimization) - maybe parts_count()
         # method on IPartsGenerator.
         # Or maybe this whole counter idea is just plain wrong.
         counter = self.counter_factory(parts_generator.count_parts(fd))
         counter.context = '[object_name=%s] ' % object_name
+        counter.expected_bytes = self._byte_length(fd)
         part_handler.client = client
         d = Deferred()
         task = MultipartUpload(client, fd, parts_generator, part_handler,
                                counter, d, self.log)
         task.on_part_generated = on_part_generated
         task.throughput_counter = self.throughput_counter
+        task.latencies = self.latencies
+        task.tracer = self.tracer
+        task.byte_budget = self.byte_budget
+        task.journal = journal
+        self._install_throttler(task)
+        if self.hedge_percentile is not None:
+            # Parts are hedged through the upload's throttler too.
+            part_handler.throttler = task.throttler
+        if self.retry_strategy is not None:
+            task.retry_strategy = self.retry_strategy
+        self.uploads.add(task)
+        d.addCallbacks(self._completed_upload, self._failed_upload,
+                       errbackArgs=(task,))
+        d.addBoth(self._remove_upload, task)
+        if self.clients is not None:
+            # Open connections for the parts while the upload is initiated.
+            self._warm(counter.expected)
+        if resume:
+            counter.completed = len(journal.parts)
+            task.resume(bucket, object_name, journal.upload_id, journal.parts,
+                        reconcile)
+        else:
+            task.upload(bucket, object_name, content_type, metadata,
+                        amz_headers)
+        return d
+
+    def _client_for(self, bucket):
+        if self.clients is None:
+            return get_s3_client(self.region)
+        return self.clients.client_for(bucket)
+
+    def _warm(self, parts):
+        if not isinstance(parts, (int, long)):
+            parts = None
+        self.clients.warm(parts)
+
+    def _byte_length(self, fd):
+        try:
+            return IByteLength(fd)
+        except TypeError:
+            return None
+
+    def _use_single_put(self, fd):
+        if self.single_put_threshold is None:
+            return False
+        size = self._byte_length(fd)
+        if size is None:
+            return False
+        return size < self.single_put_threshold
+
+    def _put(self, client, fd, bucket, object_name, content_type, metadata,
+             amz_headers):
+        counter = self.counter_factory(1)
+        counter.context = '[object_name=%s] ' % object_name
+        counter.expected_bytes = IByteLength(fd)
+        d = Deferred()
+        task = SinglePutUpload(client, fd, counter, d, self.log)
+        task.throughput_counter = self.throughput_counter
+        task.latencies = self.latencies
+        task.tracer = self.tracer
+        task.byte_budget = self.byte_budget
+        self._install_throttler(task)
+        if self.retry_strategy is not None:
+            task.retry_strategy = self.retry_strategy
         self.uploads.add(task)
-        d.addCallbacks(self._completed_upload, self.log.err)\
-            .addBoth(self._remove_upload, task)
+        d.addCallbacks(self._completed_upload, self._failed_upload,
+                       errbackArgs=(task,))
+        d.addBoth(self._remove_upload, task)
         task.upload(bucket, object_name, content_type, metadata, amz_headers)
         return d
 
+    def cancel(self, task):
+        """
+        Cancel upload C{task}, one of L{uploads}. Its parts waiting and in
+        flight are cancelled, its multipart upload aborted and the
+        L{Deferred} returned by L{upload} for it fails with a
+        L{CancelledError}.
+        """
+        self.log.msg('Cancelling upload for task: %s' % task)
+        task.cancel()
+
+    def _install_throttler(self, task):
+        if self.throttler is None:
+            return
+        if IFairThrottler.providedBy(self.throttler):
+            task.throttler = self.throttler.queue()
+            task.control_throttler = self.throttler.control_throttler
+        else:
+            task.throttler = self.throttler
+
+    def upload_many(self, sources, bucket, concurrency=10, on_result=None,
+                    **kw):
+        """
+        Upload many objects to C{bucket}, at most C{concurrency} at a time.
+        Sources are taken from C{sources} and opened only as their uploads
+        start, and closed when they finish, so C{sources} may be a
+        generator over any number of files.
+
+        @param sources: Iterable of sources. A source is a path (uploaded
+            as its base name), a 2-tuple (path, object_name) or a callable
+            taking no arguments and returning a 2-tuple (fd, object_name).
+        @param bucket: The bucket name
+        @param concurrency: Maximum number of uploads running at once
+        @param on_result: Callable called with (source, result) as each
+            upload finishes where result is the upload task, or a
+            L{Failure} if the upload failed.
+        @param kw: Additional keyword arguments for L{upload}. If no
+            content_type is given, it is guessed from the object name.
+        @return: L{Deferred} which fires with a 2-tuple of the number of
+            uploads completed and failed once all sources are uploaded.
+        """
+        bulk = _BulkUpload(self, bucket, on_result, kw)
+        work = (bulk.upload(source) for source in sources)
+        coiterate = self.cooperator.coiterate
+        d = gatherResults([coiterate(work) for _ in xrange(concurrency)])
+        d.addCallback(lambda ignore: (bulk.completed, bulk.failed))
+        return d
+
     def _completed_upload(self, task):
         self.log.msg('Completed upload for task: %s' % task)
         return task
 
+    def _failed_upload(self, why, task):
+        task.failure = why
+        self.log.err(why)
+
     def _remove_upload(self, _ignore, task):
         self.uploads.remove(task)
         return task
 
+class _BulkUpload(object):
+    """
+    Upload sources for L{MultipartUploadsManager.upload_many}.
+    """
+
+    completed = 0
+    failed = 0
+
+    def __init__(self, manager, bucket, on_result, kw):
+        self.manager = manager
+        self.bucket = bucket
+        self.on_result = on_result
+        self.kw = kw
+
+    def upload(self, source):
+        try:
+            (fd, object_name, opened) = self._open(source)
+        except Exception:
+            self._finished(Failure(), source, None)
+            return None
+        kw = dict(self.kw)
+        if kw.get('content_type') is None:
+            kw['content_type'] = mimetypes.guess_type(object_name)[0]
+        d = maybeDeferred(self.manager.upload, fd, self.bucket, object_name,
+                          **kw)
+        d.addBoth(self._finished, source, opened)
+        return d
+
+    def _open(self, source):
+        if callable(source):
+            (fd, object_name) = source()
+            return (fd, object_name, None)
+        if isinstance(source, tuple):
+            (path, object_name) = source
+        else:
+            path = source
+            object_name = os.path.basename(path)
+        fd = open(path, 'rb')
+        return (fd, object_name, fd)
+
+    def _finished(self, result, source, opened):
+        if opened is not None:
+            opened.close()
+        if not isinstance(result, Failure) and result.failure is not None:
+            result = result.failure
+        if isinstance(result, Failure):
+            self.failed += 1
+        else:
+            self.completed += 1
+        if self.on_result is not None:
+            self.on_result(source, result)
+
+
 # make pyflakes happy
 _PYFLAKES = [adapters]
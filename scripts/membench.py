@@ -0,0 +1,119 @@
+"""
+Measure the memory each part of a multipart upload keeps until the upload
+completes.
+
+Usage: membench.py PARTS [UPLOADS]
+
+Runs UPLOADS (default 10) uploads of PARTS parts each against a client
+which acknowledges parts at once but never completes uploads, then counts
+the objects (and their bytes, as reported by sys.getsizeof) still held
+once every upload is waiting for its completion. Only objects tracked by
+the garbage collector are counted (not, for instance, tuples of strings
+and ints), so the maximum RSS is printed as well.
+"""
+import gc
+import resource
+import sys
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+from txaws.s3.model import MultipartInitiationResponse
+
+from bafload.interfaces import ILog
+from bafload.up import MultipartUpload, PartsTransferredCounter
+from bafload.throttle import PassThruThrottler
+
+
+parts = int(sys.argv[1])
+uploads = 10
+if len(sys.argv) > 2:
+    uploads = int(sys.argv[2])
+
+
+class PartsGenerator(object):
+    part_size = 1
+
+    def generate_parts(self, fd):
+        for part_number in xrange(1, parts + 1):
+            yield ('x', part_number)
+
+    def count_parts(self, fd):
+        return parts
+
+
+class PartHandler(object):
+    bucket = object_name = upload_id = client = None
+
+    def handle_part(self, part, part_number):
+        return succeed((part_number, '"0123456789"'))
+
+
+class Client(object):
+
+    def __init__(self):
+        self.completing = 0
+
+    def init_multipart_upload(self, bucket, object_name, content_type,
+                              metadata, amz_headers={}):
+        return succeed(MultipartInitiationResponse(bucket, object_name,
+                                                   '1234'))
+
+    def complete_multipart_upload(self, bucket, object_name, upload_id,
+                                  parts_list):
+        self.completing += 1
+        if self.completing == uploads:
+            reactor.callLater(0, measure)
+        return Deferred()
+
+
+class Log(object):
+    implements(ILog)
+
+    def msg(self, *message, **kw):
+        pass
+
+    def err(self, stuff, why=None, **kw):
+        pass
+
+
+def snapshot():
+    gc.collect()
+    objects = gc.get_objects()
+    return dict((id(o), sys.getsizeof(o)) for o in objects)
+
+
+def start():
+    for i in range(uploads):
+        counter = PartsTransferredCounter(parts)
+        counter.set_log(Log())
+        upload = MultipartUpload(client, None, PartsGenerator(),
+                                 PartHandler(), counter, Deferred(), Log())
+        upload.throttler = PassThruThrottler()
+        upload.upload('mybucket', 'key%d' % i, None, {})
+        tasks.append(upload)
+
+
+def measure():
+    after = snapshot()
+    new = [size for (key, size) in after.iteritems() if key not in before]
+    total = parts * uploads
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print 'uploads: %d, parts per upload: %d' % (uploads, parts)
+    print 'objects held: %d (%.2f per part)' % (len(new),
+                                                len(new) / float(total))
+    print 'bytes held: %d (%.1f per part)' % (sum(new),
+                                              sum(new) / float(total))
+    print 'max rss: %.1fMB (%.1fMB before uploads)' % (maxrss / 1024.0,
+                                                       maxrss_before / 1024.0)
+    reactor.stop()
+
+
+client = Client()
+tasks = []
+before = snapshot()
+maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+reactor.callWhenRunning(start)
+reactor.run()
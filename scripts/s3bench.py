@@ -0,0 +1,219 @@
+"""
+Benchmark uploads against a local fake S3 (L{bafload.fakes3}).
+
+Usage: s3bench.py [options] DIRECTORY
+
+Uploads the files in DIRECTORY, such as those written by genbench.py, once
+for every combination of part size, concurrency and throttler, and prints
+the throughput of each run. A run still going after --timeout seconds has
+its uploads cancelled and is reported as timed out::
+
+    python scripts/genbench.py /tmp/bench 20 5 50
+    python scripts/s3bench.py -p 5,16 -c 1,4,16 -T concurrent,fair,aimd \\
+        -b 20 -e 0.01 /tmp/bench
+"""
+import os
+from optparse import OptionParser
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.server import Site
+
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceRegion
+
+from bafload.fakes3 import FakeS3, Faults, FakeS3Resource
+from bafload.retry import ClassifyingBackoff
+from bafload.sizing import PartSizePolicy
+from bafload.throttle import (MaxConcurrentThrottler, FairThrottler,
+        AIMDThrottler, ByteRateThrottler)
+from bafload.up import MultipartUploadsManager
+
+
+MB = 2 ** 20
+
+
+def aimd_throttler(max_calls):
+    return AIMDThrottler(initial=max_calls)
+
+
+def rate_throttler(max_calls):
+    # As the upload script limits its rate.
+    rate = ByteRateThrottler(mb_per_second(options.limit_rate))
+    return FairThrottler(max_calls, throttler=rate)
+
+
+THROTTLERS = {'concurrent': MaxConcurrentThrottler, 'fair': FairThrottler,
+              'aimd': aimd_throttler, 'rate': rate_throttler}
+
+
+def csv(convert):
+    def parse(option, opt, value, parser):
+        setattr(parser.values, option.dest,
+                [convert(v) for v in value.split(',')])
+    return parse
+
+
+parser = OptionParser(usage='%prog [options] DIRECTORY')
+parser.add_option('-p', '--part-sizes', dest='part_sizes', type='string',
+    action='callback', callback=csv(float), default=[5],
+    help='Comma separated part sizes in MB')
+parser.add_option('-c', '--concurrency', dest='concurrency', type='string',
+    action='callback', callback=csv(int), default=[10],
+    help='Comma separated numbers of objects uploaded at once')
+parser.add_option('-T', '--throttlers', dest='throttlers', type='string',
+    action='callback', callback=csv(str), default=['concurrent'],
+    help='Comma separated throttlers: concurrent, fair, aimd (an adaptive '
+         'window starting at --max-calls) or rate (fair, limited to '
+         '--limit-rate)')
+parser.add_option('-m', '--max-calls', dest='max_calls', type='int',
+    default=10, help='Maximum calls in flight per throttler')
+parser.add_option('-R', '--limit-rate', dest='limit_rate', type='float',
+    default=10, help='Upload rate in MB/s of the rate throttler')
+parser.add_option('-s', '--single-put-threshold', dest='single_put_threshold',
+    type='int', help='Upload objects smaller than this many bytes with a '
+                     'single PUT')
+parser.add_option('-x', '--timeout', dest='timeout', type='float',
+    default=600, help='Seconds before a run is cancelled and reported as '
+                      'timed out')
+parser.add_option('-a', '--max-attempts', dest='max_attempts', type='int',
+    default=8, help='Number of attempts of each call before giving up')
+parser.add_option('-o', '--log-file', dest='log_file', default=os.devnull,
+    help='File to write the log (including retried errors) to')
+parser.add_option('-l', '--latency', dest='latency', type='float', default=0,
+    help='Seconds each request is delayed by')
+parser.add_option('-b', '--bandwidth', dest='bandwidth', type='float',
+    help='MB per second of each request')
+parser.add_option('-B', '--total-bandwidth', dest='total_bandwidth',
+    type='float', help='MB per second of all requests')
+parser.add_option('-e', '--error-rate', dest='error_rate', type='float',
+    default=0, help='Fraction of requests failing with a 500')
+parser.add_option('-t', '--throttle-rate', dest='throttle_rate',
+    type='float', default=0, help='Fraction of requests failing with a 503')
+parser.add_option('-r', '--reset-rate', dest='reset_rate', type='float',
+    default=0, help='Fraction of requests whose connection is reset')
+parser.add_option('-w', '--slow-rate', dest='slow_rate', type='float',
+    default=0, help='Fraction of requests given a slow connection')
+parser.add_option('-f', '--slow-factor', dest='slow_factor', type='float',
+    default=10, help='How many times slower slow connections are')
+options, args = parser.parse_args()
+if len(args) != 1:
+    parser.error('Must supply the directory of files to upload')
+
+
+def mb_per_second(value):
+    if value is None:
+        return None
+    return value * MB
+
+
+def list_files(dirname):
+    paths = [os.path.join(dirname, name)
+             for name in sorted(os.listdir(dirname))]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def runs():
+    for part_size in options.part_sizes:
+        for concurrency in options.concurrency:
+            for throttler in options.throttlers:
+                if throttler not in THROTTLERS:
+                    parser.error('Unknown throttler: %s' % throttler)
+                yield (int(part_size * MB), concurrency, throttler)
+
+
+def run(region, paths, part_size, concurrency, throttler):
+    s3.clear()
+    manager = MultipartUploadsManager(region=region,
+        throttler=THROTTLERS[throttler](options.max_calls),
+        part_size_policy=PartSizePolicy(min_part_size=part_size),
+        single_put_threshold=options.single_put_threshold,
+        retry_strategy=ClassifyingBackoff(options.max_attempts))
+    requests = resource.requests
+    injected = dict(faults.injected)
+    started = reactor.seconds()
+    # Uploads completed and failed so far, for runs which time out.
+    counts = [0, 0]
+    # Bytes of the completed uploads, which failed ones don't count
+    # towards.
+    uploaded = [0]
+
+    def on_result(source, result):
+        counts[isinstance(result, Failure)] += 1
+        if not isinstance(result, Failure):
+            uploaded[0] += os.path.getsize(source)
+
+    d = manager.upload_many(paths, 'bench', concurrency, on_result=on_result)
+    finished = Deferred()
+
+    def report((completed, failed), note=''):
+        elapsed = reactor.seconds() - started
+        faulted = sum(faults.injected.values()) - sum(injected.values())
+        rate = '-'
+        if not note:
+            rate = '%.2f' % (uploaded[0] / float(MB) / elapsed)
+        print '%8.1f %11d %10s %8.2f %8s %9d %6d %9d %7d%s' % (
+              part_size / float(MB), concurrency, throttler, elapsed, rate,
+              completed, failed, resource.requests - requests, faulted, note)
+
+    def timed_out():
+        for task in list(manager.uploads):
+            manager.cancel(task)
+        report(counts, ' timed out')
+        finished.callback(None)
+
+    timer = reactor.callLater(options.timeout, timed_out)
+
+    def done(result):
+        if not timer.active():
+            # Reported as timed out already.
+            return
+        timer.cancel()
+        if isinstance(result, Failure):
+            finished.errback(result)
+        else:
+            report(result)
+            finished.callback(None)
+
+    d.addBoth(done)
+    return finished
+
+
+def run_all(region, paths, combinations):
+    for combination in combinations:
+        d = run(region, paths, *combination)
+        d.addCallback(lambda ignore: run_all(region, paths, combinations))
+        return d.addErrback(failed)
+    reactor.stop()
+
+
+def failed(why):
+    why.printTraceback()
+    reactor.stop()
+
+
+def start():
+    port = reactor.listenTCP(0, Site(resource), interface='127.0.0.1')
+    region = AWSServiceRegion(creds=AWSCredentials('bench', 'bench'),
+        s3_uri='http://127.0.0.1:%d/' % port.getHost().port)
+    print '%8s %11s %10s %8s %8s %9s %6s %9s %7s' % ('part(MB)',
+          'concurrency', 'throttler', 'secs', 'MB/s', 'uploaded', 'failed',
+          'requests', 'faults')
+    run_all(region, paths, runs())
+
+
+paths = list_files(args[0])
+faults = Faults(latency=options.latency,
+                bandwidth=mb_per_second(options.bandwidth),
+                total_bandwidth=mb_per_second(options.total_bandwidth),
+                error_rate=options.error_rate,
+                throttle_rate=options.throttle_rate,
+                reset_rate=options.reset_rate, slow_rate=options.slow_rate,
+                slow_factor=options.slow_factor)
+s3 = FakeS3()
+resource = FakeS3Resource(s3, faults)
+log.startLogging(open(options.log_file, 'a'), setStdout=False)
+reactor.callWhenRunning(start)
+reactor.run()